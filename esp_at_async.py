@@ -0,0 +1,295 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import utime as time
+
+from esp_at_uart import ESPCHIP, CMDS_GENERIC, CMDS_WIFI, CMDS_HTTP, \
+    HTTP_HEADER, IPD_HEADER, STATUS_BUSY, CMD_RESPONSE_TIMEOUT, \
+    CMD_GRACE_TIMEOUT, RESYNC_TIMEOUT, CMD_BUFFER_SIZE, CONNECT_TIMEOUT, BOOT_TIMEOUT, VALID_WIFI_MODES, \
+    URC_QUEUE_SIZE, CommandError, CommandFailure, UnknownWIFIModeError
+
+"""
+uasyncio front end of the ESPCHIP driver. The module is driven through a
+StreamReader/StreamWriter pair, so waiting for its answers does not block
+other coroutines. All commands go through a single lock, thus concurrent
+coroutines never interleave their commands on the wire.
+"""
+
+
+class AsyncESPCHIP(object):
+
+    def __init__(self, reader, writer, echo=True):
+        """Initialize the driver with a StreamReader and StreamWriter
+        connected to the module. Use from_uart() for a machine.UART.
+        echo=False turns the echo of the commands off before the first
+        command (see set_echo())."""
+        self._reader = reader
+        self._writer = writer
+        self._lock = asyncio.Lock()
+        self._cmd_buf = bytearray(CMD_BUFFER_SIZE)
+        # the module echoes the commands, see ESPCHIP._response_lines()
+        self.echo = True
+        # the echo is turned off again before the next command once the
+        # module was reset
+        self._echo_off = not echo
+        # the module got an IP and the last URC events (see
+        # ESPCHIP._parse_urc()), the oldest ones are dropped if more than
+        # URC_QUEUE_SIZE are waiting
+        self._got_ip = False
+        self.events = []
+
+    @classmethod
+    def from_uart(cls, uart, echo=True):
+        """Create the driver for a machine.UART object (MicroPython)."""
+        return cls(asyncio.StreamReader(uart), asyncio.StreamWriter(uart, {}), echo=echo)
+
+    async def close(self):
+        """Close the streams to the module."""
+        self._writer.close()
+        await self._writer.wait_closed()
+
+    async def _readline(self, start, deadline):
+        """Read a line, returns None if it does not arrive before the
+        deadline (ms after start)."""
+        remaining = deadline - time.ticks_diff(time.ticks_ms(), start)
+        if remaining <= 0:
+            return None
+        try:
+            return await asyncio.wait_for(self._reader.readline(), remaining / 1000)
+        except asyncio.TimeoutError:
+            return None
+
+    def _event(self, urc):
+        """Keep the event of a URC line in events."""
+        event = urc[0]
+        if event.startswith('WIFI') and event != 'WIFI_CONNECTED':
+            self._got_ip = event == 'WIFI_GOT_IP'
+        self.events.append(urc)
+        if len(self.events) > URC_QUEUE_SIZE:
+            self.events.pop(0)
+
+    async def _read_framed(self, line, prefix, end):
+        """Return the data of a line like +IPD,<len>:<data>. readline() may
+        have read only a part of the data or more than the data."""
+        pos = line.find(end, len(prefix))
+        size = int(line[len(prefix):pos].split(b',')[-1])
+        data = line[pos + 1:]
+        if len(data) < size:
+            data += await self._reader.readexactly(size - len(data))
+        return data[:size]
+
+    async def _read_response(self, cmd, start, timeout=0, debug=False, on_data=None):
+        """Read the answer of the module to cmd up to the status line and
+        return all lines read without the echo, URCs (kept in events) and
+        blank lines. Data of +HTTPCLIENT chunks is passed to on_data. See
+        ESPCHIP._response_lines and ESPCHIP._send_command for the framing,
+        timeouts and exceptions."""
+        cmd_output = []
+        deadline = CMD_RESPONSE_TIMEOUT
+        synced = not self.echo
+        # without an echo the first line may already be the slow answer
+        answering = synced
+        if answering:
+            deadline += timeout if timeout else CMD_GRACE_TIMEOUT
+        tag = b'+' + cmd[3:] + b':'
+        held = []
+        held_status = False
+        status = None
+        while status is None:
+            if held_status:
+                # wait a little for the echo, see ESPCHIP._response_lines
+                line = await self._readline(start, min(
+                    deadline, time.ticks_diff(time.ticks_ms(), start) + RESYNC_TIMEOUT))
+            else:
+                line = await self._readline(start, deadline)
+            if line is None:
+                if not held_status:
+                    break
+                # the echo got lost, take the answer held back
+                cmd_output = held
+                status = ESPCHIP._status(held[-1])
+                break
+            if debug:
+                print("%8i - RX: %s" %
+                      (time.ticks_diff(time.ticks_ms(), start), str(line)))
+            if line.startswith(IPD_HEADER):
+                # no sockets in this front end, keep the framing intact
+                await self._read_framed(line, IPD_HEADER, b':')
+                continue
+            if line.startswith(HTTP_HEADER):
+                data = await self._read_framed(line, HTTP_HEADER, b',')
+                if on_data:
+                    on_data(data)
+                # data keeps arriving, see ESPCHIP._response_lines
+                deadline = max(deadline, time.ticks_diff(time.ticks_ms(), start) +
+                               CMD_RESPONSE_TIMEOUT)
+                continue
+            if not answering:
+                # the module answers, give it time to finish
+                answering = True
+                deadline += timeout if timeout else CMD_GRACE_TIMEOUT
+            urc = ESPCHIP._parse_urc(line)
+            if urc:
+                self._event(urc)
+                continue
+            if line == b'\r\n':
+                continue
+            if not synced:
+                # skip everything up to the echo of the command, status and
+                # tagged lines are held back in case it was garbled
+                synced = ESPCHIP._is_echo(line, cmd)
+                if synced or held_status:
+                    held = []
+                    held_status = False
+                if not synced and (ESPCHIP._status(line) is not None or line.startswith(tag)):
+                    held.append(line)
+                    held_status = ESPCHIP._status(line) is not None
+                continue
+            if not cmd_output and ESPCHIP._is_echo(line, cmd):
+                # echo although it is off
+                continue
+            cmd_output.append(line)
+            status = ESPCHIP._status(line)
+
+        if status is None:
+            if debug:
+                print("%8i - RX-Timeout occured and no 'OK' received!" %
+                      (time.ticks_diff(time.ticks_ms(), start)))
+        elif status == b'ERROR':
+            raise CommandError('Command error!')
+        elif status == STATUS_BUSY:
+            raise CommandError('Module busy!')
+        elif status in (b'FAIL', b'SEND FAIL'):
+            raise CommandFailure()
+        return cmd_output
+
+    def _encode(self, cmd, op=b'', args=()):
+        """See ESPCHIP._encode()."""
+        while True:
+            try:
+                return ESPCHIP._encode_command(self._cmd_buf, cmd, op, args)
+            except IndexError:
+                self._cmd_buf = bytearray(2 * len(self._cmd_buf))
+
+    async def _exchange(self, cmd, op=b'', args=(), timeout=0, debug=False, on_data=None):
+        """Write a command and read its answer, the lock must be held."""
+        start = time.ticks_ms()
+        n = self._encode(cmd, op, args)
+        if debug:
+            print("%8i - TX: %s" % (0, str(bytes(self._cmd_buf[:n]))))
+        self._writer.write(memoryview(self._cmd_buf)[:n])
+        await self._writer.drain()
+        return await self._read_response(cmd, start, timeout=timeout,
+                                         debug=debug, on_data=on_data)
+
+    async def _send_command(self, cmd, op=b'', args=(), timeout=0, debug=False, on_data=None):
+        """Send a command to the module and return its output. Waits for
+        the commands of other coroutines to finish first. If the echo
+        is to be off but on (after the start or a reset), ATE0 is sent
+        first."""
+        async with self._lock:
+            if self._echo_off and self.echo:
+                # the module may have the echo off already, see set_echo()
+                self.echo = False
+                await self._exchange(CMDS_GENERIC['ECHO'] + b'0', debug=debug)
+            return await self._exchange(cmd, op, args, timeout=timeout,
+                                        debug=debug, on_data=on_data)
+
+    async def _query_command(self, cmd, timeout=0, debug=False):
+        lines = ESPCHIP._data_lines(await self._send_command(cmd, b'?', timeout=timeout,
+                                                             debug=debug))
+        if lines is None:
+            raise CommandFailure('No answer!')
+        return ESPCHIP._tagged(lines, cmd)
+
+    async def _set_command(self, cmd, *args, timeout=0, debug=False):
+        return ESPCHIP._data_lines(await self._send_command(cmd, b'=', args, timeout=timeout,
+                                                            debug=debug))
+
+    async def _execute_command(self, cmd, timeout=0, debug=False):
+        return ESPCHIP._data_lines(await self._send_command(cmd, timeout=timeout, debug=debug))
+
+    async def test(self, debug=False):
+        """Test the AT command interface."""
+        return await self._execute_command(CMDS_GENERIC['TEST_AT'], debug=debug) == []
+
+    async def version(self, debug=False):
+        """Read the version."""
+        return await self._execute_command(CMDS_GENERIC['VERSION_INFO'], debug=debug)
+
+    async def reset(self, debug=False):
+        """Reset the module and wait until it reports to be ready. An echo
+        turned off is turned off again before the next command."""
+        start = time.ticks_ms()
+        async with self._lock:
+            self._writer.write(CMDS_GENERIC['RESET'] + b'\r\n')
+            await self._writer.drain()
+            while True:
+                line = await self._readline(start, BOOT_TIMEOUT)
+                if line is None:
+                    return False
+                if debug:
+                    print("%8i - RX: %s" %
+                          (time.ticks_diff(time.ticks_ms(), start), str(line)))
+                # garbage of the boot ROM may precede 'ready'
+                if line.rstrip().endswith(b'ready'):
+                    self.echo = True
+                    return True
+
+    async def set_echo(self, enable, debug=False):
+        """See ESPCHIP.set_echo()."""
+        self._echo_off = not enable
+        self.echo = False
+        ok = await self._execute_command(CMDS_GENERIC['ECHO'] + (b'1' if enable else b'0'),
+                                         debug=debug) == []
+        self.echo = bool(enable) and ok
+        return ok
+
+    async def get_mode(self, debug=False):
+        """See ESPCHIP.get_mode()."""
+        return ESPCHIP._parse_mode(await self._query_command(CMDS_WIFI['MODE'], debug=debug))
+
+    async def set_mode(self, mode, debug=False):
+        """See ESPCHIP.set_mode()."""
+        if mode not in VALID_WIFI_MODES:
+            raise UnknownWIFIModeError("Mode '%d' not known!" % mode)
+        return await self._set_command(CMDS_WIFI['MODE'], mode, debug=debug)
+
+    async def get_accesspoint(self, debug=False):
+        """See ESPCHIP.get_accesspoint()."""
+        return ESPCHIP._parse_accesspoint(
+            await self._query_command(CMDS_WIFI['CONNECT'], debug=debug))
+
+    async def connect(self, ssid, psk, debug=False):
+        """See ESPCHIP.connect()."""
+        self._got_ip = False
+        await self._set_command(CMDS_WIFI['CONNECT'], ssid, psk,
+                                timeout=CONNECT_TIMEOUT, debug=debug)
+        return self._got_ip
+
+    async def disconnect(self, debug=False):
+        """See ESPCHIP.disconnect()."""
+        return await self._execute_command(CMDS_WIFI['DISCONNECT'], debug=debug) == []
+
+    async def list_all_accesspoints(self, timeout=10000, debug=False):
+        """See ESPCHIP.list_all_accesspoints()."""
+        return ESPCHIP._parse_list_ap_results(
+            await self._execute_command(CMDS_WIFI['LIST_APS'], timeout=timeout,
+                                        debug=debug) or ())
+
+    async def get_station_ip(self, debug=False):
+        """See ESPCHIP.get_station_ip()."""
+        return await self._query_command(CMDS_WIFI['SET_STATION_IP'], debug=debug)
+
+    async def http_request(self, url, data=None, headers=[], method="GET", contentType="application/x-www-form-urlencoded", timeout=0, debug=False):
+        """See ESPCHIP.http_request(). POST bodies are put into the AT
+        command line, use the blocking driver for large uploads."""
+        args = ESPCHIP._http_args(url, data, method, contentType, headers)
+        chunks = []
+        lines = await self._send_command(CMDS_HTTP['HTTP_CLIENT'], b'=', args, timeout=timeout,
+                                         debug=debug, on_data=chunks.append)
+        if ESPCHIP._data_lines(lines) is None:
+            raise CommandFailure('Incomplete HTTP response!')
+        rdata = b''.join(chunks)
+        return {"size": len(rdata), "data": rdata}
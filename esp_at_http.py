@@ -0,0 +1,293 @@
+import utime as time
+
+try:
+    from ucollections import namedtuple
+except ImportError:
+    from collections import namedtuple
+
+from esp_at_uart import CommandError, CommandFailure
+
+"""
+HTTP/1.1 client on top of the TCP and SSL links of the module (AT+CIPSTART
+in multiple connection mode), thus it works with the ESP8266 AT firmware as
+well, which has no AT+HTTPCLIENT. Connections are kept open (Connection:
+keep-alive) in a pool per host and port, so repeated requests to the same
+host skip the TCP and TLS handshake. Idle connections are closed after
+idle_timeout ms. Chunked responses are decoded.
+
+    client = HTTPClient(esp)
+    r = client.request('GET', 'http://example.com/api')
+    print(r.status, r.headers.get('content-type'), r.data)
+"""
+
+# Link type and default port of the URL schemes
+HTTP_SCHEMES = {'http': ('TCP', 80), 'https': ('SSL', 443)}
+# Idle connections kept open, the module has 5 links in total
+POOL_SIZE = 2
+# Idle connections older than this (ms) are closed instead of reused
+IDLE_TIMEOUT = 30000
+# Time (s) to wait for data from the server
+RESPONSE_TIMEOUT = 10
+# Bytes read from a link at once
+RECV_SIZE = 512
+# Max. data size of a single AT+CIPSEND
+SEND_CHUNK = 2048
+
+# status code, reason phrase, headers (dict with lower case names) and
+# body of a response
+HTTPResponse = namedtuple('HTTPResponse', ('status', 'reason', 'headers', 'data'))
+
+
+class HTTPError(Exception):
+    pass
+
+
+def _parse_url(url):
+    """Split url into link type, host, port and path."""
+    scheme, sep, rest = url.partition('://')
+    if not sep or scheme not in HTTP_SCHEMES:
+        raise ValueError('Unsupported URL %s!' % url)
+    proto, port = HTTP_SCHEMES[scheme]
+    host, _, path = rest.partition('/')
+    if ':' in host:
+        host, port = host.split(':')
+        port = int(port)
+    return proto, host, port, '/' + path
+
+
+class HTTPConnection(object):
+    """Buffered HTTP connection over a link of the module (ATSocket)."""
+
+    def __init__(self, esp, proto, host, port, timeout=RESPONSE_TIMEOUT):
+        self.key = (proto, host, port)
+        self.sock = esp.open_connection(proto, host, port)
+        self.sock.settimeout(timeout)
+        # requests answered and the time the connection became idle
+        self.requests = 0
+        self.idle_since = None
+        self._buf = b''
+        self._chunk = bytearray(RECV_SIZE)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except CommandError:
+            # closed by the server, the CLOSED message is not read yet
+            self.sock.connected = False
+
+    def closed_before_response(self, e):
+        """Return True if the exception e raised while sending a request
+        and waiting for the status line shows that the link was closed
+        before the server answered: the module refused AT+CIPSEND (ERROR),
+        the link was gone or it was closed before any data arrived. A
+        timeout is not, the server may still process the request."""
+        if isinstance(e, CommandError):
+            return True
+        if isinstance(e, HTTPError):
+            return not self._buf
+        return isinstance(e, OSError) and e.args[0] == 107  # ENOTCONN
+
+    def send(self, data):
+        mv = memoryview(data)
+        for i in range(0, len(mv), SEND_CHUNK):
+            self.sock.send(mv[i:i + SEND_CHUNK])
+
+    def _recv(self):
+        """Return the next received data, b'' once the link is closed."""
+        n = self.sock.recv_into(self._chunk)
+        return bytes(self._chunk[:n])
+
+    def readline(self):
+        """Return the next line including its '\\n'. Raises an HTTPError
+        if the link is closed first."""
+        while True:
+            i = self._buf.find(b'\n')
+            if i >= 0:
+                line = self._buf[:i + 1]
+                self._buf = self._buf[i + 1:]
+                return line
+            data = self._recv()
+            if not data:
+                raise HTTPError('Connection closed!')
+            self._buf += data
+
+    def read(self, n):
+        """Return exactly n bytes, received straight into the result."""
+        buf = bytearray(n)
+        mv = memoryview(buf)
+        got = min(n, len(self._buf))
+        mv[:got] = self._buf[:got]
+        self._buf = self._buf[got:]
+        while got < n:
+            r = self.sock.recv_into(mv[got:])
+            if not r:
+                raise HTTPError('Connection closed after %d of %d bytes!' % (got, n))
+            got += r
+        return bytes(buf)
+
+    def read_chunked(self):
+        """Return the body of a response with chunked transfer encoding."""
+        parts = []
+        while True:
+            size = int(self.readline().split(b';')[0].strip(), 16)
+            if not size:
+                break
+            parts.append(self.read(size))
+            # the line end of the chunk
+            self.readline()
+        # trailers up to an empty line
+        while self.readline().strip():
+            pass
+        return b''.join(parts)
+
+    def read_all(self):
+        """Return everything received until the server closes the link."""
+        parts = [self._buf]
+        self._buf = b''
+        while True:
+            data = self._recv()
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+
+class HTTPClient(object):
+
+    def __init__(self, esp, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT,
+                 timeout=RESPONSE_TIMEOUT):
+        """Initialize the client for the ESPCHIP esp. Up to pool_size idle
+        connections are kept for idle_timeout ms, timeout is the time (s)
+        to wait for data from the server."""
+        self._esp = esp
+        self._pool = []
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # connections opened, i.e. handshakes done
+        self.connects = 0
+
+    def close(self):
+        """Close the idle connections."""
+        while self._pool:
+            self._pool.pop().close()
+
+    def _connection(self, proto, host, port):
+        """Return an idle connection to host, port from the pool or a new
+        one. Connections closed by the server or idle for too long are
+        dropped from the pool."""
+        # process the CLOSED messages of links closed by the servers
+        self._esp.poll()
+        now = time.ticks_ms()
+        found = None
+        for conn in list(self._pool):
+            if not conn.sock.connected or \
+                    time.ticks_diff(now, conn.idle_since) > self.idle_timeout:
+                self._pool.remove(conn)
+                conn.close()
+            elif conn.key == (proto, host, port):
+                found = conn
+        if found:
+            self._pool.remove(found)
+            return found
+        while True:
+            try:
+                conn = HTTPConnection(self._esp, proto, host, port, self.timeout)
+                break
+            except CommandFailure:
+                # all links in use, give up the oldest idle connection
+                if not self._pool:
+                    raise
+                self._pool.pop(0).close()
+        self.connects += 1
+        return conn
+
+    def _release(self, conn):
+        """Put the connection into the pool of idle connections."""
+        conn.idle_since = time.ticks_ms()
+        self._pool.append(conn)
+        while len(self._pool) > self.pool_size:
+            self._pool.pop(0).close()
+
+    @classmethod
+    def _head(cls, method, host, port, path, data, headers, keep_alive):
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % host if port in (80, 443) else 'Host: %s:%d' % (host, port),
+                 'Connection: keep-alive' if keep_alive else 'Connection: close']
+        if data is not None:
+            lines.append('Content-Length: %d' % len(data))
+        lines.extend(headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+    @classmethod
+    def _read_response(cls, conn, status_line, method):
+        """Read the headers and the body of a response. Returns the
+        HTTPResponse and whether the connection may be reused."""
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            raise HTTPError('Invalid status line %s!' % status_line)
+        headers = {}
+        while True:
+            line = conn.readline().strip()
+            if not line:
+                break
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        status = int(parts[1])
+        connection = headers.get('connection', '').lower()
+        if parts[0] == b'HTTP/1.1':
+            reusable = connection != 'close'
+        else:
+            reusable = connection == 'keep-alive'
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = conn.read_chunked()
+        elif 'content-length' in headers:
+            data = conn.read(int(headers['content-length']))
+        else:
+            data = conn.read_all()
+            reusable = False
+        reason = parts[2].strip().decode() if len(parts) > 2 else ''
+        return HTTPResponse(status, reason, headers, data), reusable
+
+    def request(self, method, url, data=None, headers=(), keep_alive=True):
+        """Send a request and return the HTTPResponse. headers is a list of
+        header lines like 'Accept: text/plain'. With keep_alive the
+        connection is kept open for the next request to the same host and
+        port. If a kept connection turns out to be closed by the server
+        before it answered, the request is sent again over a new one (see
+        HTTPConnection.closed_before_response()). Other errors, like a
+        timeout, are raised, so a request is never sent twice."""
+        proto, host, port, path = _parse_url(url)
+        if type(data) is str:
+            data = data.encode()
+        head = HTTPClient._head(method, host, port, path, data, headers, keep_alive)
+        while True:
+            conn = self._connection(proto, host, port)
+            try:
+                conn.send(head)
+                if data:
+                    conn.send(data)
+                status_line = conn.readline()
+                break
+            except (OSError, CommandError, CommandFailure, HTTPError) as e:
+                conn.close()
+                if not conn.requests or not conn.closed_before_response(e):
+                    raise
+        try:
+            response, reusable = HTTPClient._read_response(conn, status_line, method)
+        except Exception:
+            conn.close()
+            raise
+        conn.requests += 1
+        if keep_alive and reusable:
+            self._release(conn)
+        else:
+            conn.close()
+        return response
+
+    def get(self, url, headers=(), keep_alive=True):
+        return self.request('GET', url, headers=headers, keep_alive=keep_alive)
+
+    def post(self, url, data, headers=(), keep_alive=True):
+        return self.request('POST', url, data, headers=headers, keep_alive=keep_alive)
@@ -0,0 +1,163 @@
+import utime as time
+
+try:
+    import array
+    import fcntl
+    import os
+    import select
+    import socket
+    import termios
+except ImportError:
+    termios = None
+
+"""
+Byte streams the driver talks to the module over. A transport provides
+
+    write(buf)       write the bytes, return the number written
+    readinto(buf)    read up to len(buf) bytes without blocking, return their
+                     number or None if nothing was available
+    any()            number of bytes which can be read without blocking
+    wait(timeout)    wait up to timeout ms (forever if None) for data to
+                     arrive, return True if there is any
+    init(baudrate, flow=0)
+                     change the line settings, if the transport has any
+
+UARTTransport uses a machine.UART. SerialTransport (a serial device, e.g. a
+USB serial adapter, or a PTY) and SocketTransport (a TCP connection to a
+modem bridge like host/sim_server.py) need a POSIX system running CPython.
+"""
+
+
+class UARTTransport(object):
+
+    def __init__(self, uart, rxbuf=-1, flow=0):
+        """Use the machine.UART uart. rxbuf is the size of its receive
+        buffer if known, flow its flow control setting."""
+        self.uart = uart
+        self._rxbuf = rxbuf
+        self._flow = flow
+        # times the receive buffer of the UART filled up, i.e. bytes were
+        # probably lost (never counted with RTS/CTS flow control). Polls
+        # finding it still full count once.
+        self.overflows = 0
+        self._full = False
+
+    def __repr__(self):
+        return repr(self.uart)
+
+    def init(self, *args, **kwargs):
+        self.uart.init(*args, **kwargs)
+        if kwargs.get('rxbuf', -1) >= 0:
+            self._rxbuf = kwargs['rxbuf']
+        self._flow = kwargs.get('flow', 0)
+
+    def write(self, buf):
+        return self.uart.write(buf)
+
+    def readinto(self, buf):
+        return self.uart.readinto(buf)
+
+    def any(self):
+        n = self.uart.any()
+        full = n >= self._rxbuf > 0 and not self._flow
+        if full and not self._full:
+            self.overflows += 1
+        self._full = full
+        return n
+
+    def wait(self, timeout):
+        start = time.ticks_ms()
+        while not self.uart.any():
+            if timeout is not None and time.ticks_diff(time.ticks_ms(), start) >= timeout:
+                return False
+            time.sleep_ms(1)
+        return True
+
+
+class PosixTransport(object):
+
+    def __init__(self, fd):
+        """Use the file descriptor fd, which is closed by close()."""
+        self.fd = fd
+        self._poll = select.poll()
+        self._poll.register(fd, select.POLLIN)
+        self._nread = array.array('i', [0])
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+    def write(self, buf):
+        return os.write(self.fd, buf)
+
+    def readinto(self, buf):
+        n = self.any()
+        if not n:
+            return None
+        mv = memoryview(buf)
+        return os.readv(self.fd, [mv[:n] if n < len(mv) else mv])
+
+    def any(self):
+        fcntl.ioctl(self.fd, termios.FIONREAD, self._nread, True)
+        return self._nread[0]
+
+    def wait(self, timeout):
+        if not self._poll.poll(timeout):
+            return False
+        if not self.any():
+            # readable without data: the other end is gone
+            raise OSError('Connection closed!')
+        return True
+
+
+class SerialTransport(PosixTransport):
+
+    def __init__(self, path, baudrate=115200, flow=0):
+        """Open the serial device (or PTY) at path with 8N1 and the given
+        baud rate, flow enables RTS/CTS flow control."""
+        super().__init__(os.open(path, os.O_RDWR | os.O_NOCTTY))
+        self.path = path
+        self.init(baudrate, flow=flow)
+
+    def __repr__(self):
+        return "SerialTransport('%s', baudrate=%d)" % (self.path, self.baudrate)
+
+    def init(self, baudrate=115200, flow=0, **kwargs):
+        speed = getattr(termios, 'B%d' % baudrate, None)
+        if speed is None:
+            raise ValueError('Unsupported baud rate %d!' % baudrate)
+        attrs = termios.tcgetattr(self.fd)
+        # raw 8N1, no modem control lines
+        attrs[0] = 0
+        attrs[1] = 0
+        attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+        if flow:
+            attrs[2] |= termios.CRTSCTS
+        attrs[3] = 0
+        attrs[4] = attrs[5] = speed
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        # let the command switching the baud rate leave at the old one
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, attrs)
+        self.baudrate = baudrate
+
+
+class SocketTransport(PosixTransport):
+
+    def __init__(self, host, port):
+        """Connect to the modem bridge listening at host, port."""
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().__init__(self.sock.fileno())
+        self.address = (host, port)
+
+    def __repr__(self):
+        return "SocketTransport('%s', %d)" % self.address
+
+    def close(self):
+        self.sock.close()
+
+    def write(self, buf):
+        return self.sock.send(buf)
@@ -1,5 +1,15 @@
 from machine import UART
 import utime as time
+try:
+    from ucollections import namedtuple
+except ImportError:
+    from collections import namedtuple
+try:
+    import ujson as json
+except ImportError:
+    import json
+from uart_timeout_any import FRAMED_LINES, streamTimeOut
+from esp_at_transport import UARTTransport
 
 # This hashmap collects all generic AT commands
 CMDS_GENERIC = {
@@ -9,7 +19,8 @@ CMDS_GENERIC = {
     'DEEP_SLEEP': b'AT+GSLP',
     'ECHO': b'ATE',
     'FACTORY_RESET': b'AT+RESTORE',
-    'UART_CFG_DEF': b'AT+UART_DEF=9600,8,1,0,0'
+    'UART_CFG_DEF': b'AT+UART_DEF=9600,8,1,0,0',
+    'UART_CFG_CUR': b'AT+UART_CUR'
 }
 
 # All WIFI related AT commands
@@ -17,6 +28,7 @@ CMDS_WIFI = {
     'MODE': b'AT+CWMODE',
     'CONNECT': b'AT+CWJAP',
     'LIST_APS': b'AT+CWLAP',
+    'LIST_APS_OPT': b'AT+CWLAPOPT',
     'DISCONNECT': b'AT+CWQAP',
     'AP_SET_PARAMS': b'AT+CWSAP',
     'AP_LIST_STATIONS': b'AT+CWLIF',
@@ -45,9 +57,15 @@ CMDS_IP = {
 
 # HTTP Client related AT commands
 CMDS_HTTP = {
-    'HTTP_CLIENT': b'AT+HTTPCLIENT'
+    'HTTP_CLIENT': b'AT+HTTPCLIENT',
+    'HTTP_POST': b'AT+HTTPCPOST'
 }
 
+# Header of a chunk of a HTTP response: +HTTPCLIENT:<len>,<data>
+HTTP_HEADER = b'+HTTPCLIENT:'
+# Default size of the buffer HTTP responses are streamed through
+HTTP_CHUNK_SIZE = 512
+
 HTTP_METHODS = {
     "HEAD": 1,
     "GET": 2,
@@ -85,6 +103,123 @@ WIFI_ENCRYPTION_PROTOCOLS = {
 }
 VALID_WIFI_ENCRYPTION_PROTOCOLS = list(WIFI_ENCRYPTION_PROTOCOLS.values())
 
+# Result records. Strings are returned as str, missing fields as None.
+# An access point found by a scan (+CWLAP)
+AccessPoint = namedtuple('AccessPoint', ('encryption_protocol', 'ssid', 'rssi',
+                                         'mac', 'channel'))
+# The joined access point (+CWJAP)
+JoinedAccessPoint = namedtuple('JoinedAccessPoint', ('ssid', 'bssid', 'channel', 'rssi', 'pciEn',
+                                                     'reconnInterval', 'listenInterval',
+                                                     'scanMode'))
+# Configuration of the access point of the module (+CWSAP)
+AccessPointConfig = namedtuple('AccessPointConfig', ('ssid', 'password', 'channel',
+                                                     'encryption_protocol', 'max_conn',
+                                                     'ssid_hidden'))
+# Bits of the AT+CWLAPOPT mask selecting the fields of AccessPoint
+SCAN_FIELDS = {
+    'encryption_protocol': 0x01,
+    'ssid': 0x02,
+    'rssi': 0x04,
+    'mac': 0x08,
+    'channel': 0x10
+}
+SCAN_MASK_ALL = 0x1f
+DHCPConfig = namedtuple('DHCPConfig', ('station', 'softAP'))
+# A station connected to the access point of the module (AT+CWLIF)
+Station = namedtuple('Station', ('ip', 'mac'))
+# A link in the connection status (+CIPSTATUS), tetype 0: module is client
+Link = namedtuple('Link', ('link_id', 'type', 'remote_ip', 'remote_port',
+                           'local_port', 'tetype'))
+ConnectionStatus = namedtuple('ConnectionStatus', ('status', 'links'))
+# Result of a command of a Batch: the lines of the answer (None if it
+# failed) and the exception raised for it
+BatchResult = namedtuple('BatchResult', ('command', 'lines', 'error'))
+
+# Status lines which terminate the response of an AT command
+STATUS_LINES = (b'OK', b'ERROR', b'FAIL', b'SEND OK', b'SEND FAIL')
+# The module rejects commands with 'busy p...' while still processing
+STATUS_BUSY = b'busy p'
+
+# Unsolicited result codes (URC), lines the module sends on its own, by
+# the name of the event they are dispatched as
+URC_LINES = {
+    b'WIFI CONNECTED': 'WIFI_CONNECTED',
+    b'WIFI GOT IP': 'WIFI_GOT_IP',
+    b'WIFI DISCONNECT': 'WIFI_DISCONNECT',
+    b'CONNECT': 'CONNECT',
+    b'CLOSED': 'CLOSED',
+}
+URC_PREFIXES = (
+    (b'+STA_CONNECTED:', 'STA_CONNECTED'),
+    (b'+STA_DISCONNECTED:', 'STA_DISCONNECTED'),
+    (b'+DIST_STA_IP:', 'DIST_STA_IP'),
+)
+# Number of events kept for polling if no handler is subscribed
+URC_QUEUE_SIZE = 16
+
+# Link IDs available in multiple connection mode (AT+CIPMUX=1)
+MUX_LINK_IDS = range(5)
+# Header of received network data: +IPD,[<link id>,]<len>:<data>
+IPD_HEADER = b'+IPD,'
+
+# Initial size of the buffer AT commands are encoded into, it grows if a
+# command does not fit
+CMD_BUFFER_SIZE = 128
+
+# Time (ms) the module has to start answering an AT command
+CMD_RESPONSE_TIMEOUT = 1000
+# Default time (ms) an answering module has to finish its output
+CMD_GRACE_TIMEOUT = 5000
+# Time (ms) without data after a status line, if the echo of the command
+# did not arrive intact the answer is taken nevertheless
+RESYNC_TIMEOUT = 100
+# Time (ms) joining an access point may take
+CONNECT_TIMEOUT = 20000
+# Time (ms) the module needs to boot after a reset
+BOOT_TIMEOUT = 10000
+# Lines of the boot log kept by reset()
+BOOT_LOG_SIZE = 16
+
+# Counters kept per command by CommandMetrics
+METRIC_FIELDS = ('count', 'total_ms', 'min_ms', 'max_ms', 'tx_bytes', 'rx_bytes',
+                 'timeouts', 'errors', 'failures', 'discarded')
+
+# Commands of a batch written to the module before their answers are read.
+# The module answers 'busy p...' to commands arriving while it processes
+# the previous one, so writing ahead pays off only with slow links.
+BATCH_DEPTH = 1
+# Times a command of a batch answered with 'busy p...' is sent again
+BATCH_RETRIES = 3
+# Set type commands which may be queued in a batch, the configuration
+# setters. Others change the state of the driver as well (connections,
+# prompts) and are refused inside of a batch.
+BATCH_COMMANDS = (CMDS_WIFI['MODE'], CMDS_WIFI['DHCP_CONFIG'], CMDS_WIFI['AP_SET_PARAMS'],
+                  CMDS_WIFI['SET_AUTOCONNECT'], CMDS_WIFI['SET_STATION_IP'],
+                  CMDS_WIFI['SET_AP_IP'])
+
+# File in flash the profile of the last joined access point is kept in
+WIFI_PROFILE_FILE = 'wifi_profile.json'
+
+# Bytes written at once in transparent transmission mode, the size of the
+# module's transparent transmission buffer
+PASSTHROUGH_CHUNK = 2048
+# Silence (ms) needed around '+++' to leave transparent transmission mode
+PASSTHROUGH_GUARD_TIME = 20
+# Time (ms) the module needs after '+++' to accept AT commands again
+PASSTHROUGH_EXIT_TIME = 1000
+
+# Baud rates tried by negotiate_baud(), fastest first
+BAUD_RATES = (921600, 460800, 230400, 115200)
+# Flow control setting of AT+UART_CUR: none or RTS/CTS
+UART_FLOW_NONE = 0
+UART_FLOW_RTS_CTS = 3
+# Time (ms) the module needs to switch its baud rate after the 'OK'
+BAUD_SWITCH_TIME = 20
+# Time (ms) the module has to finish its answer to a probing 'AT'
+BAUD_PROBE_TIMEOUT = 100
+# Number of 'AT' sent to check a new baud rate
+BAUD_PROBES = 3
+
 class CommandError(Exception):
     pass
 
@@ -101,187 +236,797 @@ class InvalidParameterError(Exception):
 
 class ESPCHIP(object):
 
-    def __init__(self, uart=1, baud_rate=115200):
-        """Initialize this module. uart may be an integer or an instance
-        of machine.UART. baud_rate can be used to set the Baud rate for the
-        serial communication."""
+    def __init__(self, uart=1, baud_rate=115200, echo=True):
+        """Initialize this module. uart may be an integer (the UART id), an
+        instance of machine.UART or a transport (see esp_at_transport, e.g.
+        a SerialTransport or SocketTransport). baud_rate can be used to set
+        the Baud rate for the serial communication. echo=False turns the
+        echo of the commands off (see set_echo())."""
         if uart:
             if type(uart) is int:
-                # self.uart = UART(uart, baud_rate)
                 from uart_timeout_any import uartTimeOut
                 self.uart = uartTimeOut(uart, baud_rate)
             elif type(uart) is UART:
+                self.uart = streamTimeOut(UARTTransport(uart))
+            elif isinstance(uart, streamTimeOut):
                 self.uart = uart
+            elif hasattr(uart, 'readinto') and hasattr(uart, 'wait'):
+                self.uart = streamTimeOut(uart)
             else:
                 raise Exception(
-                    "Argument 'uart' must be an integer or machine.UART object!")
-            print(self.uart)
+                    "Argument 'uart' must be an integer, machine.UART or transport object!")
         else:
             raise Exception("Argument uart must not be 'None'!")
+        self.baud_rate = baud_rate
+        self.flow_control = False
+        # baud rate of the module after a reboot, AT+UART_CUR is not stored
+        # in flash (see negotiate_baud())
+        self._boot_baud = baud_rate
+        self._partial = b''
+        # reusable buffer the commands are encoded into
+        self._cmd_buf = bytearray(CMD_BUFFER_SIZE)
+        self._cmd_mv = memoryview(self._cmd_buf)
+        # [link ID, remaining bytes] of a +IPD frame which is not read yet
+        self._ipd = None
+        # receive buffer and state of the single connection mode
+        self._rx = bytearray()
+        self._connected = False
+        self._got_ip = False
+        self._mux = False
+        self._passthrough = False
+        # open sockets in multiple connection mode by their link ID
+        self._links = {}
+        # URC handlers by event, URCs waiting to be dispatched and events
+        # nobody subscribed to
+        self._handlers = {}
+        self._urcs = []
+        self.events = []
+        # fields printed by a scan (AT+CWLAPOPT) and the rest of the answer
+        # of a command which was abandoned by the caller
+        self._scan_mask = SCAN_MASK_ALL
+        self._pending = None
+        # duration (ms) of the last join with a full scan (cold) and with
+        # the cached BSSID (warm), see reconnect()
+        self.join_times = {'cold': None, 'warm': None}
+        # cached WIFI state: 'mode', 'accesspoint', 'dhcp', 'autoconnect',
+        # 'station_ip' and 'ap_ip'
+        self._cache = {}
+        # batch the set type commands are queued in, see batch()
+        self._batch = None
+        # last lines printed by the module while booting, see reset()
+        self.boot_log = []
+        # the module echoes the commands (see _response_lines()) and the
+        # echo should be turned off after a reset (see set_echo())
+        self.echo = True
+        self._echo_off = False
+        # bytes received, the last command written and the counters per
+        # command (see enable_metrics())
+        self._rx_bytes = 0
+        self._last_cmd = None
+        self.metrics = None
+        if not echo:
+            self.set_echo(False)
 
-    def _send_command(self, cmd, timeout=0, debug=False):
-        """Send a command to the ESPCHIP module over UART and return the
-        output.
-        After sending the command there is a 1 second timeout while
-        waiting for an answer on UART. For long running commands (like AP
-        scans) there is an additional N seconds grace period to return
-        results over UART.
-        Raises an CommandError if an error occurs and an CommandFailure
-        if a command fails to execute."""
-        if debug:
-            start = time.ticks_ms()
-        cmd_output = []
-        okay = False
-        if cmd == '' or cmd == b'':
-            raise CommandError("Unknown command '" + cmd + "'!")
+    @classmethod
+    def _status(cls, line):
+        """Return the status code if the line terminates the response of an
+        AT command, otherwise None."""
+        line = line.rstrip()
+        if line in STATUS_LINES:
+            return line
+        if line.startswith(STATUS_BUSY):
+            return STATUS_BUSY
+        if line[-1:] in (b'K', b'R', b'L'):
+            # garbage in front of the status code, e.g. the rest of a line
+            # which was partly lost
+            for status in STATUS_LINES:
+                n = len(status)
+                if len(line) > n and line.endswith(status) and not 32 <= line[-n - 1] < 127:
+                    return status
+        return None
 
-        # AT commands must be finalized with an '\r\n'
-        cmd += '\r\n'
-        if debug:
-            print("%8i - TX: %s" %
-                  (time.ticks_diff(time.ticks_ms(), start), str(cmd)))
-        self.uart.write(cmd)
+    @classmethod
+    def _is_echo(cls, line, cmd):
+        """Return True if line is the echo of the command cmd (like
+        b'AT+CWMODE'). Garbage in front of the echo is skipped."""
+        pos = line.find(cmd)
+        if pos < 0:
+            return False
+        end = pos + len(cmd)
+        return line[end:end + 1] in (b'', b'=', b'?', b'\r', b'\n')
 
-        # wait at maximum one second for a command reaction
-        cmd_timeout = 100
-        while cmd_timeout > 0:
-            if self.uart.any():
-                cmd_output.append(self.uart.readline())
+    @classmethod
+    def _data_lines(cls, lines):
+        """Return the lines of an answer without the status line, or None
+        if the status line is missing (timeout)."""
+        if not lines or ESPCHIP._status(lines[-1]) is None:
+            return None
+        return lines[:-1]
+
+    @classmethod
+    def _tagged(cls, lines, cmd):
+        """Return the first line of an answer tagged like the command cmd
+        (+CWMODE: for b'AT+CWMODE') without the line end, None if there
+        is none."""
+        tag = b'+' + cmd[3:] + b':'
+        for line in lines:
+            if line.startswith(tag):
+                return line.rstrip()
+        return None
+
+    def _readline(self):
+        """Read a line from UART. Returns None as long as the line is not
+        complete."""
+        line = self.uart.readline()
+        if not line:
+            return None
+        self._rx_bytes += len(line)
+        if self._partial:
+            line = self._partial + line
+            self._partial = b''
+        if line[-1:] != b'\n':
+            for prefix, end in FRAMED_LINES:
+                if line[-1] == end and line.startswith(prefix):
+                    return line
+            # wait for the rest of the line
+            self._partial = line
+            return None
+        return line
+
+    def _response_lines(self, start, timeout=0, debug=False, cmd=None, echo=True):
+        """Generator yielding the lines of the answer of the module up to
+        and including the status line, without the echo of the command
+        and blank lines. See _send_command for the timeouts and
+        exceptions. cmd is the command answered, the last one written if
+        None. Unless the echo is off (see echo) or echo is False, e.g. for
+        the answer to data sent after a prompt, everything up to the echo
+        of cmd is discarded: a late answer of an earlier command or garbage
+        can not be taken for the answer. Status lines and lines tagged like
+        cmd arriving before the echo are held back, they are taken for the
+        answer if the echo does not follow within RESYNC_TIMEOUT ms (it
+        was garbled)."""
+        if cmd is None:
+            cmd = self._last_cmd
+        synced = not (echo and self.echo)
+        tag = b'+' + cmd[3:] + b':'
+        held = []
+        held_status = False
+        discarded = 0
+        rx_mark = self._rx_bytes
+        count = 0
+        deadline = CMD_RESPONSE_TIMEOUT
+        # without an echo the first line may already be the slow answer
+        answering = synced
+        if answering:
+            deadline += timeout if timeout else CMD_GRACE_TIMEOUT
+        status = None
+        last_rx = start
+        while status is None:
+            if held_status and (time.ticks_diff(time.ticks_ms(), last_rx) > RESYNC_TIMEOUT or
+                                time.ticks_diff(time.ticks_ms(), start) > deadline):
+                # the echo got lost, take the answer held back
+                if debug:
+                    print("%8i - No echo, taking the answer" %
+                          (time.ticks_diff(time.ticks_ms(), start)))
+                synced = True
+                held_status = False
+                while held:
+                    count += 1
+                    status = ESPCHIP._status(held[0])
+                    yield held.pop(0)
+            elif self.uart.any():
+                line = self._readline()
+                if line is None:
+                    continue
+                last_rx = time.ticks_ms()
                 if debug:
                     print("%8i - RX: %s" %
-                          (time.ticks_diff(time.ticks_ms(), start), str(cmd_output[-1])))
-                if cmd_output[-1].rstrip() == b'OK':
+                          (time.ticks_diff(time.ticks_ms(), start), str(line)))
+                if not answering:
+                    # the module answers, give it time to finish
+                    answering = True
+                    deadline += timeout if timeout else CMD_GRACE_TIMEOUT
+                    if debug and timeout:
+                        print("%8i - Using RX timeout of %i ms" %
+                              (time.ticks_diff(time.ticks_ms(), start), timeout))
+                if self._handle_urc(line, debug=debug):
+                    if self._ipd:
+                        self._drain_ipd(debug=debug)
+                    continue
+                if line == b'\r\n':
+                    continue
+                if not synced:
+                    synced = ESPCHIP._is_echo(line, cmd)
+                    if synced or held_status:
+                        # the lines held back belong to an earlier answer
+                        discarded += len(held)
+                        held = []
+                        held_status = False
+                    if synced:
+                        continue
+                    if ESPCHIP._status(line) is not None or line.startswith(tag):
+                        held.append(line)
+                        held_status = ESPCHIP._status(line) is not None
+                        continue
+                    discarded += 1
                     if debug:
-                        print("%8i - 'OK' received!" %
-                              (time.ticks_diff(time.ticks_ms(), start)))
-                    okay = True
-            else:
-                time.sleep_ms(10)
-            cmd_timeout -= 1
-        if cmd_timeout == 0 and len(cmd_output) == 0:
-            if debug == True:
-                print("%8i - RX timeout of answer after sending AT command!" %
-                      (time.ticks_diff(time.ticks_ms(), start)))
+                        print("%8i - Discarding: %s" %
+                              (time.ticks_diff(time.ticks_ms(), start), str(line)))
+                    continue
+                if not count and echo and ESPCHIP._is_echo(line, cmd):
+                    # echo although it is off, e.g. the module restarted
+                    continue
+                count += 1
+                status = ESPCHIP._status(line)
+                yield line
+                # data keeps arriving (or the caller read a payload), allow
+                # slow answers like large HTTP bodies at low baud rates
+                deadline = max(deadline, time.ticks_diff(time.ticks_ms(), start) +
+                               CMD_RESPONSE_TIMEOUT)
+            elif time.ticks_diff(time.ticks_ms(), start) > deadline:
+                if self._partial and synced:
+                    count += 1
+                    yield self._partial
+                    self._partial = b''
+                break
             else:
-                print("RX timeout of answer after sending AT command!")
+                self.uart.wait(1)
 
-        # read output if present
-        while self.uart.any():
-            cmd_output.append(self.uart.readline())
-            if debug:
-                print("%8i - RX: %s" %
-                      (time.ticks_diff(time.ticks_ms(), start), str(cmd_output[-1])))
-            if cmd_output[-1].rstrip() == b'OK':
-                if debug:
-                    print("%8i - 'OK' received!" %
-                          (time.ticks_diff(time.ticks_ms(), start)))
-                okay = True
+        if debug and status is not None:
+            print("%8i - '%s' received!" %
+                  (time.ticks_diff(time.ticks_ms(), start), status.decode()))
+        if self.metrics is not None:
+            for _ in range(discarded + len(held)):
+                self.metrics.discard(cmd)
+            self.metrics.record(cmd, time.ticks_diff(time.ticks_ms(), start),
+                                self._rx_bytes - rx_mark, status)
 
         # handle output of AT command
-        if len(cmd_output) > 0:
-            if cmd_output[-1].rstrip() == b'ERROR':
-                raise CommandError('Command error!')
-            elif cmd_output[-1].rstrip() == b'OK':
-                okay = True
-            elif not okay:
-                # some long running commands do not return OK in case of success
-                # and/or take some time to yield all output.
-                if timeout == 0:
-                    cmd_timeout = 500
+        if status is None:
+            if not synced:
+                if debug:
+                    print("%8i - RX timeout, no echo of the command received!" %
+                          (time.ticks_diff(time.ticks_ms(), start)))
                 else:
-                    if debug:
-                        print("%8i - Using RX timeout of %i ms" %
-                              (time.ticks_diff(time.ticks_ms(), start), timeout))
-                    cmd_timeout = timeout / 10
-                while cmd_timeout > 0:
-                    if self.uart.any():
-                        cmd_output.append(self.uart.readline())
-                        if debug:
-                            print("%8i - RX: %s" %
-                                  (time.ticks_diff(time.ticks_ms(), start), str(cmd_output[-1])))
-                        if cmd_output[-1].rstrip() == b'OK':
-                            okay = True
-                            break
-                        elif cmd_output[-1].rstrip() == b'FAIL':
-                            raise CommandFailure()
-                    else:
-                        time.sleep_ms(10)
-                    cmd_timeout -= 1
-            if not okay and cmd_timeout == 0 and debug:
+                    print("RX timeout, no echo of the command received!")
+            elif not count:
+                if debug:
+                    print("%8i - RX timeout of answer after sending AT command!" %
+                          (time.ticks_diff(time.ticks_ms(), start)))
+                else:
+                    print("RX timeout of answer after sending AT command!")
+            elif debug:
                 print("%8i - RX-Timeout occured and no 'OK' received!" %
                       (time.ticks_diff(time.ticks_ms(), start)))
-        return cmd_output
+        elif status == b'ERROR':
+            raise CommandError('Command error!')
+        elif status == STATUS_BUSY:
+            raise CommandError('Module busy!')
+        elif status in (b'FAIL', b'SEND FAIL'):
+            raise CommandFailure()
+
+    def _read_response(self, start, timeout=0, debug=False, cmd=None, echo=True):
+        """Read the answer of the module up to the status line and return
+        all lines read. See _response_lines and _send_command."""
+        return list(self._response_lines(start, timeout=timeout, debug=debug,
+                                         cmd=cmd, echo=echo))
 
     @classmethod
-    def _join_args(cls, *args, debug=False):
-        """Joins all given arguments as the ESPCHIP needs them for the
-        argument string in a 'set' type command.
-        Strings must be quoted using '"' and no spaces outside of quoted
-        srrings are allowed."""
-        while type(args[0]) is tuple:
-            if len(args) == 1:
-                args = args[0]
-        if debug:
-            print(args)
-        str_args = []
+    def _put(cls, buf, pos, data):
+        """Copy data into buf at pos and return the position behind it."""
+        end = pos + len(data)
+        if end > len(buf):
+            raise IndexError
+        buf[pos:end] = data
+        return end
+
+    @classmethod
+    def _put_quoted(cls, buf, pos, data):
+        """Copy data quoted and escaped into buf at pos and return the
+        position behind it."""
+        if pos + 2 * len(data) + 2 > len(buf):
+            raise IndexError
+        buf[pos] = 34
+        pos += 1
+        for c in data:
+            # '"', ',' and '\\' are escaped, MicroPython can not look up an
+            # int in bytes
+            if c == 34 or c == 44 or c == 92:
+                buf[pos] = 92
+                pos += 1
+            buf[pos] = c
+            pos += 1
+        buf[pos] = 34
+        return pos + 1
+
+    @classmethod
+    def _put_int(cls, buf, pos, value):
+        """Write the decimal digits of value into buf at pos and return the
+        position behind them."""
+        if value < 0:
+            pos = cls._put(buf, pos, b'-')
+            value = -value
+        end = pos
+        while True:
+            if end >= len(buf):
+                raise IndexError
+            buf[end] = 48 + value % 10
+            end += 1
+            value //= 10
+            if not value:
+                break
+        # the digits were written in reverse order
+        i, j = pos, end - 1
+        while i < j:
+            buf[i], buf[j] = buf[j], buf[i]
+            i += 1
+            j -= 1
+        return end
+
+    @classmethod
+    def _encode_command(cls, buf, cmd, op=b'', args=()):
+        """Encode an AT command into the bytearray buf: the command (see
+        CMDS_*), the operator (b'=' or b'?'), the arguments separated by
+        ',' and '\r\n'. Strings are quoted with '"', '"', ',' and '\\'
+        in them are escaped. bytes are copied as they are, bools become 0
+        or 1 and None is left out. Only str and other types allocate
+        memory. Returns the length of the command and raises an IndexError
+        if buf is too small."""
+        pos = cls._put(buf, 0, cmd)
+        pos = cls._put(buf, pos, op)
+        first = True
         for arg in args:
+            if arg is None:
+                continue
+            if not first:
+                pos = cls._put(buf, pos, b',')
+            first = False
             if type(arg) is str:
-                str_args.append('"' + arg + '"')
-            elif type(arg) is bytes:
-                str_args.append(arg.decode())
-            elif type(arg) is bool:
-                str_args.append(str(int(arg)))
-            elif arg is not None:
-                str_args.append(str(arg))
+                pos = cls._put_quoted(buf, pos, arg.encode())
+            elif type(arg) in (bytes, bytearray, memoryview):
+                pos = cls._put(buf, pos, arg)
+            elif type(arg) in (int, bool):
+                pos = cls._put_int(buf, pos, int(arg))
+            else:
+                pos = cls._put(buf, pos, str(arg).encode())
+        return cls._put(buf, pos, b'\r\n')
+
+    def _encode(self, cmd, op=b'', args=()):
+        """Encode a command into the command buffer and return its
+        length. The buffer grows if the command does not fit."""
+        while True:
+            try:
+                return ESPCHIP._encode_command(self._cmd_buf, cmd, op, args)
+            except IndexError:
+                self._cmd_buf = bytearray(2 * len(self._cmd_buf))
+                self._cmd_mv = memoryview(self._cmd_buf)
+
+    def _write_command(self, cmd, op=b'', args=(), debug=False):
+        """Write a command with the operator op and the arguments args
+        (see _encode_command) to the module and return the time it was
+        sent at in ms."""
+        if self._pending:
+            self._finish_pending(debug=debug)
+        start = time.ticks_ms()
+        if cmd == '' or cmd == b'':
+            raise CommandError("Unknown command %r!" % cmd)
+        if self._passthrough:
+            raise CommandError('Transparent transmission mode is active!')
+
+        # AT commands are finalized with an '\r\n' by the encoder
+        n = self._encode(cmd, op, args)
+        self._last_cmd = cmd
         if debug:
-            print(str_args)
-        return ','.join(str_args).encode()
+            print("%8i - TX: %s" %
+                  (time.ticks_diff(time.ticks_ms(), start), str(bytes(self._cmd_mv[:n]))))
+        self._write_all(self._cmd_mv[:n])
+        return start
+
+    def _finish_pending(self, debug=False):
+        """Read the rest of the answer of an abandoned command, e.g. a
+        scan stopped early."""
+        lines = self._pending
+        self._pending = None
+        try:
+            for _ in lines:
+                if self.metrics is not None:
+                    self.metrics.discard(self._last_cmd)
+        except (CommandError, CommandFailure):
+            pass
+
+    def _send_command(self, cmd, op=b'', args=(), timeout=0, debug=False):
+        """Send a command to the ESPCHIP module over UART and return the
+        output.
+        Reading stops as soon as a status line (see STATUS_LINES) arrives.
+        The module must start to answer within CMD_RESPONSE_TIMEOUT ms. For
+        long running commands (like AP scans) there is an additional grace
+        period of timeout ms (CMD_GRACE_TIMEOUT if not given) to return
+        results over UART. With the echo off it is granted right away, as
+        no echo tells that the module started to answer.
+        Raises an CommandError if an error occurs and an CommandFailure
+        if a command fails to execute."""
+        start = self._write_command(cmd, op, args, debug=debug)
+        try:
+            return self._read_response(start, timeout=timeout, debug=debug)
+        finally:
+            self._dispatch()
+
+    def _readinto_exact(self, mv):
+        """Read exactly len(mv) bytes of raw data from UART into the
+        memoryview mv. Raises a CommandFailure if no data arrives for
+        CMD_RESPONSE_TIMEOUT ms, large frames at low baud rates take
+        longer than that in total."""
+        n = len(mv)
+        got = 0
+        start = time.ticks_ms()
+        while got < n:
+            r = self.uart.readinto(mv[got:]) if self.uart.any() else None
+            if r:
+                got += r
+                self._rx_bytes += r
+                start = time.ticks_ms()
+            elif time.ticks_diff(time.ticks_ms(), start) > CMD_RESPONSE_TIMEOUT:
+                raise CommandFailure('Received only %d of %d bytes!' % (got, n))
+            else:
+                self.uart.wait(1)
+
+    def _read_payload(self, mv, debug=False):
+        """Read payload of the current +IPD frame straight into the
+        memoryview mv. Returns the number of bytes read. Raises a
+        CommandFailure if the payload does not arrive in time."""
+        n = min(len(mv), self._ipd[1])
+        try:
+            self._readinto_exact(mv[:n])
+        except CommandFailure:
+            self._ipd = None
+            raise
+        self._ipd[1] -= n
+        if not self._ipd[1]:
+            self._ipd = None
+        return n
+
+    def _link_buffer(self, link_id):
+        """Return the receive buffer of the link or None if unknown."""
+        if link_id is None:
+            return self._rx
+        link = self._links.get(link_id)
+        return link._rx if link else None
+
+    def _link_connected(self, link_id):
+        if link_id is None:
+            return self._connected
+        link = self._links.get(link_id)
+        return link is not None and link.connected
+
+    def _drain_ipd(self, debug=False):
+        """Move the rest of the current +IPD frame into the receive buffer
+        of its link. Data for unknown links is discarded."""
+        link_id = self._ipd[0]
+        data = bytearray(self._ipd[1])
+        self._read_payload(memoryview(data), debug=debug)
+        rx = self._link_buffer(link_id)
+        if rx is not None:
+            rx += data
+        elif debug:
+            print("Discarding %d bytes for link %s" % (len(data), link_id))
 
     @classmethod
-    def _parse_accesspoint_str(cls, ap_str):
-        """Parse an accesspoint string description into a hashmap
-        containing its parameters. Returns None if string could not be
-        split into 3 or 5 fields."""
-        if type(ap_str) is str:
-            ap_str = ap_str.encode()
-        ap_params = ap_str.split(b',')
-        if len(ap_params) == 5:
-            (enc_mode, ssid, rssi, mac, channel) = ap_params
-            ap = {
-                'encryption_protocol': int(enc_mode),
-                'ssid': ssid,
-                'rssi': int(rssi),
-                'mac': mac,
-                'channel': int(channel)
-            }
-        elif len(ap_params) == 3:
-            (enc_mode, ssid, rssi) = ap_params
-            ap = {
-                'encryption_protocol': int(enc_mode),
-                'ssid': ssid,
-                'rssi': int(rssi),
-            }
+    def _parse_urc(cls, line):
+        """Return the event (see subscribe()) and its argument if the line is
+        an unsolicited result code other than +IPD, otherwise None."""
+        event = line.rstrip()
+        name = URC_LINES.get(event)
+        if name:
+            return name, None
+        for prefix, name in URC_PREFIXES:
+            if event.startswith(prefix):
+                return name, event[len(prefix):]
+        # <link id>,CONNECT or <link id>,CLOSED in multiple connection mode
+        event = event[2:]
+        if line[1:2] == b',' and event in (b'CONNECT', b'CLOSED', b'CONNECT FAIL'):
+            return event.decode().replace(' ', '_'), int(line[:1])
+        return None
+
+    def _handle_urc(self, line, debug=False):
+        """Handle unsolicited result codes like network data, link state
+        changes and WIFI events. They are queued for dispatching by
+        _dispatch(). Returns True if the line was a URC."""
+        if line.startswith(IPD_HEADER):
+            # +IPD,[<link id>,]<len>:<data>
+            header = line[len(IPD_HEADER):-1].split(b',')
+            link_id = int(header[0]) if len(header) > 1 else None
+            self._ipd = [link_id, int(header[-1])]
+            self._urcs.append(('IPD', link_id))
+            return True
+        urc = ESPCHIP._parse_urc(line)
+        if urc is None:
+            return False
+        event, arg = urc
+        if event.startswith('WIFI'):
+            if event != 'WIFI_CONNECTED':
+                self._got_ip = event == 'WIFI_GOT_IP'
+            self._invalidate('accesspoint', 'station_ip')
+        elif event in ('CONNECT', 'CLOSED', 'CONNECT_FAIL'):
+            if arg is None:
+                # single connection mode
+                self._connected = event == 'CONNECT'
+            elif event != 'CONNECT':
+                link = self._links.get(arg)
+                if link:
+                    link.connected = False
+        self._urcs.append(urc)
+        return True
+
+    def batch(self, stop_on_error=True, depth=BATCH_DEPTH):
+        """Return a Batch to send many set type commands in one go:
+            with esp.batch() as batch:
+                esp.set_mode(3)
+                esp.set_autoconnect(False)
+            print(batch.results)
+        See Batch for the details."""
+        return Batch(self, stop_on_error=stop_on_error, depth=depth)
+
+    def enable_metrics(self, enable=True):
+        """Start (or stop) counting calls, latency, bytes and failures per
+        AT command, returns the CommandMetrics (or None)."""
+        self.metrics = CommandMetrics() if enable else None
+        return self.metrics
+
+    def _cached(self, key, fresh, query):
+        """Return the cached value of key, calls query() to read it from the
+        module if it is not cached or fresh is True. Inside of a batch the
+        values of the queued setters are returned."""
+        if not fresh:
+            if self._batch is not None and key in self._batch.cache:
+                return self._batch.cache[key]
+            if key in self._cache:
+                return self._cache[key]
+        self._cache[key] = query()
+        return self._cache[key]
+
+    def _cache_get(self, key):
+        """Return the cached value of key or None, see _cache_set()."""
+        if self._batch is not None and key in self._batch.cache:
+            return self._batch.cache[key]
+        return self._cache.get(key)
+
+    def _cache_set(self, key, value, ret=()):
+        """Cache the value set by a setter. Inside of a batch it is kept
+        apart until the batch ran without errors. ret is the result of the
+        setter, if it is None (no status line) the module may not have
+        the value and key is dropped from the cache instead."""
+        if ret is None:
+            self._invalidate(key)
+        elif self._batch is not None:
+            self._batch.cache[key] = value
         else:
-            ap = None
-        return ap
+            self._cache[key] = value
+
+    def _invalidate(self, *keys):
+        """Drop the given keys from the cache, all if none are given."""
+        if not keys:
+            self._cache.clear()
+        for key in keys:
+            self._cache.pop(key, None)
+        if self._batch is not None:
+            if not keys:
+                self._batch.cache.clear()
+            for key in keys:
+                self._batch.cache.pop(key, None)
+
+    def subscribe(self, event, handler):
+        """Call handler(event, arg) for the given URC event (see URC_LINES
+        and URC_PREFIXES, 'IPD', 'CONNECT_FAIL'). arg is the link ID for
+        network events, the rest of the line for +STA_... events or None.
+        Handlers are called after the running command has finished or by
+        poll(), so they may send commands themselves.
+        Events without a handler are queued in events (the oldest ones are
+        dropped if more than URC_QUEUE_SIZE are waiting)."""
+        self._handlers.setdefault(event, []).append(handler)
+
+    def unsubscribe(self, event, handler):
+        """Remove a handler added by subscribe()."""
+        self._handlers.get(event, []).remove(handler)
+
+    def _dispatch(self):
+        """Pass the URCs received so far to their handlers."""
+        while self._urcs:
+            event, arg = self._urcs.pop(0)
+            handlers = self._handlers.get(event)
+            if handlers:
+                for handler in handlers:
+                    handler(event, arg)
+            else:
+                self.events.append((event, arg))
+                if len(self.events) > URC_QUEUE_SIZE:
+                    self.events.pop(0)
+
+    def recv_into(self, buf, nbytes=0, link_id=None, timeout=None, debug=False):
+        """Read received network data of the connection (or the given link
+        in multiple connection mode) into buf, which may be a bytearray or
+        a memoryview. Up to nbytes (len(buf) if 0) are read straight from
+        UART, received data is never split into lines.
+        Waits up to timeout ms (forever if None) for data to arrive and
+        returns the number of bytes read. 0 is returned once the connection
+        is closed and all data is read. Raises OSError(ETIMEDOUT) if no
+        data arrives in time."""
+        if self._pending:
+            self._finish_pending(debug=debug)
+        mv = memoryview(buf)[:nbytes or len(buf)]
+        rx = self._link_buffer(link_id)
+        if rx:
+            n = min(len(mv), len(rx))
+            mv[:n] = rx[:n]
+            # bytearrays of MicroPython have no slice deletion
+            if link_id is None:
+                self._rx = rx[n:]
+            else:
+                self._links[link_id]._rx = rx[n:]
+            return n
+        start = time.ticks_ms()
+        while True:
+            if self._ipd:
+                if self._ipd[0] == link_id:
+                    return self._read_payload(mv, debug=debug)
+                self._drain_ipd(debug=debug)
+                continue
+            if not self._link_connected(link_id):
+                return 0
+            if self.uart.any():
+                line = self._readline()
+                if line is not None and not self._handle_urc(line, debug=debug) and debug:
+                    print("%8i - Discarding: %s" %
+                          (time.ticks_diff(time.ticks_ms(), start), str(line)))
+            elif timeout is not None and time.ticks_diff(time.ticks_ms(), start) > timeout:
+                raise OSError(110)  # ETIMEDOUT
+            else:
+                self.uart.wait(1)
+
+    def poll(self, timeout=0, debug=False):
+        """Process what the module sends without being asked, like received
+        network data (+IPD), closed links or WIFI events, and dispatch the
+        URCs to their handlers (see subscribe()). Waits up to timeout ms
+        for something to arrive. Returns the number of lines processed.
+        The rest of the answer of an abandoned command is read first."""
+        if self._pending:
+            self._finish_pending(debug=debug)
+        start = time.ticks_ms()
+        count = 0
+        while True:
+            if self.uart.any():
+                line = self._readline()
+                if line is None:
+                    continue
+                count += 1
+                if self._handle_urc(line, debug=debug):
+                    if self._ipd:
+                        self._drain_ipd(debug=debug)
+                elif line != b'\r\n':
+                    if self.metrics is not None:
+                        self.metrics.discard(self._last_cmd)
+                    if debug:
+                        print("%8i - Discarding: %s" %
+                              (time.ticks_diff(time.ticks_ms(), start), str(line)))
+            elif count or time.ticks_diff(time.ticks_ms(), start) > timeout:
+                break
+            else:
+                self.uart.wait(1)
+        self._dispatch()
+        return count
+
+    @classmethod
+    def _decode(cls, data):
+        """Return data as str, the bytes themselves if they are no valid
+        UTF-8."""
+        try:
+            return data.decode()
+        except UnicodeError:
+            return data
+
+    @classmethod
+    def _parse_fields(cls, line, pos, types):
+        """Parse the ',' separated fields of line from pos on in a single
+        pass without splitting the line. types has a character per field:
+        'i' for an integer, 's' for a (quoted or plain) string returned as
+        str, or as bytes if it is no valid UTF-8 (like an SSID in GBK).
+        A quoted string ends at a '"' which is followed by ',' or the
+        end of the line. Fields missing at the end of the line are None.
+        Returns a list of the values or None if a field is malformed."""
+        end = len(line)
+        # MicroPython can not look up an int in bytes
+        while end > pos and (line[end - 1] == 13 or line[end - 1] == 10 or
+                             line[end - 1] == 41):
+            end -= 1
+        values = []
+        for t in types:
+            if pos >= end:
+                values.append(None)
+                continue
+            if t == 'i':
+                negative = line[pos] == 45
+                if negative:
+                    pos += 1
+                start = pos
+                value = 0
+                while pos < end and 48 <= line[pos] <= 57:
+                    value = value * 10 + line[pos] - 48
+                    pos += 1
+                if pos == start:
+                    return None
+                values.append(-value if negative else value)
+            elif line[pos] == 34:
+                start = pos + 1
+                pos = line.find(b'"', start)
+                while 0 <= pos < end - 1 and line[pos + 1] != 44:
+                    pos = line.find(b'"', pos + 1)
+                if pos < 0 or pos >= end:
+                    return None
+                values.append(ESPCHIP._decode(line[start:pos]))
+                pos += 1
+            else:
+                start = pos
+                pos = line.find(b',', pos, end)
+                if pos < 0:
+                    pos = end
+                values.append(ESPCHIP._decode(line[start:pos]))
+            if pos < end:
+                if line[pos] != 44:
+                    return None
+                pos += 1
+        return values
+
+    @classmethod
+    def _parse_int(cls, line, pos):
+        """Parse the integer field of line at pos, None if it is missing.
+        Raises a CommandFailure if it is malformed."""
+        values = ESPCHIP._parse_fields(line, pos, 'i')
+        if values is None:
+            raise CommandFailure('Malformed answer %s!' % line)
+        return values[0]
+
+    @classmethod
+    def _parse_record(cls, record, line, prefix, types):
+        """Parse a line like <prefix><fields> into the record type or
+        return None if it does not start with prefix or is malformed."""
+        if line is None or not line.startswith(prefix):
+            return None
+        values = ESPCHIP._parse_fields(line, len(prefix), types)
+        return record(*values) if values else None
 
     def _query_command(self, cmd, timeout=0, debug=False):
         """Sends a 'query' type command and return the relevant output
-        line, containing the queried parameter."""
-        return self._send_command(cmd + b'?', timeout=timeout, debug=debug)[1].rstrip()
+        line tagged like the command (e.g. +CWMODE:), containing the
+        queried parameter. Other lines are ignored, None is returned if
+        there is no such line (e.g. 'No AP'). Raises a CommandFailure if
+        the answer is incomplete."""
+        lines = ESPCHIP._data_lines(self._send_command(cmd, b'?', timeout=timeout, debug=debug))
+        if lines is None:
+            raise CommandFailure('No answer!')
+        return ESPCHIP._tagged(lines, cmd)
 
     def _set_command(self, cmd, *args, timeout=0, debug=False):
         """Send a 'set' type command and return all lines of the output
         which are not command echo and status codes.
         This type of AT command usually does not return output except
         the echo and 'OK' or 'ERROR'. These are not returned by this
-        method. So usually the result of this method must be an empty list!"""
-        return self._send_command(cmd + b'=' + ESPCHIP._join_args(args, debug=debug), timeout=timeout, debug=debug)[1:-2]
+        method. So usually the result of this method must be an empty list!
+        None is returned if the status code is missing (timeout).
+        Inside of a batch() the command is queued and [] is returned,
+        commands not in BATCH_COMMANDS raise an InvalidParameterError."""
+        if self._batch is not None:
+            if cmd not in BATCH_COMMANDS:
+                raise InvalidParameterError('%s can not be sent inside of a batch!' %
+                                            cmd.decode())
+            self._batch.add(cmd, b'=', args, timeout=timeout)
+            return []
+        return ESPCHIP._data_lines(self._send_command(cmd, b'=', args, timeout=timeout,
+                                                      debug=debug))
 
     def _execute_command(self, cmd, timeout=0, debug=False):
         """Send an 'execute' type command and return all lines of the
-        output which are not command echo and status codes."""
-        return self._send_command(cmd, timeout=timeout, debug=debug)[1:-2]
+        output which are not command echo and status codes, None if the
+        status code is missing (timeout)."""
+        return ESPCHIP._data_lines(self._send_command(cmd, timeout=timeout, debug=debug))
 
     def test(self, debug=False):
         """Test the AT command interface."""
@@ -291,132 +1036,396 @@ class ESPCHIP(object):
         """Read the version."""
         return self._execute_command(CMDS_GENERIC['VERSION_INFO'], debug=debug) is not None
 
+    def set_echo(self, enable, debug=False):
+        """Turn the echo of the commands on or off (ATE1/ATE0). Without the
+        echo the module sends about half the bytes for short commands. An
+        echo turned off is turned off again after reset(). Returns True on
+        success, otherwise the echo is treated as unknown (off)."""
+        self._echo_off = not enable
+        # the module may have the echo off already, do not wait for it
+        self.echo = False
+        ok = self._execute_command(CMDS_GENERIC['ECHO'] + (b'1' if enable else b'0'),
+                                   debug=debug) == []
+        self.echo = bool(enable) and ok
+        return ok
+
     def factory_reset(self, debug=False):
-        return self._execute_command(CMDS_GENERIC['FACTORY_RESET'], debug=debug)[-1] == b'OK'
+        """Restore the factory settings and wait until the rebooted module
+        reports to be ready. Returns False if it does not within
+        BOOT_TIMEOUT ms. The local UART goes back to the baud rate the
+        driver was initialized with, a rate set by negotiate_baud() must
+        be negotiated again by the caller."""
+        self._invalidate()
+        start = time.ticks_ms()
+        ok = self._execute_command(CMDS_GENERIC['FACTORY_RESET'], debug=debug) is not None
+        if (self.baud_rate, self.flow_control) != (self._boot_baud, False):
+            time.sleep_ms(BAUD_SWITCH_TIME)
+            self._set_uart(self._boot_baud)
+        if not ok or not self._wait_ready(start, debug=debug):
+            return False
+        if self._echo_off:
+            try:
+                self.set_echo(False, debug=debug)
+            except (CommandError, CommandFailure):
+                # see reset()
+                pass
+        return True
 
     def uart_cfg_def(self, debug=False):
-        self._execute_command(CMDS_GENERIC['UART_CFG_DEF'], debug=debug)
+        if self._execute_command(CMDS_GENERIC['UART_CFG_DEF'], debug=debug) is not None:
+            # the rate stored by UART_CFG_DEF
+            self._boot_baud = 9600
 
-    def reset(self, debug=False):
-        """Reset the module and read the boot message.
+    def reset(self, debug=False, keep_log=False):
+        """Reset the module and wait until it reports to be ready. Returns
+        False if 'ready' does not arrive within BOOT_TIMEOUT ms. The
+        garbage printed by the boot ROM at its own baud rate is skipped.
+        With keep_log the last BOOT_LOG_SIZE lines of the boot log are kept
+        in boot_log.
+        The module boots at its default baud rate, thus the local UART is
+        switched to it and a rate set by negotiate_baud() or
+        set_flow_control() is set again once the module is ready.
         """
-        boot_log = []
+        if self._batch is not None:
+            self._batch.reset = True
+            return True
+        self._invalidate()
+        rx_mark = self._rx_bytes
+        start = self._write_command(CMDS_GENERIC['RESET'], debug=debug)
+        uart_cfg = (self.baud_rate, self.flow_control)
+        if uart_cfg != (self._boot_baud, False):
+            # let the command leave at the current rate
+            time.sleep_ms(BAUD_SWITCH_TIME)
+            self._set_uart(self._boot_baud)
+        ready = self._wait_ready(start, debug=debug, keep_log=keep_log)
+        if self.metrics is not None:
+            self.metrics.record(CMDS_GENERIC['RESET'], time.ticks_diff(time.ticks_ms(), start),
+                                self._rx_bytes - rx_mark, b'OK' if ready else None)
+        if not ready:
+            return False
+        if uart_cfg != (self._boot_baud, False):
+            self._restore_uart(uart_cfg, debug=debug)
+        if self._echo_off:
+            try:
+                self.set_echo(False, debug=debug)
+            except (CommandError, CommandFailure):
+                # the module is ready nevertheless, the echo is
+                # treated as unknown (see set_echo())
+                pass
+        return True
+
+    def _wait_ready(self, start, debug=False, keep_log=False):
+        """Wait until the rebooting module reports to be ready and forget
+        the state it lost. Returns False if 'ready' does not arrive within
+        BOOT_TIMEOUT ms after start. See reset() for keep_log."""
+        if keep_log:
+            self.boot_log = []
+        while time.ticks_diff(time.ticks_ms(), start) < BOOT_TIMEOUT:
+            if not self.uart.any():
+                self.uart.wait(1)
+                continue
+            line = self._readline()
+            if line is None:
+                continue
+            if debug:
+                print("%8i - RX: %s" %
+                      (time.ticks_diff(time.ticks_ms(), start), str(line)))
+            if keep_log:
+                if len(self.boot_log) == BOOT_LOG_SIZE:
+                    self.boot_log.pop(0)
+                self.boot_log.append(line)
+            # garbage without a line end may precede 'ready'
+            if line.rstrip().endswith(b'ready'):
+                self._reset_state()
+                return True
         if debug:
-            start = time.ticks_ms()
-        self._execute_command(CMDS_GENERIC['RESET'], debug=debug)
-
-        # wait for module to boot and messages appearing on self.uart
-        timeout = 500
-        while not self.uart.any() and timeout > 0:
-            time.sleep_ms(10)
-            timeout -= 1
-        if debug and timeout == 0:
-            print("%8i - RX timeout occured!" %
+            print("%8i - RX timeout occured while waiting for module to boot!" %
                   (time.ticks_diff(time.ticks_ms(), start)))
+        return False
 
-        # wait for messages to finish
-        timeout = 300
-        while timeout > 0:
-            if self.uart.any():
-                boot_log.append(self.uart.readline())
-                if debug:
-                    print("%8i - RX: %s" %
-                          (time.ticks_diff(time.ticks_ms(), start), str(boot_log[-1])))
-            time.sleep_ms(20)
-            timeout -= 1
-        if debug and timeout == 0:
-            print("%8i - RTimeout occured while waiting for module to boot!" %
-                  (time.ticks_diff(time.ticks_ms(), start)))
-        if not boot_log:
-            return False
-        return boot_log[-1].rstrip() == b'ready'
+    def _reset_state(self):
+        """Forget the state of the module lost by a reset."""
+        self._partial = b''
+        self._ipd = None
+        self._connected = False
+        self._got_ip = False
+        self._mux = False
+        self._passthrough = False
+        for link in self._links.values():
+            link.connected = False
+        self._rx = bytearray()
+        self._pending = None
+        self.echo = True
+
+    def _flush(self):
+        """Discard everything received so far."""
+        while self.uart.any():
+            self.uart.read()
+        self._partial = b''
+
+    def _restore_uart(self, uart_cfg, debug=False):
+        """Switch the module from its boot baud rate back to the baud rate
+        and flow control setting uart_cfg. Stays at the boot rate if the
+        module does not answer at uart_cfg."""
+        if not self._switch_baud(*uart_cfg, debug=debug):
+            if not self._switch_baud(self._boot_baud, debug=debug):
+                raise CommandFailure('Module lost while switching back to %d baud!' %
+                                     self._boot_baud)
+
+    def _set_uart(self, baud_rate, flow_control=False):
+        """Reconfigure the local UART."""
+        self.uart.init(baud_rate, flow=UART.RTS | UART.CTS if flow_control else 0)
+        self.baud_rate = baud_rate
+        self.flow_control = flow_control
+        self._flush()
+
+    def _probe(self, debug=False):
+        """Return True if the module answers 'AT' at the current baud
+        rate. The first attempts may fail on garbage left in the buffers."""
+        for _ in range(BAUD_PROBES):
+            try:
+                if self._send_command(CMDS_GENERIC['TEST_AT'], timeout=BAUD_PROBE_TIMEOUT,
+                                      debug=debug)[-1:] == [b'OK\r\n']:
+                    return True
+            except (CommandError, CommandFailure):
+                pass
+            self._flush()
+        return False
+
+    def _switch_baud(self, baud_rate, flow_control=False, debug=False):
+        """Switch the module and the local UART to baud_rate and return
+        True if the module answers at the new rate."""
+        flow = UART_FLOW_RTS_CTS if flow_control else UART_FLOW_NONE
+        try:
+            self._send_command(CMDS_GENERIC['UART_CFG_CUR'], b'=',
+                               (baud_rate, 8, 1, 0, flow), timeout=BAUD_PROBE_TIMEOUT, debug=debug)
+        except (CommandError, CommandFailure):
+            # the answer may be garbled, the probe tells if it worked
+            pass
+        time.sleep_ms(BAUD_SWITCH_TIME)
+        self._set_uart(baud_rate, flow_control)
+        return self._probe(debug=debug)
+
+    def set_flow_control(self, enable=True, debug=False):
+        """Enable or disable RTS/CTS hardware flow control on the module
+        (AT+UART_CUR) and the local UART. Both RTS and CTS must be wired.
+        Returns True if the module answers afterwards, otherwise the
+        previous setting is restored."""
+        current = self.flow_control
+        if self._switch_baud(self.baud_rate, enable, debug=debug):
+            return True
+        if not self._switch_baud(self.baud_rate, current, debug=debug):
+            raise CommandFailure('Module lost while switching flow control!')
+        return False
 
-    def get_mode(self, debug=False):
+    def negotiate_baud(self, rates=BAUD_RATES, flow_control=False, debug=False):
+        """Switch the module and the local UART to the fastest of the given
+        baud rates the link works with (AT+UART_CUR, not stored in flash).
+        If the module does not answer at a rate, both sides go back to the
+        rate used before and the next slower rate is tried. With
+        flow_control RTS/CTS hardware flow control is enabled as well.
+        Returns the baud rate in use afterwards. Raises a CommandFailure
+        if the module is lost while switching back."""
+        current = self.baud_rate
+        current_flow = self.flow_control
+        for rate in rates:
+            if rate < current or (rate == current and flow_control == current_flow):
+                continue
+            if debug:
+                print("Trying %d baud..." % rate)
+            if self._switch_baud(rate, flow_control, debug=debug):
+                return rate
+            if not self._switch_baud(current, current_flow, debug=debug):
+                raise CommandFailure('Module lost while switching back to %d baud!' % current)
+        return self.baud_rate
+
+    @classmethod
+    def _parse_mode(cls, answer):
+        """Parse the answer of a mode query. Raises an UnknownWIFIModeError
+        if the mode is unknown."""
+        if answer is None:
+            raise CommandFailure('No mode in answer!')
+        mode = int(answer.split(b':')[1])
+        if mode in VALID_WIFI_MODES:
+            return mode
+        else:
+            raise UnknownWIFIModeError("Mode '%d' not known!" % mode)
+
+    def get_mode(self, debug=False, fresh=False):
         """Returns the mode the ESP WIFI is in:
             1: station mode
             2: accesspoint mode
             3: accesspoint and station mode
         Check the hashmap WIFI_MODES for a name lookup.
         Raises an UnknownWIFIModeError if the mode was not a valid or
-        unknown.
+        unknown. The mode is cached, fresh=True reads it from the module.
         """
-        mode = int(self._query_command(
-            CMDS_WIFI['MODE'], debug=debug).split(b':')[1])
-        if mode in VALID_WIFI_MODES:
-            return mode
-        else:
-            raise UnknownWIFIModeError("Mode '%d' not known!" % mode)
+        return self._cached('mode', fresh, lambda: ESPCHIP._parse_mode(
+            self._query_command(CMDS_WIFI['MODE'], debug=debug)))
 
     def set_mode(self, mode, debug=False):
         """Set the given WIFI mode.
         Raises UnknownWIFIModeError in case of unknown mode."""
         if mode not in VALID_WIFI_MODES:
             raise UnknownWIFIModeError("Mode '%d' not known!" % mode)
-        return self._set_command(CMDS_WIFI['MODE'], mode, debug=debug)
-
-    def get_accesspoint(self, debug=False):
-        """ Read the SSID of the currently joined access point.
-        The SSID 'No AP' tells us that we are not connected to an access
-        point! """
-        answer = self._query_command(CMDS_WIFI["CONNECT"], debug=debug)
-        # print("AP: " + str(answer))
-        result = None
-        if answer and answer != b'No AP':
-            ret = answer.split(b'+' + CMDS_WIFI['CONNECT'][3:] + b':')[1]
-            r = ret.split(b',')
-            # print(r)
-            if len(r) >= 8:
-                result = {
-                    "ssid": r[0].strip(b'"').decode('utf-8'),
-                    "bssid": r[1].strip(b'"').decode('utf-8'),
-                    "channel": int(r[2]),
-                    "rssi": int(r[3]),
-                    "pciEn": int(r[4]),
-                    "reconnInterval": int(r[5]),
-                    "listenInterval": int(r[6]),
-                    "scanMode": int(r[7]),
-                }
-        return result
+        ret = self._set_command(CMDS_WIFI['MODE'], mode, debug=debug)
+        self._cache_set('mode', mode, ret)
+        return ret
+
+    @classmethod
+    def _parse_accesspoint(cls, answer):
+        """Parse the answer of a query of the joined access point into a
+        JoinedAccessPoint. Returns None if not connected."""
+        if not answer:
+            return None
+        return ESPCHIP._parse_record(JoinedAccessPoint, answer, b'+CWJAP:', 'ssiiiiii')
+
+    def get_accesspoint(self, debug=False, fresh=False):
+        """ Read the currently joined access point (see JoinedAccessPoint).
+        Returns None if the module is not connected to an access point.
+        The result is cached until a WIFI event arrives, fresh=True reads
+        it from the module."""
+        return self._cached('accesspoint', fresh, lambda: ESPCHIP._parse_accesspoint(
+            self._query_command(CMDS_WIFI["CONNECT"], debug=debug)))
 
-    def connect(self, ssid, psk, debug=False):
+    def connect(self, ssid, psk, bssid=None, debug=False):
         """Tries to connect to a WIFI network using the given SSID and
-        pre shared key (PSK). Uses a 20 second timeout for the connect
-        command.
+        pre shared key (PSK). If the BSSID of the access point is given,
+        the module joins it without scanning for the SSID. Uses a 20 second
+        timeout for the connect command.
         """
-        ret = self._set_command(CMDS_WIFI['CONNECT'], ssid,
-                          psk, debug=debug, timeout=20000)
-        if ret and len(ret):
-            return ret[-1] == b'WIFI GOT IP\r\n'
-        else:
+        self._got_ip = False
+        self._invalidate('accesspoint', 'station_ip')
+        self._set_command(CMDS_WIFI['CONNECT'], ssid,
+                          psk, bssid, debug=debug, timeout=CONNECT_TIMEOUT)
+        return self._got_ip
+
+    @classmethod
+    def _load_profile(cls, profile):
+        """Read a connection profile, returns None if there is none."""
+        try:
+            with open(profile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_profile(self, profile, debug=False):
+        """Store SSID, BSSID and channel of the joined access point."""
+        ap = self.get_accesspoint(debug=debug)
+        if not ap:
+            return
+        try:
+            with open(profile, 'w') as f:
+                json.dump({'ssid': ap.ssid, 'bssid': ap.bssid, 'channel': ap.channel}, f)
+        except OSError:
+            pass
+
+    def reconnect(self, ssid, psk, profile=WIFI_PROFILE_FILE, debug=False):
+        """Connect like connect(), but reuse the BSSID of the access point
+        stored in the profile file by the last successful join, which
+        saves the scan for the SSID. If the cached access point is gone a
+        full join follows. The duration of the join is recorded in
+        join_times ('warm' with the cached BSSID, 'cold' otherwise)."""
+        cached = ESPCHIP._load_profile(profile)
+        if cached and cached.get('ssid') == ssid:
+            start = time.ticks_ms()
+            try:
+                if self.connect(ssid, psk, bssid=cached.get('bssid'), debug=debug):
+                    self.join_times['warm'] = time.ticks_diff(time.ticks_ms(), start)
+                    return True
+            except (CommandError, CommandFailure):
+                # ESP-AT 2.x answers a failed join with ERROR
+                if debug:
+                    print("Cached access point %s not found" % cached.get('bssid'))
+        start = time.ticks_ms()
+        if not self.connect(ssid, psk, debug=debug):
             return False
+        self.join_times['cold'] = time.ticks_diff(time.ticks_ms(), start)
+        self._save_profile(profile, debug=debug)
+        return True
 
     def disconnect(self, debug=False):
         """Tries to connect to a WIFI network using the given SSID and
         pre shared key (PSK)."""
+        self._invalidate('accesspoint', 'station_ip')
         return self._execute_command(CMDS_WIFI['DISCONNECT'], debug=debug) == []
 
     @classmethod
-    def _parse_list_ap_results(cls, ap_scan_results):
+    def _parse_scan_line(cls, line, mask=SCAN_MASK_ALL):
+        """Parse a +CWLAP line containing the fields selected by mask into
+        an AccessPoint. Returns None for rubbish lines."""
+        if mask == SCAN_MASK_ALL:
+            return ESPCHIP._parse_record(AccessPoint, line, b'+CWLAP:(', 'isisi')
+        if not line.startswith(b'+CWLAP:('):
+            return None
+        types = ''
+        for i, t in enumerate('isisi'):
+            if mask & (1 << i):
+                types += t
+        values = ESPCHIP._parse_fields(line, len(b'+CWLAP:('), types)
+        if not values:
+            return None
+        fields = [None] * 5
+        n = 0
+        for i in range(5):
+            if mask & (1 << i):
+                fields[i] = values[n]
+                n += 1
+        return AccessPoint(*fields)
+
+    @classmethod
+    def _parse_list_ap_results(cls, ap_scan_results, mask=SCAN_MASK_ALL):
+        """Parse the lines of a scan into a list of AccessPoint records.
+        Rubbish lines returned by the AT command are skipped."""
         aps = []
-        for ap in ap_scan_results:
-            try:
-                ap_str = ap.rstrip().split(
-                    CMDS_WIFI['LIST_APS'][-4:] + b':')[1].decode()[1:-1]
-            except IndexError:
-                # Catching this exception means the line in scan result
-                # was probably rubbish
-                continue
-            # parsing the ap_str may not work because of rubbish strings
-            # returned from the AT command. None is returned in this case.
-            ap = ESPCHIP._parse_accesspoint_str(ap_str)
+        for line in ap_scan_results:
+            ap = ESPCHIP._parse_scan_line(line, mask)
             if ap:
                 aps.append(ap)
         return aps
 
+    def set_scan_options(self, sort_rssi=True, fields=None, debug=False):
+        """Configure the scans (AT+CWLAPOPT): sort_rssi lets the module
+        list the strongest access points first, fields is a list of the
+        AccessPoint fields to report (see SCAN_FIELDS), all if None.
+        Fields not reported are None in the results."""
+        mask = SCAN_MASK_ALL
+        if fields is not None:
+            mask = 0
+            for field in fields:
+                if field not in SCAN_FIELDS:
+                    raise InvalidParameterError("Unknown scan field '%s'!" % field)
+                mask |= SCAN_FIELDS[field]
+        self._set_command(CMDS_WIFI['LIST_APS_OPT'], sort_rssi, mask, debug=debug)
+        self._scan_mask = mask
+
+    def scan(self, *args, stop_ssid=None, timeout=10000, debug=False):
+        """Generator yielding an AccessPoint for every +CWLAP line as soon
+        as it arrives. args may limit the scan like in list_accesspoints().
+        The scan ends after the access point stop_ssid was found, the
+        caller may stop iterating at any time as well. The rest of the
+        answer is then read before the next command is sent."""
+        if args:
+            start = self._write_command(CMDS_WIFI['LIST_APS'], b'=', args, debug=debug)
+        else:
+            start = self._write_command(CMDS_WIFI['LIST_APS'], debug=debug)
+        lines = self._response_lines(start, timeout=timeout, debug=debug)
+        # generators are not finalized on MicroPython, thus the answer is
+        # marked as pending until it was read completely
+        self._pending = lines
+        for line in lines:
+            ap = ESPCHIP._parse_scan_line(line, self._scan_mask)
+            if ap:
+                yield ap
+                if stop_ssid is not None and ap.ssid == stop_ssid:
+                    return
+        self._pending = None
+        self._dispatch()
+
     def list_all_accesspoints(self, timeout=10000, debug=False):
         """ List all available access points.
         """
-        return ESPCHIP._parse_list_ap_results(self._execute_command(CMDS_WIFI['LIST_APS'], timeout=timeout, debug=debug))
+        return list(self.scan(timeout=timeout, debug=debug))
 
     def list_accesspoints(self, *args):
         """List accesspoint matching the parameters given by the
@@ -424,7 +1433,7 @@ class ESPCHIP(object):
         The arguments may be of the types string or integer. Strings can
         describe MAC adddresses or SSIDs while the integers refer to
         channel names."""
-        return ESPCHIP._parse_list_ap_results(self._set_command(CMDS_WIFI['LIST_APS'], args))
+        return list(self.scan(*args))
 
     def set_accesspoint_config(self, ssid, password, channel, encrypt_proto, debug=False):
         """Configure the parameters for the accesspoint mode. The module
@@ -456,34 +1465,37 @@ class ESPCHIP(object):
     def get_accesspoint_config(self, debug=False):
         """ Reads the current access point configuration. The module must
         be in an acces point mode to work.
-        Returns a hashmap containing the access point parameters.
+        Returns an AccessPointConfig record.
         Raises CommandFailure in case of wrong WIFI mode set. """
         if self.get_mode(debug=debug) not in (2, 3):
             raise CommandFailure('WIFI not set to the access point mode!')
         ret = self._query_command(CMDS_WIFI['AP_SET_PARAMS'], debug=debug)
-        (ssid, password, channel, encryption_protocol, max_conn, ssid_hidden) = \
-            ret.split(b':')[1].split(b',')
-        return {
-            'ssid': ssid,
-            'password': password,
-            'channel': int(channel),
-            'encryption_protocol': int(encryption_protocol),
-            'max_conn': int(max_conn),
-            'ssid_hidden': int(ssid_hidden)
-        }
+        return ESPCHIP._parse_record(AccessPointConfig, ret, b'+CWSAP:', 'ssiiii')
 
     def list_stations(self, debug=False):
-        """List IPs of stations which are connected to the access point.
-        ToDo: Parse result and return python list of IPs (as str)."""
-        return self._execute_command(CMDS_WIFI['AP_LIST_STATIONS'], debug=debug)
+        """List the stations which are connected to the access point as
+        Station records."""
+        stations = []
+        for line in self._execute_command(CMDS_WIFI['AP_LIST_STATIONS'], debug=debug) or ():
+            # ESP-AT 2.x tags the lines, 1.x does not
+            prefix = b'+CWLIF:' if line.startswith(b'+CWLIF:') else b''
+            station = ESPCHIP._parse_record(Station, line, prefix, 'ss')
+            if station and station.mac:
+                stations.append(station)
+        return stations
 
-    def get_dhcp_config(self, debug=False):
+    def _query_dhcp_config(self, debug=False):
         ret = self._query_command(CMDS_WIFI['DHCP_CONFIG'], debug=debug)
-        state = int(ret.split(b':')[1])
-        return {
-            "station": True if state & 0x01 else False,
-            "softAP": True if state & 0x02 else False,
-        }
+        state = ESPCHIP._parse_int(ret, len(b'+CWDHCP:')) if ret else None
+        if state is None:
+            raise CommandFailure('No DHCP state in answer!')
+        return DHCPConfig(bool(state & 0x01), bool(state & 0x02))
+
+    def get_dhcp_config(self, debug=False, fresh=False):
+        """Read whether DHCP is enabled for the station and the access
+        point, returns a DHCPConfig record. The result is cached, fresh=True
+        reads it from the module."""
+        return self._cached('dhcp', fresh, lambda: self._query_dhcp_config(debug=debug))
 
     def set_dhcp_config(self, mode, operate, debug=False):
         """Set the DHCP configuration for a specific mode.
@@ -494,67 +1506,217 @@ class ESPCHIP(object):
         Bit0: Station DHCP
         Bit1: SoftAP DHCP
         """
-        return self._set_command(CMDS_WIFI['DHCP_CONFIG'], int(operate), mode, debug=debug)
+        ret = self._set_command(CMDS_WIFI['DHCP_CONFIG'], int(operate), mode, debug=debug)
+        dhcp = self._cache_get('dhcp')
+        if dhcp:
+            self._cache_set('dhcp', DHCPConfig(bool(operate) if mode & 0x01 else dhcp.station,
+                                               bool(operate) if mode & 0x02 else dhcp.softAP),
+                            ret)
+        return ret
+
+    def get_autoconnect(self, debug=False, fresh=False):
+        """Read if the module connects to an access point on startup. The
+        result is cached, fresh=True reads it from the module."""
+        return self._cached('autoconnect', fresh, lambda: ESPCHIP._parse_int(
+            self._query_command(CMDS_WIFI['SET_AUTOCONNECT'], debug=debug) or b'',
+            len(b'+CWAUTOCONN:')) == 1)
 
     def set_autoconnect(self, autoconnect, debug=False):
         """Set if the module should connnect to an access point on
         startup."""
-        return self._set_command(CMDS_WIFI['SET_AUTOCONNECT'], autoconnect, debug=debug)
+        ret = self._set_command(CMDS_WIFI['SET_AUTOCONNECT'], autoconnect, debug=debug)
+        self._cache_set('autoconnect', bool(autoconnect), ret)
+        return ret
 
-    def get_station_ip(self, debug=False):
+    def get_station_ip(self, debug=False, fresh=False):
         """get the IP address of the module in station mode.
         The IP address must be given as a string. No check on the
-        correctness of the IP address is made."""
-        return self._query_command(CMDS_WIFI['SET_STATION_IP'], debug=debug)
+        correctness of the IP address is made. The answer is cached until
+        a WIFI event arrives, fresh=True reads it from the module."""
+        return self._cached('station_ip', fresh, lambda: self._query_command(
+            CMDS_WIFI['SET_STATION_IP'], debug=debug))
 
     def set_station_ip(self, ip_str, debug=False):
         """Set the IP address of the module in station mode.
         The IP address must be given as a string. No check on the
         correctness of the IP address is made."""
+        # a static IP disables DHCP of the station
+        self._invalidate('station_ip', 'dhcp')
         return self._set_command(CMDS_WIFI['SET_STATION_IP'], ip_str, debug=debug)
 
-    def get_accesspoint_ip(self, debug=False):
+    def get_accesspoint_ip(self, debug=False, fresh=False):
         """get the IP address of the module in access point mode.
         The IP address must be given as a string. No check on the
-        correctness of the IP address is made."""
-        return self._query_command(CMDS_WIFI['SET_AP_IP'], debug=debug)
+        correctness of the IP address is made. The answer is cached,
+        fresh=True reads it from the module."""
+        return self._cached('ap_ip', fresh, lambda: self._query_command(
+            CMDS_WIFI['SET_AP_IP'], debug=debug))
 
     def set_accesspoint_ip(self, ip_str, debug=False):
         """Set the IP address of the module in access point mode.
         The IP address must be given as a string. No check on the
         correctness of the IP address is made."""
+        self._invalidate('ap_ip', 'dhcp')
         return self._set_command(CMDS_WIFI['SET_AP_IP'], ip_str, debug=debug)
 
-    def get_connection_status(self):
-        """Get connection information.
-        ToDo: Parse returned data and return python data structure."""
-        return self._execute_command(CMDS_IP['STATUS'])
+    @classmethod
+    def _parse_connection_status(cls, lines):
+        """Parse the answer of AT+CIPSTATUS into a ConnectionStatus."""
+        status = None
+        links = []
+        for line in lines:
+            if line.startswith(b'STATUS:'):
+                status = ESPCHIP._parse_int(line, len(b'STATUS:'))
+            else:
+                link = ESPCHIP._parse_record(Link, line, b'+CIPSTATUS:', 'issiii')
+                if link:
+                    links.append(link)
+        return ConnectionStatus(status, links)
+
+    def get_connection_status(self, debug=False):
+        """Get the connection status and the open links as a
+        ConnectionStatus record. status is 2: got IP, 3: connected,
+        4: disconnected, 5: not connected to an access point."""
+        return ESPCHIP._parse_connection_status(
+            self._execute_command(CMDS_IP['STATUS'], debug=debug) or ())
 
     def start_connection(self, protocol, dest_ip, dest_port, debug=False):
-        """Start a TCP or UDP connection.
-        ToDo: Implement MUX mode. Currently only single connection mode is
-        supported!"""
+        """Start a TCP or UDP connection in single connection mode. Use
+        open_connection() for multiple connection mode. Received data is
+        read with recv_into()."""
+        self._rx = bytearray()
         self._set_command(CMDS_IP['START'], protocol,
                           dest_ip, dest_port, debug=debug)
 
-    def send(self, data, debug=False):
-        """Send data over the current connection."""
-        self._set_command(CMDS_IP['SEND'], len(data), debug=debug)
-        print(b'>' + data)
-        self.uart.write(data)
+    def set_mux_mode(self, enable, debug=False):
+        """Enable or disable the multiple connection mode. This is only
+        possible while no connection is open."""
+        self._set_command(CMDS_IP['SET_MUX_MODE'], bool(enable), debug=debug)
+        self._mux = bool(enable)
+
+    def open_connection(self, protocol, dest_ip, dest_port, debug=False):
+        """Start a TCP or UDP connection in multiple connection mode, which
+        is enabled if necessary. Returns an ATSocket for the link.
+        The ID of a link closed by the peer is only reused once its socket
+        was closed, which keeps the data received on it. Raises
+        CommandFailure if all link IDs are in use."""
+        if not self._mux:
+            self.set_mux_mode(True, debug=debug)
+        for link_id in MUX_LINK_IDS:
+            if link_id not in self._links:
+                break
+        else:
+            raise CommandFailure('No free link ID!')
+        self._set_command(CMDS_IP['START'], link_id, protocol,
+                          dest_ip, dest_port, debug=debug)
+        sock = ATSocket(self, link_id)
+        self._links[link_id] = sock
+        return sock
+
+    def close_connection(self, link_id=None, debug=False):
+        """Close the connection or the given link in multiple connection
+        mode."""
+        if link_id is None:
+            self._execute_command(CMDS_IP['CLOSE'], debug=debug)
+        else:
+            self._set_command(CMDS_IP['CLOSE'], link_id, debug=debug)
+            link = self._links.pop(link_id, None)
+            if link:
+                link.connected = False
+
+    def _wait_prompt(self, debug=False):
+        """Wait for the '>' the module prompts for data with. Only a '>' at
+        the start of a line is the prompt: the lines arriving before it are
+        read as a whole, so network data of other links (+IPD) is buffered
+        and a '>' in it is not taken for the prompt."""
+        if self._pending:
+            self._finish_pending(debug=debug)
+        start = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), start) <= CMD_RESPONSE_TIMEOUT:
+            if not self.uart.any():
+                self.uart.wait(1)
+                continue
+            if not self._partial and self.uart.peek() == 62:
+                self.uart.read(1)
+                return
+            line = self._readline()
+            if line is None:
+                continue
+            if self._handle_urc(line, debug=debug):
+                if self._ipd:
+                    self._drain_ipd(debug=debug)
+            elif line != b'\r\n':
+                if self.metrics is not None:
+                    self.metrics.discard(self._last_cmd)
+                if debug:
+                    print("%8i - Discarding: %s" %
+                          (time.ticks_diff(time.ticks_ms(), start), str(line)))
+        raise CommandFailure('No prompt for data received!')
+
+    def send(self, data, link_id=None, debug=False):
+        """Send data over the current connection or the given link in
+        multiple connection mode."""
+        if type(data) is str:
+            data = data.encode()
+        self._set_command(CMDS_IP['SEND'], link_id, len(data), debug=debug)
+        self._wait_prompt(debug=debug)
+        self._write_all(data)
+        self._read_response(time.ticks_ms(), debug=debug, echo=False)
+
+    def _write_all(self, data):
+        """Write all of data to UART, which may accept only a part of it
+        per write() call (see esp_at_transport). The bytes are counted for
+        the last command written."""
+        mv = memoryview(data)
+        while mv:
+            n = self.uart.write(mv)
+            if n:
+                mv = mv[n:]
+                if self.metrics is not None:
+                    self.metrics.sent(self._last_cmd, n)
+            else:
+                time.sleep_ms(1)
+
+    def start_passthrough(self, debug=False):
+        """Enter the transparent transmission mode on the connection of the
+        single connection mode (see start_connection()), which avoids the
+        AT+CIPSEND round trip per packet. Returns a PassthroughStream to
+        write data to and to read received data from. No AT commands can
+        be sent until stop_passthrough() is called."""
+        if self._mux:
+            raise CommandFailure('Transparent transmission needs single connection mode!')
+        self._set_command(CMDS_IP['SET_TX_MODE'], 1, debug=debug)
+        self._execute_command(CMDS_IP['SEND'], debug=debug)
+        self._wait_prompt(debug=debug)
+        self._passthrough = True
+        return PassthroughStream(self)
+
+    def stop_passthrough(self, debug=False):
+        """Leave the transparent transmission mode using the '+++' escape
+        sequence and switch back to the normal transmission mode."""
+        time.sleep_ms(PASSTHROUGH_GUARD_TIME)
+        self._write_all(b'+++')
+        time.sleep_ms(PASSTHROUGH_EXIT_TIME)
+        self._passthrough = False
+        self._set_command(CMDS_IP['SET_TX_MODE'], 0, debug=debug)
 
     def ping(self, destination, debug=False):
         """Ping the destination address or hostname."""
         return self._set_command(CMDS_IP['PING'], destination, debug=debug)
 
-    def http_request(self, url, data=None, headers=[], method="GET", contentType="application/x-www-form-urlencoded", debug=False):
-        """Connect to a webpage URL and download html content.
-        """
+    @classmethod
+    def _check_http(cls, method, contentType):
         if method not in HTTP_METHODS:
             raise InvalidParameterError('Unknown http method')
         if contentType not in CONTENT_TYPES:
             raise InvalidParameterError('Unknown content Type')
 
+    @classmethod
+    def _http_args(cls, url, data, method, contentType, headers=()):
+        """Return the arguments of an AT+HTTPCLIENT command. The headers
+        follow the <data> field, which is left empty if there is no data."""
+        ESPCHIP._check_http(method, contentType)
+
         try:
             proto, dummy, host, path = url.split("/", 3)
         except ValueError:
@@ -574,30 +1736,370 @@ class ESPCHIP(object):
             host, port = host.split(":", 1)
             port = int(port)
 
-        res = self._set_command(CMDS_HTTP['HTTP_CLIENT'],
-                        HTTP_METHODS[method],
-                        CONTENT_TYPES[contentType],
-                        url,
-                        host,
-                        path,
-                        transportType,
-                        data,
-                        # TODO: multiple headers
-                        debug=debug)
-        # print(res)
-        l = 0
-        rdata = b''
-        magic = b'+' + CMDS_HTTP['HTTP_CLIENT'][3:] + b':'
-        if res and len(res):
-            for line in res:
-                if line.startswith(magic):
-                    x = line.split(magic)
-                    if len(x) > 1:
-                        _pos = x[1].find(b',')
-                        l += int(x[1][0 : _pos])
-                        rdata += x[1][_pos+1:]
-                else:
-                    rdata += line
-                    if len(rdata) > l:
-                        rdata = rdata[:l] # ignore the last \r\n
-        return {"size": l, "data": rdata }
+        headers = ESPCHIP._http_headers(headers)
+        if data is None and headers:
+            # None is left out by the encoder, the module would take the
+            # first header for the data
+            data = b''
+        return (HTTP_METHODS[method],
+                CONTENT_TYPES[contentType],
+                url,
+                host,
+                path,
+                transportType,
+                data) + headers
+
+    @classmethod
+    def _http_headers(cls, headers):
+        """Return the headers as a tuple of str."""
+        return tuple(h.decode() if type(h) is not str else h for h in headers)
+
+    def _http_post(self, url, data, headers, contentType, timeout=0, debug=False):
+        """Send a POST request using AT+HTTPCPOST, which streams the body
+        after the '>' prompt instead of putting it into the command line.
+        data may be a bytes like object, a str or a list of them, which
+        is sent as one body without joining it first. Returns the
+        generator of the answer lines, which end with 'SEND OK' and
+        contain no response body."""
+        parts = data if type(data) in (list, tuple) else (data,)
+        parts = [p.encode() if type(p) is str else p for p in parts]
+        headers = ESPCHIP._http_headers(headers)
+        for header in headers:
+            if header.lower().startswith('content-type:'):
+                break
+        else:
+            headers += ('Content-Type: ' + contentType,)
+        length = 0
+        for part in parts:
+            length += len(part)
+        self._set_command(CMDS_HTTP['HTTP_POST'], url, length, len(headers),
+                          *headers, debug=debug)
+        self._wait_prompt(debug=debug)
+        for part in parts:
+            self._write_all(part)
+        return self._response_lines(time.ticks_ms(), timeout=timeout, debug=debug, echo=False)
+
+    def http_request_stream(self, url, data=None, headers=[], method="GET", contentType="application/x-www-form-urlencoded", buf=None, timeout=0, stream_body=False, debug=False):
+        """Generator streaming the body of a HTTP request. Each
+        +HTTPCLIENT:<len>, chunk is read straight into buf (a bytearray of
+        HTTP_CHUNK_SIZE bytes if None) and yielded as a memoryview slice
+        of it, which is only valid until the next chunk is requested.
+        E.g. to save a download:
+            for chunk in esp.http_request_stream(url):
+                f.write(chunk)
+        headers is a list of header lines like 'Accept: text/plain'.
+        With stream_body a POST request is sent with AT+HTTPCPOST (see
+        _http_post()), so the body is not limited by the length of an AT
+        command line. The module answers it with 'SEND OK' only, the
+        response body of the server is dropped and nothing is yielded.
+        The module must answer within timeout ms (see _send_command), the
+        deadline is extended as long as data arrives. Raises a
+        CommandFailure if the answer ends without a status line, i.e. the
+        body is incomplete.
+        """
+        if stream_body and method == "POST" and data is not None:
+            ESPCHIP._check_http(method, contentType)
+            lines = self._http_post(url, data, headers, contentType,
+                                    timeout=timeout, debug=debug)
+        else:
+            args = ESPCHIP._http_args(url, data, method, contentType, headers)
+            start = self._write_command(CMDS_HTTP['HTTP_CLIENT'], b'=', args,
+                                        debug=debug)
+            lines = self._response_lines(start, timeout=timeout, debug=debug)
+        if buf is None:
+            buf = bytearray(HTTP_CHUNK_SIZE)
+        chunks = self._http_chunks(lines, memoryview(buf))
+        # marked as pending like the answer of scan(), so the rest of the
+        # body is read if the caller stops early
+        self._pending = chunks
+        for chunk in chunks:
+            yield chunk
+        self._pending = None
+        self._dispatch()
+
+    def _http_chunks(self, lines, mv):
+        """Generator reading the +HTTPCLIENT chunks of the answer lines
+        into the memoryview mv, see http_request_stream()."""
+        line = None
+        for line in lines:
+            if line.startswith(HTTP_HEADER):
+                size = int(line[len(HTTP_HEADER):-1])
+                while size:
+                    n = min(size, len(mv))
+                    self._readinto_exact(mv[:n])
+                    size -= n
+                    yield mv[:n]
+        if line is None or ESPCHIP._status(line) is None:
+            raise CommandFailure('Incomplete HTTP response!')
+
+    def http_request(self, url, data=None, headers=[], method="GET", contentType="application/x-www-form-urlencoded", timeout=0, stream_body=False, debug=False):
+        """Connect to a webpage URL and download html content. The whole
+        body is kept in memory, use http_request_stream() for large
+        responses. See http_request_stream() for timeout and stream_body,
+        which returns an empty body.
+        """
+        chunks = [bytes(chunk) for chunk in self.http_request_stream(
+            url, data, headers, method, contentType, timeout=timeout,
+            stream_body=stream_body, debug=debug)]
+        rdata = b''.join(chunks)
+        return {"size": len(rdata), "data": rdata }
+
+class CommandMetrics(object):
+    """Counters per AT command (see CMDS_*): the fields of METRIC_FIELDS
+    kept in a list of ints per command, so counting does not allocate
+    after the first call of a command. Latencies are in ms, lines the
+    driver discarded unread are counted for the last command sent."""
+
+    def __init__(self):
+        self.commands = {}
+
+    def _counters(self, cmd):
+        counters = self.commands.get(cmd)
+        if counters is None:
+            counters = self.commands[cmd] = [0] * len(METRIC_FIELDS)
+        return counters
+
+    def sent(self, cmd, tx):
+        """Count bytes written for the command (or its data)."""
+        self._counters(cmd)[4] += tx
+
+    def record(self, cmd, ms, rx, status):
+        """Count an answered (or timed out) command."""
+        c = self._counters(cmd)
+        if not c[0] or ms < c[2]:
+            c[2] = ms
+        c[0] += 1
+        c[1] += ms
+        if ms > c[3]:
+            c[3] = ms
+        c[5] += rx
+        if status is None:
+            c[6] += 1
+        elif status == b'ERROR' or status == STATUS_BUSY:
+            c[7] += 1
+        elif status == b'FAIL' or status == b'SEND FAIL':
+            c[8] += 1
+
+    def discard(self, cmd, lines=1):
+        """Count lines which were discarded."""
+        self._counters(cmd)[9] += lines
+
+    def clear(self):
+        for counters in self.commands.values():
+            for i in range(len(counters)):
+                counters[i] = 0
+
+    def dump(self, clear=False):
+        """Return the counters as a dict of dicts by command name, with the
+        average latency added as 'avg_ms'. clear starts a new period."""
+        result = {}
+        for cmd, counters in self.commands.items():
+            if not counters[0] and not counters[4] and not counters[9]:
+                continue
+            entry = {}
+            for i, field in enumerate(METRIC_FIELDS):
+                entry[field] = counters[i]
+            entry['avg_ms'] = counters[1] / counters[0] if counters[0] else 0
+            result[cmd.decode() if cmd else '?'] = entry
+        if clear:
+            self.clear()
+        return result
+
+
+class Batch(object):
+    """Set type commands queued to be sent to the module back to back.
+    Inside of a with block the configuration setters (see BATCH_COMMANDS)
+    are queued and reset() is deferred to a single reset after the
+    commands. Queries are still sent right away and return the values of
+    the queued setters, which are cached once the batch ran without
+    errors. Other set type commands (connect(), open_connection(), ...)
+    raise an InvalidParameterError. Up to depth commands are written before
+    their answers are read, which are matched to the commands in order.
+    Commands answered with 'busy p...' are sent again, see run().
+    If stop_on_error is set, no further commands are written after a
+    command failed; commands already written are completed."""
+
+    def __init__(self, esp, stop_on_error=True, depth=BATCH_DEPTH):
+        self._esp = esp
+        self.stop_on_error = stop_on_error
+        self.depth = max(depth, 1)
+        # (command, operator, arguments, timeout) of the queued commands
+        self.commands = []
+        # values cached by the queued setters, see ESPCHIP._cache_set()
+        self.cache = {}
+        self.reset = False
+        self.results = []
+
+    def add(self, cmd, op=b'', args=(), timeout=0):
+        """Queue a command, see ESPCHIP._encode_command."""
+        self.commands.append((cmd, op, args, timeout))
+
+    def __enter__(self):
+        self._esp._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._esp._batch = None
+        if exc_type is None:
+            self.run()
+
+    def _read(self, cmd, timeout, debug=False):
+        """Read the answer of the next command written. Returns None if the
+        module was busy."""
+        esp = self._esp
+        lines = []
+        try:
+            for line in esp._response_lines(time.ticks_ms(), timeout=timeout,
+                                            debug=debug, cmd=cmd):
+                lines.append(line)
+        except (CommandError, CommandFailure) as e:
+            if lines and ESPCHIP._status(lines[-1]) == STATUS_BUSY:
+                return None
+            return BatchResult(cmd, None, e)
+        if not lines or ESPCHIP._status(lines[-1]) is None:
+            return BatchResult(cmd, None, CommandFailure('No answer!'))
+        return BatchResult(cmd, lines[:-1], None)
+
+    def run(self, debug=False):
+        """Send the queued commands and the deferred reset and return the
+        list of BatchResults, which is kept in results as well. Commands
+        which were not sent after an error have no result. Commands the
+        module was too busy for are sent again (up to BATCH_RETRIES times)
+        together with the commands written behind them, once all answers
+        have been read, and from then on one at a time, as the module
+        would reject the commands written ahead again."""
+        esp = self._esp
+        commands = self.commands
+        results = [None] * len(commands)
+        retries = [0] * len(commands)
+        # indices of the commands to write and of those written
+        queue = list(range(len(commands)))
+        written = []
+        busy = []
+        failed = False
+        depth = self.depth
+        try:
+            while written or (queue and not failed):
+                while queue and len(written) < depth and not busy and not failed:
+                    i = queue.pop(0)
+                    cmd, op, args, _ = commands[i]
+                    esp._write_command(cmd, op, args, debug=debug)
+                    written.append(i)
+                i = written.pop(0)
+                cmd, _, _, timeout = commands[i]
+                result = self._read(cmd, timeout, debug=debug)
+                if result is None and retries[i] == BATCH_RETRIES:
+                    result = BatchResult(cmd, None, CommandError('Module busy!'))
+                elif result is None or busy:
+                    # commands written behind a busy one are sent again as
+                    # well, so the setters take effect in their order
+                    if result is None:
+                        retries[i] += 1
+                    busy.append(i)
+                    result = None
+                if result is not None:
+                    results[i] = result
+                    if result.error:
+                        failed = self.stop_on_error
+                        # the cached values of the setters are not reliable
+                        esp._invalidate()
+                        self.cache.clear()
+                if busy and not written:
+                    # send them again in their order
+                    queue = busy + queue
+                    busy = []
+                    depth = 1
+            results = [r for r in results if r is not None]
+            esp._cache.update(self.cache)
+            if self.reset and not failed:
+                ok = esp.reset(debug=debug)
+                results.append(BatchResult(CMDS_GENERIC['RESET'], [],
+                                           None if ok else CommandFailure('Reset failed!')))
+        finally:
+            esp._dispatch()
+        self.commands = []
+        self.cache = {}
+        self.reset = False
+        self.results = results
+        return results
+
+
+class ATSocket(object):
+    """Socket like object of a link in multiple connection mode. Received
+    data is read straight into the buffer given to recv_into(), data
+    arriving while other work is done is buffered per link."""
+
+    def __init__(self, esp, link_id):
+        self._esp = esp
+        self.link_id = link_id
+        self.connected = True
+        self._timeout = None
+        self._rx = bytearray()
+
+    def settimeout(self, value):
+        """Set the timeout of recv() in seconds. None blocks forever."""
+        self._timeout = value
+
+    def _registered(self):
+        """Return True if the link ID still belongs to this socket."""
+        return self._esp._links.get(self.link_id) is self
+
+    def send(self, data):
+        if not self.connected or not self._registered():
+            raise OSError(107)  # ENOTCONN
+        self._esp.send(data, link_id=self.link_id)
+        return len(data)
+
+    def _timeout_ms(self):
+        return None if self._timeout is None else int(self._timeout * 1000)
+
+    def recv_into(self, buf, nbytes=0):
+        """Read up to nbytes (len(buf) if 0) received bytes into buf and
+        return their number. See ESPCHIP.recv_into(). 0 is returned once
+        the socket was closed."""
+        if not self._registered():
+            return 0
+        return self._esp.recv_into(buf, nbytes, link_id=self.link_id,
+                                   timeout=self._timeout_ms())
+
+    def recv(self, bufsize):
+        """Return up to bufsize received bytes. Returns b'' once the link
+        is closed and all data is read. Raises OSError(ETIMEDOUT) if
+        nothing arrives within the timeout."""
+        buf = bytearray(bufsize)
+        n = self.recv_into(buf)
+        return bytes(buf[:n])
+
+    def close(self):
+        if self.connected:
+            self._esp.close_connection(self.link_id)
+        elif self._esp._links.get(self.link_id) is self:
+            del self._esp._links[self.link_id]
+        self.connected = False
+
+
+class PassthroughStream(object):
+    """Byte stream over the connection in transparent transmission mode.
+    Created by ESPCHIP.start_passthrough()."""
+
+    def __init__(self, esp):
+        self._esp = esp
+        self.sent = 0
+
+    def write(self, data):
+        """Write data in chunks the module is able to buffer."""
+        mv = memoryview(data)
+        for i in range(0, len(mv), PASSTHROUGH_CHUNK):
+            self._esp._write_all(mv[i:i + PASSTHROUGH_CHUNK])
+        self.sent += len(mv)
+        return len(mv)
+
+    def readinto(self, buf, nbytes=0):
+        """Read received data into buf without waiting. Returns the number
+        of bytes read."""
+        mv = memoryview(buf)[:nbytes or len(buf)]
+        return self._esp.uart.readinto(mv) or 0
+
+    def stop(self):
+        """Leave the transparent transmission mode."""
+        self._esp.stop_passthrough()
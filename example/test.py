@@ -65,7 +65,7 @@ else:
 
 print('Checking if connected WLAN %s' % (TEST_AP_SSID))
 ret = esp.get_accesspoint()
-if ret and ret.get('ssid') == TEST_AP_SSID:
+if ret and ret.ssid == TEST_AP_SSID:
     print('Success!')
 else:
     print('Failed!')
@@ -92,8 +92,8 @@ print('Scanning for WLANs...')
 wlans = esp.list_all_accesspoints(timeout=20000, debug=False)
 print(wlans)
 # for wlan in wlans:
-#     print("Scanning for WLAN '%s'..." % (wlan['ssid']))
-#     for wlan2 in esp.list_accesspoints(wlan['ssid']):
+#     print("Scanning for WLAN '%s'..." % (wlan.ssid))
+#     for wlan2 in esp.list_accesspoints(wlan.ssid):
 #         print(wlan2)
 
 print('Setting AP + Station mode...')
@@ -112,14 +112,14 @@ dhcpCfg = esp.get_dhcp_config()
 print(dhcpCfg)
 
 print('Checking DHCP client and server settings...')
-if not dhcpCfg["station"]:
+if not dhcpCfg.station:
     print('    Enable Station DHCP...')
     esp.set_dhcp_config(1, True)
 else:
     print('    Disable Station DHCP & Setting static IP...')
     esp.set_station_ip('192.168.0.10')
     esp.set_dhcp_config(1, False)
-if not dhcpCfg["softAP"]:
+if not dhcpCfg.softAP:
     print('    Enable SoftAP DHCP...')
     esp.set_dhcp_config(2, True)
 else:
@@ -0,0 +1,53 @@
+"""
+Run the asyncio front end against the simulated modem. Several coroutines
+send commands concurrently while a ticker keeps running, which shows that
+waiting for the module does not block the event loop and that commands
+do not interleave on the wire.
+
+Run from the repository root with:
+
+    python3 host/async_demo.py
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import asyncio
+from esp_at_sim import ESPATModem
+from sim_server import serve
+from esp_at_async import AsyncESPCHIP
+
+
+async def main():
+    modem = ESPATModem(latency_ms=20)
+    modem.pages[b'http://example.com/'] = b'<html>hello</html>'
+    server = await serve(modem)
+    port = server.sockets[0].getsockname()[1]
+    esp = AsyncESPCHIP(*await asyncio.open_connection('127.0.0.1', port))
+
+    ticks = 0
+    done = False
+
+    async def ticker():
+        nonlocal ticks
+        while not done:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    tick_task = asyncio.ensure_future(ticker())
+    results = await asyncio.gather(
+        esp.test(), esp.get_mode(), esp.set_mode(3), esp.get_mode(),
+        esp.http_request('http://example.com/'), esp.version())
+    done = True
+    await tick_task
+    for result in results:
+        print(result)
+    print('%d commands, %d ticks while waiting' % (len(modem.commands), ticks))
+    await esp.close()
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Loopback benchmark of the AT command round trip against the simulated
+modem. Compares the fixed 100 x 10 ms polling loop the driver used to have
+with the current response reader, which returns on the status line.
+
+Run from the repository root with:
+
+    python3 host/bench_commands.py [--count N] [--baud BAUD] [--latency MS]
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import utime as time
+import machine
+from esp_at_sim import ESPATModem
+import esp_at_uart
+
+
+class LegacyESPCHIP(esp_at_uart.ESPCHIP):
+    """ESPCHIP with the former polling loop, which always waited one second
+    for the answer of a command."""
+
+    def _send_command(self, cmd, op=b'', args=(), timeout=0, debug=False):
+        cmd_output = []
+        self.uart.write(self._cmd_mv[:self._encode(cmd, op, args)])
+        cmd_timeout = 100
+        while cmd_timeout > 0:
+            if self.uart.any():
+                cmd_output.append(self.uart.readline())
+            else:
+                time.sleep_ms(10)
+            cmd_timeout -= 1
+        while self.uart.any():
+            cmd_output.append(self.uart.readline())
+        return cmd_output
+
+
+def run(cls, calls, count, baud, latency):
+    machine.attach(1, ESPATModem(baudrate=baud, latency_ms=latency))
+    esp = cls(1, baud)
+    results = {}
+    for name, kwargs in calls:
+        method = getattr(esp, name)
+        start = time.ticks_ms()
+        for _ in range(count):
+            method(**kwargs)
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        results[name] = count * 1000 / max(elapsed, 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=5)
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--latency', type=int, default=5,
+                        help='modem processing latency in ms')
+    args = parser.parse_args()
+
+    # fresh=True: time the round trip, not the cache of the driver
+    calls = (('test', {}), ('get_mode', {'fresh': True}))
+    before = run(LegacyESPCHIP, calls, args.count, args.baud, args.latency)
+    after = run(esp_at_uart.ESPCHIP, calls, args.count, args.baud, args.latency)
+    print('%-10s %12s %12s' % ('command', 'before/s', 'after/s'))
+    for name, _ in calls:
+        print('%-10s %12.1f %12.1f' % (name, before[name], after[name]))
+
+
+if __name__ == '__main__':
+    main()
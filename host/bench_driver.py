@@ -0,0 +1,333 @@
+"""
+Benchmark of the ESPCHIP entry points against the simulated modem. Every
+call is timed at each of the given baud rates; the report lists latency
+percentiles, the bytes per second received from the modem, the bytes the
+receive buffer of the host lost and the peak memory allocated during a
+call.
+
+Run from the repository root with:
+
+    python3 host/bench_driver.py [--count N] [--baud 9600,115200,921600]
+                                 [--calls test,get_mode,...]
+                                 [--transport uart|pty|tcp] [--echo-off]
+                                 [--rxbuf BYTES] [--flow-control]
+                                 [--tls-ms MS] [--json results.json]
+                                 [--metrics] [--profile]
+
+Features are compared by their calls (e.g. send against passthrough,
+scan against list_all_accesspoints, provision against provision_batch,
+http_client against http_client_close) or by two runs with and without an
+option; compare the JSON output of two runs to catch regressions.
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import asyncio
+import gc
+import json
+import tempfile
+import threading
+import utime as time
+import machine
+import esp_at_uart
+from esp_at_http import HTTPClient
+from esp_at_sim import AccessPoint, HTTPServer
+from run import modem, TEST_AP_SSID, TEST_AP_PASS
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BAUD_RATES = (9600, 115200, 921600)
+
+# size of the HTTP body fetched by http_request
+HTTP_BODY_SIZE = 8192
+# resource polled by the keep-alive HTTP client
+API_URL = 'https://api.example.com/api'
+API_BODY = b'{"temperature": 21.5, "humidity": 40}\n' * 8
+# peer of the connection data is sent to, packets sent per call
+PEER = ('192.168.0.2', 5000)
+PACKETS = 10
+PACKET = b'x' * 64
+# access point a scan stops at, in the middle of the list
+SCAN_TARGET = 'Bench_AP_08'
+# time (ms) the driver does not read the UART while a scan arrives
+BUSY_MS = 100
+
+
+def bench_modem(baud, latency, delay, tls_ms):
+    """Return the simulated modem for a benchmark run."""
+    esp = modem(baud, latency)
+    esp.scan_ms = esp.join_ms = esp.join_scan_ms = delay
+    for i in range(17):
+        esp.aps.append(AccessPoint('Bench_AP_%02d' % i, 'secret',
+                                   bssid='aa:bb:cc:dd:ef:%02x' % i,
+                                   channel=1 + i % 13, rssi=-40 - 3 * i))
+    esp.pages[b'http://bench/body'] = bytes(i & 0x7f for i in range(HTTP_BODY_SIZE))
+    # the peer swallows everything
+    esp.peers[(PEER[0].encode(), PEER[1])] = lambda data: None
+    esp.peers[(b'api.example.com', 443)] = HTTPServer({b'/api': API_BODY}, chunk=128)
+    esp.connect_ms[b'SSL'] = tls_ms
+    return esp
+
+
+def provision(esp):
+    esp.set_mode(esp_at_uart.WIFI_MODES['SOFTAP_STATION'])
+    esp.set_dhcp_config(1, False)
+    esp.set_station_ip('192.168.0.10')
+    esp.set_accesspoint_ip('192.168.4.1')
+    esp.set_autoconnect(True)
+    esp.set_accesspoint_config('PicoAP', 'picopico', 6, 3)
+    esp.set_dhcp_config(2, True)
+
+
+def provision_batch(esp):
+    with esp.batch() as batch:
+        provision(esp)
+    assert not [r for r in batch.results if r.error]
+
+
+def send(esp):
+    for _ in range(PACKETS):
+        esp.send(PACKET)
+
+
+def passthrough(esp):
+    for _ in range(PACKETS):
+        esp.bench_stream.write(PACKET)
+
+
+def start_passthrough(esp):
+    esp.start_connection('TCP', *PEER)
+    esp.bench_stream = esp.start_passthrough()
+
+
+def stop_passthrough(esp):
+    esp.bench_stream.stop()
+    esp.close_connection()
+
+
+def scan_while_busy(esp):
+    """List the access points while the driver is busy with something
+    else as the answer arrives."""
+    start = esp._write_command(esp_at_uart.CMDS_WIFI['LIST_APS'])
+    time.sleep_ms(BUSY_MS)
+    return esp._parse_list_ap_results(esp._read_response(start)[:-1])
+
+
+def http_client(esp, keep_alive=True):
+    """GET over the keep-alive HTTP client, which is kept with the
+    driver."""
+    if not hasattr(esp, 'bench_client'):
+        esp.bench_client = HTTPClient(esp)
+    assert esp.bench_client.get(API_URL, keep_alive=keep_alive).data == API_BODY
+
+
+CALLS = (
+    ('test', lambda esp: esp.test()),
+    ('get_mode', lambda esp: esp.get_mode(fresh=True)),
+    ('connect', lambda esp: esp.connect(TEST_AP_SSID, TEST_AP_PASS)),
+    # the first call joins cold, the others with the cached BSSID
+    ('reconnect', lambda esp: esp.reconnect(TEST_AP_SSID, TEST_AP_PASS,
+                                            profile=esp.bench_profile)),
+    ('list_all_accesspoints', lambda esp: esp.list_all_accesspoints()),
+    ('scan', lambda esp: [ap for ap in esp.scan(stop_ssid=SCAN_TARGET)]),
+    ('scan_while_busy', scan_while_busy),
+    ('send', send),
+    ('passthrough', passthrough),
+    ('http_request', lambda esp: esp.http_request('http://bench/body')),
+    ('http_client', http_client),
+    ('http_client_close', lambda esp: http_client(esp, keep_alive=False)),
+    ('provision', provision),
+    ('provision_batch', provision_batch),
+)
+
+
+# untimed (setup, teardown) around each call of the given names
+FIXTURES = {
+    # the rest of a scan stopped early is read by the next command
+    'scan': (None, lambda esp: esp.test()),
+    'send': (lambda esp: esp.start_connection('TCP', *PEER),
+             lambda esp: esp.close_connection()),
+    'passthrough': (start_passthrough, stop_passthrough),
+}
+
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of the sorted values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class PeakAlloc(object):
+    """Peak memory allocated while the block runs, measured with tracemalloc
+    on CPython and gc.mem_alloc() on the device."""
+
+    def __enter__(self):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            self._start = gc.mem_alloc()
+            gc.disable()
+        return self
+
+    def __exit__(self, *exc):
+        if tracemalloc:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            self.peak = gc.mem_alloc() - self._start
+            gc.enable()
+
+
+def serve_tcp(sim):
+    """Serve the modem over TCP in a background thread, return the port."""
+    from sim_server import serve
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(serve(sim))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+def driver(sim, baud, args):
+    """Return the driver talking to the modem sim over the transport and
+    with the options given by args."""
+    echo = not args.echo_off
+    if args.transport == 'pty':
+        from esp_at_transport import SerialTransport
+        from sim_server import serve_pty
+        return esp_at_uart.ESPCHIP(SerialTransport(serve_pty(sim), baud), baud, echo=echo)
+    if args.transport == 'tcp':
+        from esp_at_transport import SocketTransport
+        return esp_at_uart.ESPCHIP(SocketTransport('127.0.0.1', serve_tcp(sim)), baud,
+                                   echo=echo)
+    machine.attach(1, sim)
+    esp = esp_at_uart.ESPCHIP(1, baud, echo=echo)
+    if args.rxbuf:
+        esp.uart.init(baud, rxbuf=args.rxbuf)
+    return esp
+
+
+def run(baud, calls, args):
+    sim = bench_modem(baud, args.latency, args.delay, args.tls_ms)
+    esp = driver(sim, baud, args)
+    if args.flow_control:
+        esp.set_flow_control()
+    esp.set_mode(esp_at_uart.WIFI_MODES['STATION'])
+    esp.bench_profile = os.path.join(tempfile.mkdtemp(), esp_at_uart.WIFI_PROFILE_FILE)
+    esp.enable_metrics(args.metrics)
+    results = {}
+    for name, call in calls:
+        setup, teardown = FIXTURES.get(name, (None, None))
+        times = []
+        received = 0
+        dropped = sim.dropped
+        for _ in range(args.count):
+            if setup:
+                setup(esp)
+            before = sim.bytes_out
+            start = time.ticks_us()
+            call(esp)
+            times.append(time.ticks_diff(time.ticks_us(), start) / 1000)
+            received += sim.bytes_out - before
+            if teardown:
+                teardown(esp)
+        dropped = sim.dropped - dropped
+        # tracing slows the calls down, measure the allocations separately
+        if setup:
+            setup(esp)
+        with PeakAlloc() as alloc:
+            call(esp)
+        if teardown:
+            teardown(esp)
+        times.sort()
+        results[name] = {
+            'count': args.count,
+            'min_ms': times[0],
+            'p50_ms': percentile(times, 50),
+            'p90_ms': percentile(times, 90),
+            'p99_ms': percentile(times, 99),
+            'max_ms': times[-1],
+            'rx_bytes_per_s': received * 1000 / max(sum(times), 1),
+            'lost_bytes': dropped,
+            'peak_alloc': alloc.peak,
+        }
+    if args.metrics:
+        results['metrics'] = esp.metrics.dump()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--baud', default=','.join(str(b) for b in BAUD_RATES),
+                        help='comma separated baud rates')
+    parser.add_argument('--calls', help='comma separated calls, all if not given')
+    parser.add_argument('--latency', type=int, default=5,
+                        help='modem processing latency in ms')
+    parser.add_argument('--delay', type=int, default=50,
+                        help='time the modem needs to scan or join in ms')
+    parser.add_argument('--tls-ms', type=int, default=200,
+                        help='time of the TLS handshake in ms')
+    parser.add_argument('--transport', choices=('uart', 'pty', 'tcp'), default='uart',
+                        help='machine.UART stand-in, SerialTransport on a PTY or '
+                             'SocketTransport to host/sim_server.py')
+    parser.add_argument('--echo-off', action='store_true',
+                        help='turn the echo of the commands off (ATE0)')
+    parser.add_argument('--rxbuf', type=int,
+                        help='size of the receive buffer of the UART')
+    parser.add_argument('--flow-control', action='store_true',
+                        help='enable RTS/CTS flow control')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--metrics', action='store_true',
+                        help='report the counters per AT command as well')
+    parser.add_argument('--profile', action='store_true',
+                        help='run under cProfile and print where the time is spent')
+    args = parser.parse_args()
+
+    calls = CALLS
+    if args.calls:
+        names = args.calls.split(',')
+        calls = [call for call in CALLS if call[0] in names]
+
+    report = {'count': args.count, 'latency_ms': args.latency,
+              'delay_ms': args.delay, 'tls_ms': args.tls_ms,
+              'transport': args.transport, 'echo': not args.echo_off,
+              'rxbuf': args.rxbuf, 'flow_control': args.flow_control, 'results': {}}
+    if args.profile:
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        for baud in [int(b) for b in args.baud.split(',')]:
+            profile.runcall(run, baud, calls, args)
+        pstats.Stats(profile).sort_stats('tottime').print_stats(15)
+        return
+    print('%-8s %-22s %9s %9s %9s %12s %6s %10s' %
+          ('baud', 'call', 'p50/ms', 'p90/ms', 'max/ms', 'rx bytes/s', 'lost', 'peak'))
+    for baud in [int(b) for b in args.baud.split(',')]:
+        results = run(baud, calls, args)
+        report['results'][str(baud)] = results
+        for name, _ in calls:
+            r = results[name]
+            print('%-8d %-22s %9.1f %9.1f %9.1f %12.0f %6d %10d' %
+                  (baud, name, r['p50_ms'], r['p90_ms'], r['max_ms'],
+                   r['rx_bytes_per_s'], r['lost_bytes'], r['peak_alloc']))
+    if args.metrics:
+        print('\n%-8s %-22s %9s %9s %9s %12s %10s' %
+              ('baud', 'command', 'count', 'avg/ms', 'max/ms', 'rx bytes', 'failed'))
+        for baud, results in report['results'].items():
+            for cmd, m in sorted(results['metrics'].items()):
+                print('%-8s %-22s %9d %9.1f %9d %12d %10d' %
+                      (baud, cmd, m['count'], m['avg_ms'], m['max_ms'], m['rx_bytes'],
+                       m['timeouts'] + m['errors'] + m['failures']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark of uartTimeOut.readline on a long AP scan like burst of lines.
+Compares the former byte-at-a-time reader with the ring buffered one and
+reports the time taken plus the bytes consumed and allocated.
+
+Run from the repository root with:
+
+    python3 host/bench_readline.py [--lines N] [--length BYTES]
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import time
+import machine
+from machine import UART
+from uart_timeout_any import uartTimeOut
+
+
+class Burst(object):
+    """Device which has all of its data received already."""
+
+    def __init__(self, data):
+        self._out = bytearray(data)
+
+    def any(self):
+        return len(self._out)
+
+    def read(self, nbytes=None):
+        if nbytes is None:
+            nbytes = len(self._out)
+        data = bytes(self._out[:nbytes])
+        del self._out[:nbytes]
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        n = min(len(buf) if nbytes is None else nbytes, len(self._out))
+        buf[:n] = self._out[:n]
+        del self._out[:n]
+        return n
+
+    def write(self, data):
+        pass
+
+
+class LegacyUart(UART):
+    """The former readline, which read one byte per call."""
+
+    consumed = 0
+    allocated = 0
+
+    def readline(self, timeOut=100):
+        now = time.monotonic()
+        data = b''
+        while time.monotonic() - now < timeOut / 1000:
+            if self.any():
+                _d = self.read(1)
+                data += _d
+                self.allocated += len(_d) + len(data)
+                if b"\n" in _d:
+                    break
+        self.consumed += len(data)
+        return data
+
+    def stats(self):
+        return {'consumed': self.consumed, 'allocated': self.allocated}
+
+
+def run(cls, data, lines):
+    machine.attach(1, Burst(data))
+    uart = cls(1, 115200)
+    start = time.perf_counter()
+    for _ in range(lines):
+        uart.readline()
+    return time.perf_counter() - start, uart.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=200)
+    parser.add_argument('--length', type=int, default=120)
+    args = parser.parse_args()
+
+    line = b'+CWLAP:(3,"' + b'x' * max(args.length - 40, 1) + \
+        b'",-52,"aa:bb:cc:dd:ee:ff",6)\r\n'
+    data = line * args.lines
+    print('%-8s %10s %10s %12s' % ('reader', 'ms', 'consumed', 'allocated'))
+    for name, cls in (('before', LegacyUart), ('after', uartTimeOut)):
+        elapsed, stats = run(cls, data, args.lines)
+        print('%-8s %10.1f %10d %12d' % (name, elapsed * 1000,
+                                        stats['consumed'], stats['allocated']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,753 @@
+"""
+Simulated ESP AT firmware for running the driver on a host machine.
+
+The modem is a passive object: bytes written by the driver are parsed into
+AT commands and the answers are queued with a configurable latency. Queued
+answers become readable at the pace of the configured baud rate, like on a
+real serial line. Optionally the answers are fragmented into small pieces
+with gaps in between, as a busy UART would deliver them.
+
+The simulated state (access points in range, joined access point, IPs,
+links, HTTP pages, ...) is kept in plain attributes, so scripts can set up
+a scenario and check what the driver did afterwards.
+"""
+import random
+import time
+
+
+def _now_ms():
+    return time.monotonic() * 1000
+
+
+class AccessPoint(object):
+    """An access point in range of the simulated modem."""
+
+    def __init__(self, ssid, password='', bssid='aa:bb:cc:dd:ee:01',
+                 channel=6, rssi=-52, ecn=3):
+        self.ssid = ssid
+        # the SSID on the air, ssid may be bytes in any encoding
+        self.raw_ssid = ssid if isinstance(ssid, bytes) else ssid.encode()
+        self.password = password
+        self.bssid = bssid
+        self.channel = channel
+        self.rssi = rssi
+        self.ecn = ecn
+
+
+class HTTPServer(object):
+    """Peer of the links to a simulated HTTP/1.1 server serving pages
+    (path -> body). Bodies are sent with chunked transfer encoding in
+    pieces of chunk bytes if chunk is set. The server closes the link
+    after answering if the client asks for it or keep_alive is False."""
+
+    def __init__(self, pages, chunk=0, keep_alive=True):
+        self.pages = pages
+        self.chunk = chunk
+        self.keep_alive = keep_alive
+        self.requests = []
+        self._buf = b''
+
+    def __call__(self, data):
+        self._buf += data
+        end = self._buf.find(b'\r\n\r\n')
+        if end < 0:
+            return None
+        head = self._buf[:end].split(b'\r\n')
+        length = 0
+        close = not self.keep_alive
+        for line in head[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+            elif name.strip().lower() == b'connection':
+                close = close or value.strip().lower() == b'close'
+        if len(self._buf) < end + 4 + length:
+            return None
+        self._buf = self._buf[end + 4 + length:]
+        method, path = head[0].split(b' ')[:2]
+        self.requests.append((method, path))
+        body = self.pages.get(path)
+        if body is None:
+            status, body = b'404 Not Found', b'not found'
+        else:
+            status = b'200 OK'
+        headers = [b'HTTP/1.1 ' + status, b'Content-Type: text/plain']
+        if close:
+            headers.append(b'Connection: close')
+        if self.chunk:
+            headers.append(b'Transfer-Encoding: chunked')
+            out = b''
+            for i in range(0, len(body), self.chunk):
+                piece = body[i:i + self.chunk]
+                out += b'%x\r\n' % len(piece) + piece + b'\r\n'
+            body = out + b'0\r\n\r\n'
+        else:
+            headers.append(b'Content-Length: %d' % len(body))
+        return b'\r\n'.join(headers) + b'\r\n\r\n' + body, close
+
+
+class ESPATModem(object):
+
+    # printed by the ROM bootloader at 74880 baud, which looks like garbage
+    # at any other baud rate
+    BOOT_GARBAGE = b'\x00\xf8\xe0\x80\x1c\x8e\xfe\x92\x0e\xc0\x9c\x80'
+    BOOT_LOG = (b'ets Jun  8 2016 00:22:57',
+                b'rst:0xc (SW_CPU_RESET),boot:0x13 (SPI_FAST_FLASH_BOOT)',
+                b'load:0x3fff0030,len:4',
+                b'entry 0x40080634',
+                b'',
+                b'ready')
+    # ends of an answer, the firmware takes commands again once sent
+    STATUS_LINES = (b'OK\r\n', b'ERROR\r\n', b'FAIL\r\n', b'>', b'ready\r\n')
+
+    def __init__(self, baudrate=115200, latency_ms=5, echo=True,
+                 fragment=0, fragment_gap_ms=0, seed=0):
+        """latency_ms is the time the firmware needs to process a command
+        before it starts answering. If fragment is set, answers are split
+        into random pieces of up to fragment bytes, delayed by up to
+        fragment_gap_ms each. seed makes the fragmenting reproducible."""
+        self.baudrate = self.default_baudrate = baudrate
+        self.latency_ms = latency_ms
+        self.echo = echo
+        self.fragment = fragment
+        self.fragment_gap_ms = fragment_gap_ms
+        self.random = random.Random(seed)
+        # baud rate the host UART is set to (None: same as the modem) and
+        # the rate above which the host fails to receive data intact, like
+        # a Pico which is too slow to drain its UART (None: never)
+        self.host_baudrate = None
+        self.max_baudrate = None
+        self.flow_control = 0
+        # size of the receive buffer of the host UART (None: unlimited),
+        # whether the host holds the modem back with RTS when it is full
+        # and the number of bytes lost because it was full
+        self.host_rxbuf = None
+        self.host_flow = False
+        self.dropped = 0
+        # time (ms) a scan, a join and a boot take. A join without a BSSID
+        # scans all channels for the access point first.
+        self.scan_ms = 1000
+        self.join_ms = 500
+        self.join_scan_ms = 2000
+        self.boot_ms = 300
+        # status line of a failed join: FAIL (ESP8266 AT 1.x) or ERROR
+        # (ESP-AT 2.x), both follow +CWJAP:<reason>
+        self.join_fail = b'FAIL'
+
+        self.mode = 1
+        self.aps = []
+        # AT+CWLAPOPT: sort scan results by RSSI, fields printed
+        self.scan_sort = False
+        self.scan_mask = 0x1f
+        self.joined = None
+        self.autoconnect = True
+        self.dhcp = 3
+        self.station_ip = b'0.0.0.0'
+        self.ap_ip = b'192.168.4.1'
+        self.softap = [b'ESP_8283B1', b'', 1, 0, 4, 0]
+        # (ip, mac) of stations connected to the soft AP, listed with the
+        # +CWLIF: tag of ESP-AT 2.x if tag_stations is set
+        self.stations = []
+        self.tag_stations = False
+        # hosts answering AT+PING
+        self.ping_hosts = {}
+
+        self.mux = False
+        self.cipmode = 0
+        # bytes forwarded in transparent transmission mode
+        self.passthrough = False
+        self.passthrough_bytes = 0
+        # open links by link ID (None in single connection mode)
+        self.links = {}
+        # peers answer data sent over a link, echo if not set, see
+        # HTTPServer; time (ms) to open a link by type, e.g. b'SSL'
+        self.peers = {}
+        self.connect_ms = {}
+        # HTTP bodies by URL for AT+HTTPCLIENT, size of the chunks sent
+        self.pages = {}
+        self.http_chunk = 1024
+        # (method, url, data, headers) of every AT+HTTPCLIENT request
+        self.http_requests = []
+        # (url, headers, body) of every AT+HTTPCPOST request
+        self.posts = []
+
+        self.commands = []
+        self.resets = 0
+        # commands answered with 'busy p...', as they arrived before the
+        # status line of the previous command was sent
+        self.busy = 0
+        self._busy_until = 0
+        self._status_ms = 0
+        # bytes received from and sent to the host
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._rx = b''
+        # [callback, remaining bytes, data] while receiving data after '>'
+        self._sink = None
+        # chunks of [start_ms, data, baud rate] on their way over the wire
+        self._chunks = []
+        self._wire_free = 0
+        self._out = bytearray()
+        self.handlers = {
+            b'AT': self._at,
+            b'ATE0': self._ate,
+            b'ATE1': self._ate,
+            b'AT+RST': self._rst,
+            b'AT+RESTORE': self._restore,
+            b'AT+GMR': self._gmr,
+            b'AT+GSLP': self._ok,
+            b'AT+UART_CUR': self._uart_cur,
+            b'AT+UART_DEF': self._ok,
+            b'AT+CWMODE': self._cwmode,
+            b'AT+CWJAP': self._cwjap,
+            b'AT+CWQAP': self._cwqap,
+            b'AT+CWLAP': self._cwlap,
+            b'AT+CWLAPOPT': self._cwlapopt,
+            b'AT+CWSAP': self._cwsap,
+            b'AT+CWLIF': self._cwlif,
+            b'AT+CWDHCP': self._cwdhcp,
+            b'AT+CWAUTOCONN': self._cwautoconn,
+            b'AT+CIPSTA': self._cipsta,
+            b'AT+CIPAP': self._cipap,
+            b'AT+CIFSR': self._cifsr,
+            b'AT+CIPSTATUS': self._cipstatus,
+            b'AT+CIPSTO': self._ok,
+            b'AT+CIPSERVER': self._ok,
+            b'AT+PING': self._ping,
+            b'AT+CIPMUX': self._cipmux,
+            b'AT+CIPMODE': self._cipmode,
+            b'AT+CIPSTART': self._cipstart,
+            b'AT+CIPSEND': self._cipsend,
+            b'AT+CIPCLOSE': self._cipclose,
+            b'AT+HTTPCLIENT': self._httpclient,
+            b'AT+HTTPCPOST': self._httpcpost,
+        }
+
+    # --- serial line model ---------------------------------------------
+
+    def _byte_ms(self):
+        return 10000 / self.baudrate
+
+    def emit(self, data, delay_ms=0):
+        """Queue data to be sent to the host after the processing latency
+        plus delay_ms."""
+        start = max(_now_ms() + self.latency_ms + delay_ms, self._wire_free)
+        # the firmware is done with a command once its status line is sent
+        pos = max(data.rfind(status) for status in self.STATUS_LINES)
+        if pos >= 0:
+            self._status_ms = start + pos * self._byte_ms()
+        if self.fragment:
+            pos = 0
+            while pos < len(data):
+                n = self.random.randint(1, self.fragment)
+                self._chunks.append([start, data[pos:pos + n], self.baudrate])
+                start += n * self._byte_ms() + \
+                    self.random.random() * self.fragment_gap_ms
+                pos += n
+            self._wire_free = start
+        else:
+            self._chunks.append([start, data, self.baudrate])
+            self._wire_free = start + len(data) * self._byte_ms()
+
+    def _wire(self, data, baudrate, to_host=True):
+        """Return data sent at baudrate as it arrives on the other side."""
+        if (to_host and self.max_baudrate and baudrate > self.max_baudrate) or \
+                (self.host_baudrate is not None and self.host_baudrate != baudrate):
+            return bytes(c | 0x80 for c in data)
+        return data
+
+    def _pump(self):
+        now = _now_ms()
+        while self._chunks:
+            chunk = self._chunks[0]
+            start, data, baudrate = chunk
+            if start > now:
+                break
+            # bytes of the chunk which are on the host side by now
+            n = min(int((now - start) / self._byte_ms()) + 1, len(data))
+            received = data[:n]
+            if self.host_rxbuf:
+                space = max(self.host_rxbuf - len(self._out), 0)
+                if self.host_flow and self.flow_control:
+                    # RTS holds the modem back until the host reads
+                    n = min(n, space)
+                    if not n:
+                        break
+                    received = data[:n]
+                elif n > space:
+                    # the receive buffer of the host overflows
+                    self.dropped += n - space
+                    received = data[:space]
+            self._out += self._wire(received, baudrate)
+            if n == len(data):
+                self._chunks.pop(0)
+            else:
+                chunk[0] = start + n * self._byte_ms()
+                chunk[1] = data[n:]
+                break
+
+    def any(self):
+        self._pump()
+        return len(self._out)
+
+    def read(self, nbytes=None):
+        self._pump()
+        if nbytes is None:
+            nbytes = len(self._out)
+        data = bytes(self._out[:nbytes])
+        del self._out[:nbytes]
+        self.bytes_out += len(data)
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        self._pump()
+        if nbytes is None:
+            nbytes = len(buf)
+        n = min(nbytes, len(self._out))
+        buf[:n] = self._out[:n]
+        del self._out[:n]
+        self.bytes_out += n
+        return n
+
+    def readline(self):
+        self._pump()
+        end = self._out.find(b'\n')
+        return self.read(end + 1 if end >= 0 else None)
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        data = self._wire(data, self.baudrate, to_host=False)
+        if self.passthrough:
+            self._forward(data)
+            return
+        self._rx += data
+        while True:
+            if self._sink:
+                n = min(self._sink[1], len(self._rx))
+                self._data(self._rx[:n])
+                self._rx = self._rx[n:]
+                if self._sink:
+                    break
+                continue
+            end = self._rx.find(b'\r\n')
+            if end < 0:
+                break
+            line = self._rx[:end]
+            self._rx = self._rx[end + 2:]
+            self._command(line)
+
+    # --- AT command processing -----------------------------------------
+
+    @staticmethod
+    def reply(*lines, status=b'OK'):
+        """Format an answer consisting of the given lines and a status."""
+        out = b''.join(line + b'\r\n' for line in lines)
+        return out + b'\r\n' + status + b'\r\n'
+
+    @staticmethod
+    def _args(args):
+        """Split the arguments of a set command. Quotes are removed from
+        strings and backslash escapes are resolved."""
+        result = []
+        field = b''
+        quoted = False
+        i = 0
+        while i < len(args):
+            c = args[i:i + 1]
+            if c == b'\\' and quoted:
+                i += 1
+                field += args[i:i + 1]
+            elif c == b'"':
+                quoted = not quoted
+            elif c == b',' and not quoted:
+                result.append(field)
+                field = b''
+            else:
+                field += c
+            i += 1
+        if args:
+            result.append(field)
+        return result
+
+    def _command(self, line):
+        self.commands.append(line)
+        if self.echo:
+            self.emit(line + b'\r\n')
+        if _now_ms() < self._busy_until:
+            # the firmware is still processing the previous command
+            self.busy += 1
+            self.emit(b'busy p...\r\n')
+            return
+        for i, c in enumerate(line):
+            if c in b'=?':
+                name, op, args = line[:i], line[i:i + 1], line[i + 1:]
+                break
+        else:
+            name, op, args = line, b'', b''
+        self._status_ms = 0
+        handler = self.handlers.get(name)
+        if handler is None:
+            self.emit(b'\r\nERROR\r\n')
+        else:
+            handler(op, args)
+        self._busy_until = self._status_ms
+
+    def _error(self):
+        self.emit(self.reply(status=b'ERROR'))
+
+    def _ok(self, op, args):
+        self.emit(self.reply())
+
+    def _at(self, op, args):
+        self.emit(self.reply())
+
+    def _ate(self, op, args):
+        self.emit(self.reply())
+        self.echo = self.commands[-1] == b'ATE1'
+
+    def _uart_cur(self, op, args):
+        if op == b'?':
+            self.emit(self.reply(b'+UART_CUR:%d,8,1,0,%d' %
+                                 (self.baudrate, self.flow_control)))
+            return
+        args = self._args(args)
+        if op != b'=' or len(args) != 5 or args[0] == b'0':
+            self._error()
+            return
+        # the answer is sent at the old baud rate, then the rate changes
+        self.emit(self.reply())
+        self.baudrate = int(args[0])
+        self.flow_control = int(args[4])
+
+    def _gmr(self, op, args):
+        self.emit(self.reply(b'AT version:2.1.0.0(simulated)',
+                             b'SDK version:v4.0.1',
+                             b'Bin version:2.1.0(simulated)'))
+
+    def boot(self, delay_ms=0):
+        """Restart the firmware and print the boot log."""
+        self.resets += 1
+        self.echo = True
+        self.joined = None
+        self.links = {}
+        self.mux = False
+        self.cipmode = 0
+        self.passthrough = False
+        self.flow_control = 0
+        self.baudrate = self.default_baudrate
+        self.emit(self.BOOT_GARBAGE + b'\r\n' +
+                  b''.join(line + b'\r\n' for line in self.BOOT_LOG),
+                  delay_ms + self.boot_ms)
+
+    def _rst(self, op, args):
+        self.emit(self.reply())
+        self.boot()
+
+    def _restore(self, op, args):
+        self.emit(self.reply())
+        self.mode = 1
+        self.autoconnect = True
+        self.dhcp = 3
+        self.boot()
+
+    # --- WIFI ------------------------------------------------------------
+
+    def _cwmode(self, op, args):
+        if op == b'?':
+            self.emit(self.reply(b'+CWMODE:%d' % self.mode))
+        elif op == b'=' and args in (b'1', b'2', b'3'):
+            self.mode = int(args)
+            self.emit(self.reply())
+        else:
+            self._error()
+
+    def _find_ap(self, ssid, bssid=None):
+        for ap in self.aps:
+            if ap.raw_ssid == ssid and \
+                    (not bssid or ap.bssid.encode() == bssid):
+                return ap
+        return None
+
+    def _cwjap(self, op, args):
+        if op == b'?':
+            ap = self.joined
+            if ap is None:
+                self.emit(self.reply(b'No AP'))
+            else:
+                self.emit(self.reply(b'+CWJAP:"%s","%s",%d,%d,0,1,3,0,1' % (
+                    ap.raw_ssid, ap.bssid.encode(), ap.channel, ap.rssi)))
+            return
+        args = self._args(args)
+        if op != b'=' or len(args) < 2 or self.mode not in (1, 3):
+            self._error()
+            return
+        out = b''
+        if self.joined:
+            out += b'WIFI DISCONNECT\r\n'
+            self.joined = None
+        bssid = args[2] if len(args) > 2 else None
+        ap = self._find_ap(args[0], bssid)
+        delay = self.join_ms if bssid else self.join_ms + self.join_scan_ms
+        if ap is None:
+            self.emit(out + self.reply(b'+CWJAP:3', status=self.join_fail), delay)
+        elif ap.password.encode() != args[1]:
+            self.emit(out + self.reply(b'+CWJAP:1', status=self.join_fail), delay)
+        else:
+            self.joined = ap
+            if self.dhcp & 1:
+                self.station_ip = b'192.168.0.10'
+            self.emit(out + b'WIFI CONNECTED\r\nWIFI GOT IP\r\n' + self.reply(),
+                      delay)
+
+    def _cwqap(self, op, args):
+        self.emit(b'\r\nOK\r\n')
+        if self.joined:
+            self.joined = None
+            self.emit(b'WIFI DISCONNECT\r\n')
+
+    def _cwlap_line(self, ap):
+        fields = (b'%d' % ap.ecn, b'"%s"' % ap.raw_ssid, b'%d' % ap.rssi,
+                  b'"%s"' % ap.bssid.encode(), b'%d' % ap.channel)
+        return b'+CWLAP:(%s)' % b','.join(
+            f for i, f in enumerate(fields) if self.scan_mask & (1 << i))
+
+    def _cwlapopt(self, op, args):
+        args = self._args(args)
+        if op != b'=' or len(args) != 2 or args[0] not in (b'0', b'1'):
+            self._error()
+            return
+        self.scan_sort = args[0] == b'1'
+        self.scan_mask = int(args[1])
+        self.emit(self.reply())
+
+    def _cwlap(self, op, args):
+        args = self._args(args)
+        if self.mode not in (1, 3):
+            self._error()
+            return
+        aps = self.aps
+        if args:
+            aps = [ap for ap in aps if ap.raw_ssid == args[0]]
+        if self.scan_sort:
+            aps = sorted(aps, key=lambda ap: -ap.rssi)
+        self.emit(self.reply(*[self._cwlap_line(ap) for ap in aps]),
+                  self.scan_ms)
+
+    def _cwsap(self, op, args):
+        if self.mode not in (2, 3):
+            self._error()
+        elif op == b'?':
+            ssid, pwd, channel, ecn, max_conn, hidden = self.softap
+            self.emit(self.reply(b'+CWSAP:"%s","%s",%d,%d,%d,%d' % (
+                ssid, pwd, channel, ecn, max_conn, hidden)))
+        else:
+            args = self._args(args)
+            if len(args) < 4:
+                self._error()
+                return
+            self.softap[:4] = [args[0], args[1], int(args[2]), int(args[3])]
+            self.emit(self.reply())
+
+    def _cwlif(self, op, args):
+        tag = b'+CWLIF:' if self.tag_stations else b''
+        self.emit(self.reply(*[tag + b'%s,%s' % station for station in self.stations]))
+
+    def _cwdhcp(self, op, args):
+        if op == b'?':
+            self.emit(self.reply(b'+CWDHCP:%d' % self.dhcp))
+            return
+        args = self._args(args)
+        if len(args) != 2 or args[0] not in (b'0', b'1'):
+            self._error()
+            return
+        if args[0] == b'1':
+            self.dhcp |= int(args[1])
+        else:
+            self.dhcp &= ~int(args[1])
+        self.emit(self.reply())
+
+    def _cwautoconn(self, op, args):
+        if op == b'?':
+            self.emit(self.reply(b'+CWAUTOCONN:%d' % self.autoconnect))
+        elif op == b'=' and args in (b'0', b'1'):
+            self.autoconnect = args == b'1'
+            self.emit(self.reply())
+        else:
+            self._error()
+
+    def _ip_query(self, tag, ip):
+        gateway = ip.rsplit(b'.', 1)[0] + b'.1'
+        self.emit(self.reply(b'%s:ip:"%s"' % (tag, ip),
+                             b'%s:gateway:"%s"' % (tag, gateway),
+                             b'%s:netmask:"255.255.255.0"' % tag))
+
+    def _cipsta(self, op, args):
+        if op == b'?':
+            self._ip_query(b'+CIPSTA', self.station_ip)
+        else:
+            self.station_ip = self._args(args)[0]
+            self.dhcp &= ~1
+            self.emit(self.reply())
+
+    def _cipap(self, op, args):
+        if op == b'?':
+            self._ip_query(b'+CIPAP', self.ap_ip)
+        else:
+            self.ap_ip = self._args(args)[0]
+            self.dhcp &= ~2
+            self.emit(self.reply())
+
+    def _cifsr(self, op, args):
+        self.emit(self.reply(b'+CIFSR:APIP,"%s"' % self.ap_ip,
+                             b'+CIFSR:APMAC,"aa:bb:cc:dd:ee:f0"',
+                             b'+CIFSR:STAIP,"%s"' % self.station_ip,
+                             b'+CIFSR:STAMAC,"aa:bb:cc:dd:ee:f1"'))
+
+    def _ping(self, op, args):
+        ms = self.ping_hosts.get(self._args(args)[0])
+        if ms is None:
+            self.emit(self.reply(b'+PING:TIMEOUT', status=b'ERROR'), 1000)
+        else:
+            self.emit(self.reply(b'+PING:%d' % ms), ms)
+
+    # --- network links --------------------------------------------------
+
+    def remote_send(self, data, link_id=None, delay_ms=0):
+        """Data arriving from the peer of a link."""
+        if self.mux:
+            header = b'+IPD,%d,%d:' % (link_id, len(data))
+        else:
+            header = b'+IPD,%d:' % len(data)
+        self.emit(b'\r\n' + header + data, delay_ms)
+
+    def remote_close(self, link_id=None, delay_ms=0):
+        """The peer closes the link."""
+        del self.links[link_id]
+        self.emit(b'%d,CLOSED\r\n' % link_id if self.mux else b'CLOSED\r\n',
+                  delay_ms)
+
+    def _cipstatus(self, op, args):
+        lines = [b'STATUS:%d' % (3 if self.links else 2 if self.joined else 5)]
+        for link_id, (proto, host, port) in sorted(self.links.items(),
+                                                   key=lambda l: l[0] or 0):
+            lines.append(b'+CIPSTATUS:%d,"%s","%s",%d,%d,0' % (
+                link_id or 0, proto, host, port, 50000 + (link_id or 0)))
+        self.emit(self.reply(*lines))
+
+    def _cipmux(self, op, args):
+        if op == b'?':
+            self.emit(self.reply(b'+CIPMUX:%d' % self.mux))
+        elif op == b'=' and args in (b'0', b'1') and not self.links:
+            self.mux = args == b'1'
+            self.emit(self.reply())
+        else:
+            self._error()
+
+    def _cipstart(self, op, args):
+        args = self._args(args)
+        link_id = int(args.pop(0)) if self.mux else None
+        if op != b'=' or len(args) < 3 or link_id in self.links:
+            self._error()
+            return
+        self.links[link_id] = (args[0], args[1], int(args[2]))
+        connect = b'CONNECT' if link_id is None else b'%d,CONNECT' % link_id
+        self.emit(self.reply(connect), self.connect_ms.get(args[0], 0))
+
+    def _peer(self, link_id):
+        return self.peers.get(self.links[link_id][1:], lambda data: data)
+
+    def _forward(self, data):
+        if data == b'+++':
+            self.passthrough = False
+            return
+        self.passthrough_bytes += len(data)
+        answer = self._peer(None)(data)
+        if answer:
+            self.emit(answer)
+
+    def _cipmode(self, op, args):
+        if op == b'?':
+            self.emit(self.reply(b'+CIPMODE:%d' % self.cipmode))
+        elif op == b'=' and args in (b'0', b'1') and not self.mux:
+            self.cipmode = int(args)
+            self.emit(self.reply())
+        else:
+            self._error()
+
+    def _cipsend(self, op, args):
+        if op == b'' and self.cipmode and None in self.links:
+            self.passthrough = True
+            self.emit(b'\r\nOK\r\n\r\n>')
+            return
+        args = self._args(args)
+        link_id = int(args.pop(0)) if self.mux and args else None
+        if op != b'=' or len(args) != 1 or link_id not in self.links:
+            self._error()
+            return
+        self._sink = [lambda data: self._link_data(link_id, data), int(args[0]), b'']
+        self.emit(b'\r\nOK\r\n\r\n>')
+
+    def _data(self, data):
+        self._sink[1] -= len(data)
+        self._sink[2] += data
+        if self._sink[1] > 0:
+            return
+        callback, _, data = self._sink
+        self._sink = None
+        self.emit(b'\r\nRecv %d bytes\r\n\r\nSEND OK\r\n' % len(data))
+        callback(data)
+
+    def _link_data(self, link_id, data):
+        answer = self._peer(link_id)(data)
+        # a peer may close the link after answering
+        close = False
+        if type(answer) is tuple:
+            answer, close = answer
+        if answer:
+            self.remote_send(answer, link_id)
+        if close:
+            self.remote_close(link_id)
+
+    def _cipclose(self, op, args):
+        link_id = int(args) if self.mux and op == b'=' else None
+        if link_id not in self.links:
+            self._error()
+            return
+        del self.links[link_id]
+        closed = b'CLOSED' if link_id is None else b'%d,CLOSED' % link_id
+        self.emit(self.reply(closed))
+
+    # --- HTTP client ----------------------------------------------------
+
+    def _httpclient(self, op, args):
+        args = self._args(args)
+        if op != b'=' or len(args) < 6:
+            self._error()
+            return
+        # <data> comes before the headers, it may be empty
+        data = args[6] if len(args) > 6 else b''
+        headers = args[7:]
+        if any(b':' not in header for header in headers):
+            self._error()
+            return
+        self.http_requests.append((int(args[0]), args[2], data, headers))
+        body = self.pages.get(args[2])
+        if body is None:
+            self._error()
+            return
+        out = b''
+        for i in range(0, len(body), self.http_chunk):
+            chunk = body[i:i + self.http_chunk]
+            out += b'+HTTPCLIENT:%d,' % len(chunk) + chunk + b'\r\n'
+        self.emit(out + b'\r\nOK\r\n')
+
+    def _httpcpost(self, op, args):
+        args = self._args(args)
+        if op != b'=' or len(args) < 2 or \
+                len(args) != 2 + (int(args[2]) + 1 if len(args) > 2 else 0):
+            self._error()
+            return
+        url, headers = args[0], args[3:]
+        self._sink = [lambda body: self.posts.append((url, headers, body)),
+                      int(args[1]), b'']
+        self.emit(b'\r\nOK\r\n\r\n>')
@@ -0,0 +1,99 @@
+"""
+Minimal stand-in for the MicroPython machine module. UART instances are
+connected to a simulated ESP AT modem instead of real hardware.
+
+A device may be attached to a UART id in advance using attach(), otherwise
+a default simulated modem is created on first use.
+"""
+
+import time
+
+_devices = {}
+
+
+def attach(id, device):
+    """Attach a device (e.g. esp_at_sim.ESPATModem) to the UART id."""
+    _devices[id] = device
+
+
+def device(id):
+    """Return the device attached to the UART id."""
+    if id not in _devices:
+        from esp_at_sim import ESPATModem
+        _devices[id] = ESPATModem()
+    return _devices[id]
+
+
+class UART(object):
+
+    CTS = 1
+    RTS = 2
+
+    def __init__(self, id, baudrate=115200, **kwargs):
+        self._id = id
+        self._dev = device(id)
+        # default size of the receive buffer of the rp2 port
+        self._rxbuf = 256
+        self.init(baudrate, **kwargs)
+
+    def init(self, baudrate=115200, bits=8, parity=None, stop=1, flow=0,
+             rxbuf=-1, **kwargs):
+        self._baudrate = baudrate
+        self._flow = flow
+        if rxbuf >= 0:
+            self._rxbuf = rxbuf
+        if hasattr(self._dev, 'host_baudrate'):
+            self._dev.host_baudrate = baudrate
+            self._dev.host_rxbuf = self._rxbuf
+            self._dev.host_flow = bool(flow & self.RTS)
+        self._bits = bits
+        self._parity = parity
+        self._stop = stop
+
+    def __repr__(self):
+        return "UART(%d, baudrate=%d, bits=%d, parity=%s, stop=%d)" % \
+            (self._id, self._baudrate, self._bits, self._parity, self._stop)
+
+    def any(self):
+        return self._dev.any()
+
+    def read(self, nbytes=None):
+        data = self._dev.read(nbytes)
+        return data if data else None
+
+    def readinto(self, buf, nbytes=None):
+        n = self._dev.readinto(buf, nbytes)
+        return n if n else None
+
+    def readline(self):
+        return self._dev.readline() or None
+
+    def write(self, buf):
+        if type(buf) is str:
+            buf = buf.encode()
+        self._dev.write(bytes(buf))
+        # writing blocks until the bytes are on the wire
+        time.sleep(len(buf) * 10 / self._baudrate)
+        return len(buf)
+
+
+class Pin(object):
+
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=IN, value=None):
+        self._id = id
+        self._mode = mode
+        self._value = value or 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
@@ -0,0 +1,71 @@
+"""
+Run a MicroPython script of the driver on the host against the simulated
+modem, e.g. one of the examples:
+
+    python3 host/run.py example/test.py [--baud BAUD] [--latency MS]
+                        [--fragment BYTES] [--gap MS] [--seed N]
+
+The modem sees the access point and HTTP page the examples expect, so the
+scripts run through without hardware. With --fragment the answers of the
+modem are delivered in random pieces; --seed makes a run reproducible.
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import runpy
+import machine
+from esp_at_sim import ESPATModem, AccessPoint
+
+TEST_AP_SSID = "YOUR_AP_SSID"
+TEST_AP_PASS = "YOUR_AP_PWD"
+
+HTTPBIN_GET = b'''{
+  "args": {},
+  "headers": {
+    "Host": "httpbin.org",
+    "User-Agent": "ESP32 HTTP Client/1.0"
+  },
+  "url": "http://httpbin.org/get"
+}
+'''
+
+
+def modem(baud=115200, latency=5, fragment=0, gap=0, seed=0):
+    """Return a simulated modem set up for the example scripts."""
+    esp = ESPATModem(baudrate=baud, latency_ms=latency, fragment=fragment,
+                     fragment_gap_ms=gap, seed=seed)
+    esp.aps = [AccessPoint(TEST_AP_SSID, TEST_AP_PASS),
+               AccessPoint('Neighbour', 'secret', bssid='aa:bb:cc:dd:ee:02',
+                           channel=11, rssi=-80, ecn=4),
+               AccessPoint('Cafe', bssid='aa:bb:cc:dd:ee:03', channel=1,
+                           rssi=-71, ecn=0)]
+    esp.pages[b'http://httpbin.org/get'] = HTTPBIN_GET
+    esp.ping_hosts[b'httpbin.org'] = 30
+    esp.scan_ms = esp.join_scan_ms = 200
+    return esp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('script')
+    parser.add_argument('--baud', type=int, default=9600,
+                        help='baud rate of the modem, the examples use 9600')
+    parser.add_argument('--latency', type=int, default=5,
+                        help='modem processing latency in ms')
+    parser.add_argument('--fragment', type=int, default=0,
+                        help='split answers into pieces of up to N bytes')
+    parser.add_argument('--gap', type=int, default=0,
+                        help='max. gap between fragments in ms')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    machine.attach(1, modem(args.baud, args.latency, args.fragment,
+                            args.gap, args.seed))
+    runpy.run_path(args.script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Serve a simulated ESP AT modem over TCP or a PTY, e.g. for the asyncio
+front end (esp_at_async.py) or to drive the simulator from another process
+(see SocketTransport and SerialTransport in esp_at_transport.py).
+
+Run from the repository root with:
+
+    python3 host/sim_server.py [--port PORT] [--baud BAUD] [--pty]
+"""
+import argparse
+import asyncio
+import os
+import select
+import threading
+import tty
+
+from esp_at_sim import ESPATModem
+
+
+async def serve(modem, host='127.0.0.1', port=0):
+    """Start a server connecting its clients to the modem. Returns the
+    asyncio server."""
+
+    async def client(reader, writer):
+
+        async def pump():
+            while True:
+                if modem.any():
+                    writer.write(modem.read())
+                    await writer.drain()
+                await asyncio.sleep(0.001)
+
+        task = asyncio.ensure_future(pump())
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                modem.write(data)
+        finally:
+            task.cancel()
+            writer.close()
+
+    return await asyncio.start_server(client, host, port)
+
+
+def serve_pty(modem):
+    """Connect the modem to a new PTY in a background thread. Returns the
+    path of the PTY to open with SerialTransport."""
+    # the slave end stays open, so clients may come and go
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+
+    def pump():
+        poll = select.poll()
+        poll.register(master, select.POLLIN)
+        while True:
+            if poll.poll(1):
+                modem.write(os.read(master, 4096))
+            if modem.any():
+                os.write(master, modem.read())
+
+    threading.Thread(target=pump, daemon=True).start()
+    return path
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--pty', action='store_true',
+                        help='serve the modem on a PTY instead of TCP')
+    args = parser.parse_args()
+    if args.pty:
+        print('Serving simulated modem on %s' % serve_pty(ESPATModem(baudrate=args.baud)))
+        await asyncio.Event().wait()
+    server = await serve(ESPATModem(baudrate=args.baud), port=args.port)
+    print('Serving simulated modem on port %d' % args.port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
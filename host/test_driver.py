@@ -0,0 +1,889 @@
+"""
+Tests of the ESPCHIP driver against the simulated modem. Everything runs
+on the host without hardware; fragmenting is seeded, so the runs are
+reproducible. Run from the repository root with:
+
+    python3 -m unittest host/test_driver.py
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+import asyncio
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import utime as time
+import machine
+from esp_at_uart import ESPCHIP, CMDS_WIFI, WIFI_MODES, AccessPoint, AccessPointConfig, \
+    ConnectionStatus, DHCPConfig, Link, Station, CommandError, CommandFailure, \
+    InvalidParameterError
+from esp_at_async import AsyncESPCHIP
+from esp_at_http import HTTPClient
+import esp_at_sim
+from esp_at_sim import HTTPServer
+from esp_at_transport import SerialTransport, SocketTransport, UARTTransport
+from run import modem, TEST_AP_SSID, TEST_AP_PASS
+from sim_server import serve, serve_pty
+
+PEER = ('192.168.0.2', 5000)
+
+
+def driver(baud=115200, **kwargs):
+    """Return the simulated modem and an ESPCHIP attached to it."""
+    sim = modem(baud, **kwargs)
+    sim.peers[(PEER[0].encode(), PEER[1])] = lambda data: None
+    machine.attach(1, sim)
+    return sim, ESPCHIP(1, baud)
+
+
+def garble(sim, match, replace):
+    """Make the modem send replace instead of the first chunk equal to
+    match, like bytes lost on the line."""
+    emit = sim.emit
+
+    def garbled(data, delay_ms=0):
+        if data == match:
+            data = replace
+            sim.emit = emit
+        emit(data, delay_ms)
+    sim.emit = garbled
+
+
+class EncodeTest(unittest.TestCase):
+
+    def encode(self, cmd, op=b'', args=()):
+        buf = bytearray(128)
+        return bytes(buf[:ESPCHIP._encode_command(buf, cmd, op, args)])
+
+    def test_escaping(self):
+        self.assertEqual(self.encode(CMDS_WIFI['CONNECT'], b'=', ('a"b,c\\d', 1)),
+                         b'AT+CWJAP="a\\"b\\,c\\\\d",1\r\n')
+
+    def test_arguments(self):
+        self.assertEqual(self.encode(CMDS_WIFI['MODE'], b'?'), b'AT+CWMODE?\r\n')
+        self.assertEqual(self.encode(CMDS_WIFI['DHCP_CONFIG'], b'=', (1, False)),
+                         b'AT+CWDHCP=1,0\r\n')
+        self.assertEqual(self.encode(b'AT+CIPSEND', b'=', (None, -12)),
+                         b'AT+CIPSEND=-12\r\n')
+
+    def test_buffer_too_small(self):
+        with self.assertRaises(IndexError):
+            ESPCHIP._encode_command(bytearray(8), CMDS_WIFI['MODE'], b'=', (1,))
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_fields(self):
+        line = b'+CWLAP:(3,"a,b\\"c",-52,"aa:bb:cc:dd:ee:01",6)\r\n'
+        self.assertEqual(ESPCHIP._parse_fields(line, 8, 'isisi'),
+                         [3, 'a,b\\"c', -52, 'aa:bb:cc:dd:ee:01', 6])
+
+    def test_non_utf8(self):
+        self.assertEqual(ESPCHIP._parse_fields(b'+CWLAP:(3,"\xbf\xa7",-60)\r\n', 8, 'isi'),
+                         [3, b'\xbf\xa7', -60])
+
+    def test_missing_fields(self):
+        self.assertEqual(ESPCHIP._parse_fields(b'+CWMODE:1\r\n', 8, 'ii'), [1, None])
+
+    def test_malformed_fields(self):
+        self.assertIsNone(ESPCHIP._parse_fields(b'+CWMODE:x\r\n', 8, 'i'))
+        self.assertIsNone(ESPCHIP._parse_fields(b'+CWJAP:"open\r\n', 7, 's'))
+        self.assertIsNone(ESPCHIP._parse_fields(b'+CWMODE:1x\r\n', 8, 'i'))
+
+    def test_record(self):
+        self.assertEqual(ESPCHIP._parse_record(Station, b'+CWLIF:192.168.4.2,aa:bb\r\n',
+                                               b'+CWLIF:', 'ss'),
+                         Station('192.168.4.2', 'aa:bb'))
+        self.assertIsNone(ESPCHIP._parse_record(Station, b'busy p...\r\n', b'+CWLIF:', 'ss'))
+
+    def test_int(self):
+        self.assertEqual(ESPCHIP._parse_int(b'+CWMODE:-3\r\n', 8), -3)
+        self.assertIsNone(ESPCHIP._parse_int(b'+CWMODE:\r\n', 8))
+        with self.assertRaises(CommandFailure):
+            ESPCHIP._parse_int(b'+CWMODE:?\r\n', 8)
+
+
+class FramingTest(unittest.TestCase):
+
+    def test_fragmented(self):
+        sim, esp = driver(fragment=5, gap=2, seed=1)
+        self.assertTrue(esp.test())
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertEqual(len(esp.list_all_accesspoints()), len(sim.aps))
+
+    def test_echo_off(self):
+        sim, esp = driver()
+        self.assertTrue(esp.set_echo(False))
+        self.assertFalse(sim.echo)
+        self.assertTrue(esp.test())
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertEqual(esp.get_dhcp_config(fresh=True), DHCPConfig(True, True))
+        # turned off again after a reset
+        self.assertTrue(esp.reset())
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertFalse(sim.echo)
+
+    def test_echo_off_slow_answer(self):
+        sim, esp = driver()
+        self.assertTrue(esp.set_echo(False))
+        # the first line arrives after CMD_RESPONSE_TIMEOUT
+        sim.join_ms, sim.join_scan_ms, sim.scan_ms = 1200, 300, 1500
+        self.assertTrue(esp.connect(TEST_AP_SSID, TEST_AP_PASS))
+        self.assertEqual(len(esp.list_all_accesspoints()), len(sim.aps))
+
+    def test_stale_answer(self):
+        sim, esp = driver()
+        sim.emit(b'\xfe\xff+CWMODE:3\r\n\r\nOK\r\n')
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        sim.emit(b'\x00\x80garbage\r\n')
+        self.assertTrue(esp.test())
+
+    def test_garbled_echo(self):
+        sim, esp = driver(9600)
+        garble(sim, b'AT+CWMODE?\r\n', b'AT+CWMOD?\r\n')
+        start = time.ticks_ms()
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertLess(time.ticks_diff(time.ticks_ms(), start), 500)
+        self.assertTrue(esp.test())
+
+
+class EventTest(unittest.TestCase):
+
+    def test_dispatch(self):
+        sim, esp = driver()
+        events = []
+        esp.subscribe('WIFI_DISCONNECT', lambda event, arg: events.append(event))
+        self.assertTrue(esp.connect(TEST_AP_SSID, TEST_AP_PASS))
+        sim.emit(b'WIFI DISCONNECT\r\n')
+        # removed from the answer of a command and dispatched after it
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertEqual(events, ['WIFI_DISCONNECT'])
+        sim.emit(b'+STA_CONNECTED:"aa:bb:cc:dd:ee:ff"\r\n')
+        self.assertEqual(esp.poll(timeout=200), 1)
+        self.assertEqual(esp.events[-1], ('STA_CONNECTED', b'"aa:bb:cc:dd:ee:ff"'))
+
+    def test_link_events(self):
+        sim, esp = driver()
+        events = []
+        esp.subscribe('CLOSED', lambda event, arg: events.append((event, arg)))
+        sock = esp.open_connection('TCP', PEER[0], PEER[1])
+        sim.remote_close(sock.link_id)
+        self.assertEqual(esp.poll(timeout=200), 1)
+        self.assertEqual(events, [('CLOSED', 0)])
+        self.assertFalse(sock.connected)
+
+    def test_poll_abandoned(self):
+        sim, esp = driver()
+        sim.pages[b'http://x/body'] = b'z' * 2048
+        sim.http_chunk = 512
+        events = []
+        esp.subscribe('WIFI_DISCONNECT', lambda event, arg: events.append(event))
+        for abandon in (lambda: next(iter(esp.scan())),
+                        lambda: next(iter(esp.http_request_stream('http://x/body')))):
+            abandon()
+            sim.emit(b'WIFI DISCONNECT\r\n', 50)
+            # the rest of the answer is read first, the event is dispatched
+            esp.poll(timeout=200)
+            self.assertEqual(events, ['WIFI_DISCONNECT'])
+            start = time.ticks_ms()
+            self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+            self.assertLess(time.ticks_diff(time.ticks_ms(), start), 200)
+            del events[:]
+
+    def test_stations(self):
+        sim, esp = driver()
+        sim.stations = [(b'192.168.4.2', b'aa:bb:cc:dd:ee:ff')]
+        for tagged in (False, True):
+            sim.tag_stations = tagged
+            self.assertEqual(esp.list_stations(),
+                             [Station('192.168.4.2', 'aa:bb:cc:dd:ee:ff')])
+
+
+class ScanTest(unittest.TestCase):
+
+    def test_stop_ssid(self):
+        sim, esp = driver()
+        aps = list(esp.scan(stop_ssid='Neighbour'))
+        self.assertEqual([ap.ssid for ap in aps], [TEST_AP_SSID, 'Neighbour'])
+        self.assertEqual(aps[1], AccessPoint(4, 'Neighbour', -80, 'aa:bb:cc:dd:ee:02', 11))
+        # the rest of the answer is read before the next command
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertEqual(len(list(esp.scan(TEST_AP_SSID))), 1)
+
+    def test_non_utf8_ssid(self):
+        sim, esp = driver()
+        ssid = '\u5496\u5561'.encode('gbk')
+        sim.aps.insert(1, esp_at_sim.AccessPoint(ssid, bssid='aa:bb:cc:dd:ee:04', rssi=-60))
+        aps = esp.list_all_accesspoints()
+        self.assertEqual([ap.ssid for ap in aps], [TEST_AP_SSID, ssid, 'Neighbour', 'Cafe'])
+        self.assertEqual(aps[1], AccessPoint(3, ssid, -60, 'aa:bb:cc:dd:ee:04', 6))
+
+    def test_scan_options(self):
+        sim, esp = driver()
+        esp.set_scan_options(sort_rssi=True, fields=('ssid', 'rssi'))
+        self.assertTrue(sim.scan_sort)
+        self.assertEqual(sim.scan_mask, 0x06)
+        self.assertEqual(esp.list_all_accesspoints(),
+                         [AccessPoint(None, TEST_AP_SSID, -52, None, None),
+                          AccessPoint(None, 'Cafe', -71, None, None),
+                          AccessPoint(None, 'Neighbour', -80, None, None)])
+        with self.assertRaises(InvalidParameterError):
+            esp.set_scan_options(fields=('ssid', 'noise'))
+        esp.set_scan_options(sort_rssi=False)
+        self.assertEqual(esp.list_all_accesspoints()[1],
+                         AccessPoint(4, 'Neighbour', -80, 'aa:bb:cc:dd:ee:02', 11))
+
+
+class ReconnectTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.profile = os.path.join(tmp, 'wifi_profile.json')
+
+    def joins(self, sim):
+        return [c for c in sim.commands if c.startswith(b'AT+CWJAP=')]
+
+    def test_profile(self):
+        sim, esp = driver()
+        sim.join_ms = 50
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        with open(self.profile) as f:
+            self.assertEqual(json.load(f), {'ssid': TEST_AP_SSID,
+                                            'bssid': 'aa:bb:cc:dd:ee:01', 'channel': 6})
+        self.assertIsNone(esp.join_times['warm'])
+        self.assertTrue(esp.disconnect())
+        # the cached BSSID saves the scan
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        self.assertTrue(self.joins(sim)[-1].endswith(b',"aa:bb:cc:dd:ee:01"'))
+        self.assertLess(esp.join_times['warm'], esp.join_times['cold'])
+
+    def test_cached_ap_gone(self):
+        sim, esp = driver()
+        sim.join_ms = 50
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        sim.aps[0].bssid = 'aa:bb:cc:dd:ee:09'
+        self.assertTrue(esp.disconnect())
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        # a full join follows and updates the profile
+        self.assertEqual(self.joins(sim)[-1], b'AT+CWJAP="%s","%s"' % (
+            TEST_AP_SSID.encode(), TEST_AP_PASS.encode()))
+        with open(self.profile) as f:
+            self.assertEqual(json.load(f)['bssid'], 'aa:bb:cc:dd:ee:09')
+
+    def test_cached_ap_gone_error(self):
+        sim, esp = driver()
+        sim.join_ms = 50
+        sim.join_fail = b'ERROR'
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        sim.aps[0].bssid = 'aa:bb:cc:dd:ee:09'
+        self.assertTrue(esp.disconnect())
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        self.assertEqual(len(self.joins(sim)), 3)
+        self.assertEqual(esp.get_accesspoint().bssid, 'aa:bb:cc:dd:ee:09')
+
+    def test_other_ssid(self):
+        sim, esp = driver()
+        sim.join_ms = 50
+        self.assertTrue(esp.reconnect(TEST_AP_SSID, TEST_AP_PASS, profile=self.profile))
+        self.assertTrue(esp.reconnect('Cafe', '', profile=self.profile))
+        self.assertEqual(self.joins(sim)[-1], b'AT+CWJAP="Cafe",""')
+        with open(self.profile) as f:
+            self.assertEqual(json.load(f)['ssid'], 'Cafe')
+        with self.assertRaises(CommandFailure):
+            esp.reconnect('Unknown', 'x', profile=self.profile)
+        with open(self.profile) as f:
+            self.assertEqual(json.load(f)['ssid'], 'Cafe')
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counters(self):
+        sim, esp = driver()
+        sim.join_ms = 50
+        m = esp.enable_metrics()
+        self.assertTrue(esp.test())
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        # a timeout and a failed join
+        garble(sim, b'\r\nOK\r\n', b'')
+        garble(sim, b'AT\r\n', b'')
+        self.assertFalse(esp.test())
+        with self.assertRaises(CommandFailure):
+            esp.connect('Cafe', 'wrong')
+        counters = m.dump()
+        self.assertEqual(sorted(counters), ['AT', 'AT+CWJAP', 'AT+CWMODE'])
+        at = counters['AT']
+        self.assertEqual((at['count'], at['tx_bytes'], at['timeouts'], at['failures']),
+                         (2, 8, 1, 0))
+        mode = counters['AT+CWMODE']
+        self.assertEqual((mode['count'], mode['tx_bytes'], mode['timeouts']), (1, 12, 0))
+        self.assertEqual(mode['rx_bytes'], len(b'AT+CWMODE?\r\n+CWMODE:1\r\n\r\nOK\r\n'))
+        self.assertLessEqual(mode['min_ms'], mode['avg_ms'])
+        self.assertLessEqual(mode['avg_ms'], mode['max_ms'])
+        self.assertEqual(counters['AT+CWJAP']['failures'], 1)
+        # a new period
+        self.assertEqual(m.dump(clear=True), counters)
+        self.assertEqual(m.dump(), {})
+        self.assertTrue(esp.test())
+        self.assertEqual(m.dump()['AT']['count'], 1)
+        self.assertIsNone(esp.enable_metrics(False))
+
+
+class BatchTest(unittest.TestCase):
+
+    def provision(self, esp):
+        esp.set_mode(WIFI_MODES['SOFTAP_STATION'])
+        esp.set_dhcp_config(1, False)
+        esp.set_accesspoint_config('Batch_AP', 'password', 5, 3)
+        esp.set_autoconnect(False)
+        esp.set_dhcp_config(1, True)
+
+    def test_results(self):
+        sim, esp = driver()
+        with esp.batch() as batch:
+            self.provision(esp)
+            # queries see the queued values
+            self.assertEqual(esp.get_mode(), WIFI_MODES['SOFTAP_STATION'])
+        # set_accesspoint_config() requested a reset, done once at the end
+        self.assertEqual([r.command for r in batch.results],
+                         [b'AT+CWMODE', b'AT+CWDHCP', b'AT+CWSAP', b'AT+CWAUTOCONN',
+                          b'AT+CWDHCP', b'AT+RST'])
+        self.assertEqual([r.error for r in batch.results], [None] * 6)
+        self.assertEqual(sim.mode, WIFI_MODES['SOFTAP_STATION'])
+        self.assertFalse(sim.autoconnect)
+
+    def test_busy(self):
+        sim, esp = driver()
+        with esp.batch(depth=4) as batch:
+            self.provision(esp)
+        self.assertEqual([r.error for r in batch.results], [None] * 6)
+        self.assertGreater(sim.busy, 0)
+        # the setters took effect in their order
+        self.assertEqual(sim.dhcp, 3)
+        self.assertEqual(sim.softap[0], b'Batch_AP')
+
+    def test_rejected(self):
+        sim, esp = driver()
+        mode = esp.get_mode()
+        with self.assertRaises(InvalidParameterError):
+            with esp.batch():
+                esp.set_mode(WIFI_MODES['SOFTAP'])
+                esp.connect(TEST_AP_SSID, TEST_AP_PASS)
+        # nothing was sent or cached
+        self.assertEqual(esp.get_mode(), mode)
+        self.assertEqual(sim.mode, mode)
+
+
+class CacheTest(unittest.TestCase):
+
+    def test_cached(self):
+        sim, esp = driver()
+        self.assertEqual(esp.get_mode(), sim.mode)
+        esp.set_mode(WIFI_MODES['SOFTAP_STATION'])
+        n = len(sim.commands)
+        self.assertEqual(esp.get_mode(), WIFI_MODES['SOFTAP_STATION'])
+        self.assertEqual(esp.get_dhcp_config(), DHCPConfig(True, True))
+        esp.set_dhcp_config(2, False)
+        self.assertEqual(esp.get_dhcp_config(), DHCPConfig(True, False))
+        self.assertEqual(sim.commands[n:], [b'AT+CWDHCP?', b'AT+CWDHCP=0,2'])
+
+    def test_setter_timeout(self):
+        sim, esp = driver()
+        self.assertEqual(esp.get_mode(), sim.mode)
+        self.assertEqual(esp.get_dhcp_config(), DHCPConfig(True, True))
+        self.assertTrue(esp.get_autoconnect())
+        # neither the echo nor the status line of the setters arrive
+        for cmd, setter in ((b'AT+CWMODE=2', lambda: esp.set_mode(WIFI_MODES['SOFTAP'])),
+                            (b'AT+CWDHCP=0,1', lambda: esp.set_dhcp_config(1, False)),
+                            (b'AT+CWAUTOCONN=0', lambda: esp.set_autoconnect(False))):
+            garble(sim, b'\r\nOK\r\n', b'')
+            garble(sim, cmd + b'\r\n', b'')
+            self.assertIsNone(setter())
+        # the values are read from the module again
+        n = len(sim.commands)
+        self.assertEqual(esp.get_mode(), sim.mode)
+        self.assertEqual(esp.get_dhcp_config(), DHCPConfig(False, True))
+        self.assertFalse(esp.get_autoconnect())
+        self.assertEqual(sim.commands[n:], [b'AT+CWMODE?', b'AT+CWDHCP?', b'AT+CWAUTOCONN?'])
+
+
+class ModuleTest(unittest.TestCase):
+
+    def test_version(self):
+        sim, esp = driver()
+        self.assertTrue(esp.version())
+        self.assertEqual(sim.commands[-1], b'AT+GMR')
+
+    def test_factory_reset(self):
+        sim, esp = driver()
+        esp.set_mode(WIFI_MODES['SOFTAP'])
+        esp.set_autoconnect(False)
+        self.assertTrue(esp.set_echo(False))
+        resets = sim.resets
+        # returns once the module rebooted
+        self.assertTrue(esp.factory_reset())
+        self.assertEqual(sim.resets, resets + 1)
+        self.assertFalse(sim.echo)
+        # the cached values are gone
+        self.assertEqual(esp.get_mode(), WIFI_MODES['STATION'])
+        self.assertTrue(esp.get_autoconnect())
+
+    def test_flow_control(self):
+        sim, esp = driver()
+        self.assertTrue(esp.set_flow_control())
+        self.assertEqual(sim.flow_control, 3)
+        self.assertTrue(esp.flow_control)
+        self.assertTrue(sim.host_flow)
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertTrue(esp.set_flow_control(False))
+        self.assertEqual(sim.flow_control, 0)
+        self.assertFalse(sim.host_flow)
+
+    def test_ping(self):
+        sim, esp = driver()
+        sim.ping_hosts[b'example.com'] = 20
+        self.assertIsNotNone(esp.ping('example.com'))
+        self.assertEqual(sim.commands[-1], b'AT+PING="example.com"')
+        with self.assertRaises(CommandError):
+            esp.ping('unknown.example.com')
+
+    def test_accesspoint_config(self):
+        sim, esp = driver()
+        with self.assertRaises(CommandFailure):
+            esp.get_accesspoint_config()
+        esp.set_mode(WIFI_MODES['SOFTAP'])
+        self.assertEqual(esp.get_accesspoint_config(),
+                         AccessPointConfig('ESP_8283B1', '', 1, 0, 4, 0))
+        esp.set_accesspoint_config('Pico_AP', 'password', 5, 3)
+        self.assertEqual(esp.get_accesspoint_config(),
+                         AccessPointConfig('Pico_AP', 'password', 5, 3, 4, 0))
+
+
+class DataTest(unittest.TestCase):
+
+    def test_connection_status(self):
+        sim, esp = driver()
+        self.assertEqual(esp.get_connection_status(), ConnectionStatus(5, []))
+        self.assertTrue(esp.connect(TEST_AP_SSID, TEST_AP_PASS))
+        self.assertEqual(esp.get_connection_status(), ConnectionStatus(2, []))
+        sock = esp.open_connection('TCP', PEER[0], PEER[1])
+        esp.open_connection('UDP', PEER[0], 5001)
+        self.assertEqual(esp.get_connection_status(), ConnectionStatus(3, [
+            Link(0, 'TCP', PEER[0], PEER[1], 50000, 0),
+            Link(1, 'UDP', PEER[0], 5001, 50001, 0)]))
+        sock.close()
+        self.assertEqual(esp.get_connection_status().links,
+                         [Link(1, 'UDP', PEER[0], 5001, 50001, 0)])
+
+    def test_large_ipd(self):
+        sim, esp = driver(9600)
+        esp.start_connection('TCP', PEER[0], PEER[1])
+        sim.remote_send(b'y' * 1460)
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        buf = bytearray(2000)
+        self.assertEqual(esp.recv_into(buf, timeout=3000), 1460)
+        self.assertEqual(bytes(buf[:1460]), b'y' * 1460)
+
+    def test_recv_into(self):
+        sim, esp = driver()
+        esp.start_connection('TCP', PEER[0], PEER[1])
+        sim.remote_send(b'0123456789')
+        esp.poll(timeout=200)
+        buf = bytearray(4)
+        data = b''
+        while len(data) < 10:
+            n = esp.recv_into(buf, timeout=200)
+            data += bytes(buf[:n])
+        self.assertEqual(data, b'0123456789')
+
+    def test_sockets(self):
+        sim, esp = driver()
+        sock = esp.open_connection('TCP', PEER[0], PEER[1])
+        echo = esp.open_connection('TCP', '192.168.0.3', 80)
+        self.assertTrue(sim.mux)
+        self.assertEqual((sock.link_id, echo.link_id), (0, 1))
+        echo.settimeout(1)
+        self.assertEqual(echo.send(b'ping'), 4)
+        self.assertEqual(echo.recv(16), b'ping')
+        # data of a link arriving during a command is kept for it
+        sim.remote_send(b'pong', link_id=0)
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        buf = bytearray(16)
+        self.assertEqual(sock.recv_into(buf), 4)
+        self.assertEqual(bytes(buf[:4]), b'pong')
+        sock.settimeout(0.1)
+        with self.assertRaises(OSError):
+            sock.recv(16)
+        # closed by the peer: b'' once all data is read
+        sim.remote_send(b'bye', link_id=0)
+        sim.remote_close(link_id=0)
+        self.assertEqual(sock.recv(16), b'bye')
+        self.assertEqual(sock.recv(16), b'')
+        with self.assertRaises(OSError):
+            sock.send(b'x')
+        sock.close()
+        echo.close()
+        self.assertEqual(sim.links, {})
+        self.assertEqual(esp.open_connection('TCP', PEER[0], PEER[1]).link_id, 0)
+
+    def test_closed_link_kept(self):
+        sim, esp = driver()
+        old = esp.open_connection('TCP', PEER[0], PEER[1])
+        sim.remote_send(b'old', link_id=0)
+        sim.remote_close(link_id=0)
+        esp.poll(timeout=200)
+        self.assertFalse(old.connected)
+        # the ID is still held by the socket which was not closed yet
+        new = esp.open_connection('TCP', PEER[0], PEER[1])
+        self.assertEqual(new.link_id, 1)
+        sim.remote_send(b'secret', link_id=1)
+        new.settimeout(1)
+        self.assertEqual(new.recv(16), b'secret')
+        self.assertEqual(old.recv(16), b'old')
+        self.assertEqual(old.recv(16), b'')
+        old.close()
+        self.assertEqual(old.recv(16), b'')
+        with self.assertRaises(OSError):
+            old.send(b'x')
+        self.assertEqual(esp.open_connection('TCP', PEER[0], PEER[1]).link_id, 0)
+
+    def test_passthrough(self):
+        sim, esp = driver()
+        esp.start_connection('TCP', '192.168.0.3', 80)
+        stream = esp.start_passthrough()
+        with self.assertRaises(CommandError):
+            esp.test()
+        # more than a chunk, less than the receive buffer of the UART
+        data = bytes(range(256)) * 12
+        self.assertEqual(stream.write(data), len(data))
+        self.assertEqual(sim.passthrough_bytes, len(data))
+        # the echo of the peer arrives as it is
+        buf = bytearray(len(data))
+        mv = memoryview(buf)
+        got = 0
+        start = time.ticks_ms()
+        while got < len(data) and time.ticks_diff(time.ticks_ms(), start) < 3000:
+            got += stream.readinto(mv[got:])
+        self.assertEqual(bytes(buf), data)
+        self.assertEqual(sim.dropped, 0)
+        stream.stop()
+        self.assertFalse(sim.passthrough)
+        self.assertEqual(sim.cipmode, 0)
+        self.assertTrue(esp.test())
+        # only in single connection mode
+        esp.close_connection()
+        esp.set_mux_mode(True)
+        with self.assertRaises(CommandFailure):
+            esp.start_passthrough()
+
+    def test_ipd_before_prompt(self):
+        sim, esp = driver()
+        received = []
+        sim.peers[(PEER[0].encode(), PEER[1])] = received.append
+        sock = esp.open_connection('TCP', PEER[0], PEER[1])
+        other = esp.open_connection('TCP', '192.168.0.3', 80)
+        # data of the other link with a '>' in it arrives before the prompt
+        garble(sim, b'\r\nOK\r\n\r\n>', b'\r\nOK\r\n\r\n+IPD,1,8:<p>x</p>\r\n>')
+        sock.send(b'hello')
+        self.assertEqual(received, [b'hello'])
+        other.settimeout(1)
+        self.assertEqual(other.recv(16), b'<p>x</p>')
+
+    def test_http(self):
+        sim, esp = driver(9600)
+        body = bytes(range(256)) * 8
+        sim.pages[b'http://x/body'] = body
+        self.assertEqual(esp.http_request('http://x/body'),
+                         {'size': len(body), 'data': body})
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+
+    def test_http_headers(self):
+        sim, esp = driver()
+        sim.pages[b'http://x/p'] = b'page'
+        headers = ['Accept: text/plain', b'X-Id: 1']
+        self.assertEqual(esp.http_request('http://x/p', headers=headers)['data'], b'page')
+        self.assertEqual(esp.http_request('http://x/p', data='a=1', headers=headers,
+                                          method='PUT')['data'], b'page')
+        self.assertEqual(sim.http_requests,
+                         [(2, b'http://x/p', b'', [b'Accept: text/plain', b'X-Id: 1']),
+                          (4, b'http://x/p', b'a=1', [b'Accept: text/plain', b'X-Id: 1'])])
+
+    def test_http_post(self):
+        sim, esp = driver()
+        sim.pages[b'http://x/p'] = b'created'
+        self.assertEqual(esp.http_request('http://x/p', data='a=1', method='POST'),
+                         {'size': 7, 'data': b'created'})
+        self.assertEqual(sim.http_requests[-1][:3], (3, b'http://x/p', b'a=1'))
+        # the body follows the prompt, the answer has no response body
+        self.assertEqual(esp.http_request('http://x/p', data=[b'{"a":', '1}'],
+                                          headers=['X-Id: 1'], method='POST',
+                                          contentType='application/json',
+                                          stream_body=True),
+                         {'size': 0, 'data': b''})
+        self.assertEqual(sim.posts, [(b'http://x/p', [b'X-Id: 1',
+                                                      b'Content-Type: application/json'],
+                                      b'{"a":1}')])
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+
+    def test_http_truncated(self):
+        sim, esp = driver()
+        sim.pages[b'http://x/body'] = b'z' * 512
+        sim.http_chunk = 512
+        garble(sim, b'+HTTPCLIENT:512,' + b'z' * 512 + b'\r\n\r\nOK\r\n',
+               b'+HTTPCLIENT:512,' + b'z' * 100)
+        with self.assertRaises(CommandFailure):
+            esp.http_request('http://x/body')
+
+    def test_reset_keeps_baud(self):
+        sim, esp = driver()
+        rate = esp.negotiate_baud()
+        self.assertGreater(rate, 115200)
+        self.assertTrue(esp.reset())
+        self.assertEqual(esp.baud_rate, rate)
+        self.assertEqual(sim.baudrate, rate)
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def client(self, **kwargs):
+        sim, esp = driver()
+        server = HTTPServer({b'/a': b'first', b'/b': b'second'}, **kwargs)
+        sim.peers[(b'x', 80)] = server
+        return sim, server, HTTPClient(esp, timeout=0.5)
+
+    def test_keep_alive(self):
+        sim, server, client = self.client()
+        self.assertEqual(client.get('http://x/a').data, b'first')
+        r = client.post('http://x/b', 'a=1', headers=['X-Id: 1'])
+        self.assertEqual((r.status, r.reason, r.data), (200, 'OK', b'second'))
+        self.assertEqual(r.headers['content-type'], 'text/plain')
+        self.assertEqual(client.get('http://x/c').status, 404)
+        self.assertEqual(client.connects, 1)
+        self.assertEqual(server.requests, [(b'GET', b'/a'), (b'POST', b'/b'), (b'GET', b'/c')])
+        client.close()
+        self.assertEqual(sim.links, {})
+
+    def test_chunked(self):
+        sim, server, client = self.client(chunk=2)
+        r = client.get('http://x/b')
+        self.assertEqual(r.headers['transfer-encoding'], 'chunked')
+        self.assertEqual(r.data, b'second')
+        self.assertEqual(client.get('http://x/a').data, b'first')
+        self.assertEqual(client.connects, 1)
+
+    def test_connection_close(self):
+        sim, server, client = self.client(keep_alive=False)
+        self.assertEqual(client.get('http://x/a').data, b'first')
+        self.assertEqual(client.get('http://x/b').data, b'second')
+        self.assertEqual(client.connects, 2)
+        sim, server, client = self.client()
+        self.assertEqual(client.get('http://x/a', keep_alive=False).data, b'first')
+        self.assertEqual(client.get('http://x/a').data, b'first')
+        self.assertEqual(client.connects, 2)
+
+    def test_retry_closed(self):
+        sim, server, client = self.client()
+        self.assertEqual(client.get('http://x/a').data, b'first')
+
+        def drop(data):
+            # the server closes the kept link without answering
+            sim.peers[(b'x', 80)] = server
+            return None, True
+        sim.peers[(b'x', 80)] = drop
+        self.assertEqual(client.get('http://x/b').data, b'second')
+        self.assertEqual(client.connects, 2)
+        self.assertEqual(server.requests, [(b'GET', b'/a'), (b'GET', b'/b')])
+
+    def test_no_retry_on_timeout(self):
+        sim, server, client = self.client()
+        self.assertEqual(client.get('http://x/a').data, b'first')
+        received = []
+        sim.peers[(b'x', 80)] = received.append
+        with self.assertRaises(OSError):
+            client.post('http://x/b', 'a=1')
+        # the request may have reached the server, it is not sent again
+        self.assertEqual(b''.join(received).count(b'POST /b'), 1)
+        self.assertEqual(client.connects, 1)
+
+
+class ShortWrites(object):
+    """Transport to the modem accepting only a few bytes per write(), like
+    a socket with a full send buffer."""
+
+    def __init__(self, sim, size=3):
+        self.sim = sim
+        self.size = size
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def write(self, buf):
+        n = min(len(buf), self.size)
+        self.sim.write(bytes(buf[:n]))
+        return n
+
+    def readinto(self, buf):
+        return self.sim.readinto(buf) or None
+
+    def any(self):
+        return self.sim.any()
+
+    def wait(self, timeout):
+        start = time.ticks_ms()
+        while not self.sim.any():
+            if timeout is not None and time.ticks_diff(time.ticks_ms(), start) >= timeout:
+                return False
+            time.sleep_ms(1)
+        return True
+
+
+class TransportTest(unittest.TestCase):
+
+    def test_overflows(self):
+        uart = machine.UART(2, 115200, rxbuf=16)
+        sim = machine.device(2)
+        transport = UARTTransport(uart, 16)
+        sim.emit(b'x' * 32)
+        time.sleep_ms(50)
+        # polling a full buffer again is the same overflow
+        for _ in range(3):
+            self.assertEqual(transport.any(), 16)
+        self.assertEqual(transport.overflows, 1)
+        buf = bytearray(16)
+        transport.readinto(buf)
+        self.assertEqual(transport.any(), 0)
+        sim.emit(b'y' * 20)
+        time.sleep_ms(50)
+        transport.any()
+        self.assertEqual(transport.overflows, 2)
+        # never counted with RTS/CTS flow control
+        transport.init(115200, flow=machine.UART.RTS | machine.UART.CTS)
+        transport.readinto(buf)
+        sim.emit(b'z' * 20)
+        time.sleep_ms(50)
+        transport.any()
+        self.assertEqual(transport.overflows, 2)
+
+    def test_short_writes(self):
+        sim = modem()
+        received = []
+        sim.peers[(PEER[0].encode(), PEER[1])] = received.append
+        esp = ESPCHIP(ShortWrites(sim))
+        self.assertTrue(esp.test())
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        esp.start_connection('TCP', PEER[0], PEER[1])
+        esp.send(b'hello world')
+        self.assertEqual(received, [b'hello world'])
+
+    def check(self, sim, esp):
+        self.assertTrue(esp.test())
+        self.assertEqual(esp.get_mode(fresh=True), sim.mode)
+        self.assertEqual(len(esp.list_all_accesspoints()), len(sim.aps))
+        esp.start_connection('TCP', '192.168.0.3', 80)
+        esp.send(b'x' * 3000)
+        buf = bytearray(4096)
+        got = 0
+        while got < 3000:
+            got += esp.recv_into(memoryview(buf)[got:], timeout=1000)
+        self.assertEqual(bytes(buf[:got]), b'x' * 3000)
+
+    def test_serial(self):
+        sim = modem()
+        transport = SerialTransport(serve_pty(sim), 115200)
+        self.addCleanup(transport.close)
+        self.check(sim, ESPCHIP(transport))
+
+    def test_socket(self):
+        sim = modem()
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(serve(sim))
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        transport = SocketTransport('127.0.0.1', server.sockets[0].getsockname()[1])
+
+        def stop():
+            transport.close()
+            # let the server see the end of the connection
+            time.sleep_ms(50)
+            loop.call_soon_threadsafe(loop.stop)
+        self.addCleanup(stop)
+        self.check(sim, ESPCHIP(transport))
+
+
+class AsyncTest(unittest.TestCase):
+
+    def run_async(self, test, sim=None):
+        """Run the coroutine test(sim, esp) against the modem served over
+        TCP."""
+        sim = sim or modem()
+
+        async def main():
+            server = await serve(sim)
+            port = server.sockets[0].getsockname()[1]
+            esp = AsyncESPCHIP(*await asyncio.open_connection('127.0.0.1', port))
+            try:
+                await test(sim, esp)
+            finally:
+                await esp.close()
+                # let the server see the end of the connection
+                await asyncio.sleep(0.05)
+                server.close()
+                await server.wait_closed()
+        asyncio.run(main())
+
+    def test_events(self):
+        async def test(sim, esp):
+            self.assertTrue(await esp.connect(TEST_AP_SSID, TEST_AP_PASS))
+            # removed from the answer and kept in events
+            garble(sim, b'\r\nOK\r\n', b'WIFI DISCONNECT\r\n0,CLOSED\r\n\r\nOK\r\n')
+            self.assertTrue(await esp.test())
+            self.assertEqual(esp.events[-2:], [('WIFI_DISCONNECT', None), ('CLOSED', 0)])
+            self.assertEqual(await esp.get_mode(), sim.mode)
+        self.run_async(test)
+
+    def test_concurrent(self):
+        async def test(sim, esp):
+            sim.pages[b'http://x/p'] = b'page'
+            results = await asyncio.gather(
+                esp.get_mode(), esp.set_mode(3), esp.get_mode(),
+                esp.http_request('http://x/p', headers=['Accept: text/plain']),
+                esp.list_all_accesspoints())
+            self.assertEqual(results[:3], [1, [], 3])
+            self.assertEqual(results[3], {'size': 4, 'data': b'page'})
+            self.assertEqual(len(results[4]), len(sim.aps))
+            self.assertEqual(sim.http_requests[-1][3], [b'Accept: text/plain'])
+        self.run_async(test)
+
+    def test_scan_timeout(self):
+        async def test(sim, esp):
+            sim.scan_ms = 3000
+            self.assertEqual(await esp.list_all_accesspoints(timeout=100), [])
+        self.run_async(test)
+
+    def test_echo_off(self):
+        async def test(sim, esp):
+            self.assertTrue(await esp.set_echo(False))
+            self.assertFalse(sim.echo)
+            self.assertEqual(await esp.get_mode(), sim.mode)
+            self.assertTrue(await esp.reset())
+            # turned off again before the next command
+            self.assertTrue(await esp.test())
+            self.assertFalse(sim.echo)
+        self.run_async(test)
+
+    def test_echo_off_slow_answer(self):
+        async def test(sim, esp):
+            self.assertTrue(await esp.set_echo(False))
+            sim.join_ms, sim.join_scan_ms, sim.scan_ms = 1200, 300, 1500
+            self.assertTrue(await esp.connect(TEST_AP_SSID, TEST_AP_PASS))
+            self.assertEqual(len(await esp.list_all_accesspoints()), len(sim.aps))
+        self.run_async(test)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Minimal stand-in for the MicroPython utime module, so the driver can be
+run with CPython on a host machine.
+"""
+import time as _time
+
+_start = _time.monotonic()
+
+
+def ticks_ms():
+    return int((_time.monotonic() - _start) * 1000)
+
+
+def ticks_us():
+    return int((_time.monotonic() - _start) * 1000000)
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def ticks_add(a, b):
+    return a + b
+
+
+def sleep(s):
+    _time.sleep(s)
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+
+def time():
+    return int(_time.time())
@@ -1,26 +1,185 @@
 from machine import UART
 import utime
 
+from esp_at_transport import UARTTransport
+
 """
 The MicroPython port for Pi Pico has no timeout for readline() at this moment.
 We use this hack to make sure it won't get stuck forever.
+
+Received bytes are drained from the UART in bulk into a preallocated ring
+buffer and lines are split from there, so reading a line costs a single
+allocation instead of one per byte. streamTimeOut does the same on top of
+any transport (see esp_at_transport), uartTimeOut on top of a UART.
 """
 
-class uartTimeOut(UART):
+# Default size of the receive ring buffer in bytes
+RX_RING_SIZE = 1024
+# Size of the receive buffer of the UART driver. The default of the port is
+# too small to hold a burst of +CWLAP or +IPD data at higher baud rates.
+UART_RX_BUF = 4096
 
-   def readline(self, timeOut=100):
-       if timeOut is None:
-           return super().readline()
+# Lines of the ESP AT firmware which are followed by raw data instead of a
+# '\n': a line starting with the prefix already ends at the terminator.
+FRAMED_LINES = ((b'+IPD,', ord(':')), (b'+HTTPCLIENT:', ord(',')))
+
+class streamTimeOut(object):
+
+   def __init__(self, transport, ringSize=RX_RING_SIZE):
+       self.transport = transport
+       self._ring = bytearray(ringSize)
+       self._mv = memoryview(self._ring)
+       self._head = 0
+       self._len = 0
+       # bytes after _head already searched for a line end
+       self._scan = 0
+       # bytes handed out to the caller and bytes allocated to do so
+       self.consumed = 0
+       self.allocated = 0
+
+   def __repr__(self):
+       return repr(self.transport)
+
+   def init(self, *args, **kwargs):
+       """Change the line settings of the transport."""
+       self.transport.init(*args, **kwargs)
+
+   def write(self, buf):
+       return self.transport.write(buf)
+
+   def stats(self):
+       """Return the number of bytes consumed from the ring and allocated
+       for the returned objects and the number of overflows of the
+       receive buffer of the transport."""
+       return {'consumed': self.consumed, 'allocated': self.allocated,
+               'overflows': getattr(self.transport, 'overflows', 0)}
+
+   def _fill(self):
+       """Move everything the transport has received into the ring."""
+       n = self.transport.any()
+       size = len(self._ring)
+       while n > 0 and self._len < size:
+           tail = (self._head + self._len) % size
+           chunk = min(n, size - self._len, size - tail)
+           got = self.transport.readinto(self._mv[tail:tail + chunk])
+           if not got:
+               break
+           self._len += got
+           n -= got
+
+   def _take(self, n):
+       """Remove n bytes from the ring and return them as bytes."""
+       size = len(self._ring)
+       head = self._head
+       if head + n <= size:
+           data = bytes(self._mv[head:head + n])
        else:
-           now = utime.ticks_ms()
-           data = b''
-           while True:
-               if utime.ticks_ms()-now > timeOut:
-                   break
-               else:
-                   if super().any():
-                       _d = super().read(1)
-                       data += _d
-                       if "\n" in _d:
-                           break
-           return data
+           data = bytes(self._mv[head:]) + bytes(self._mv[:head + n - size])
+           # the two halves are allocated as well
+           self.allocated += n
+       self._head = (head + n) % size
+       self._len -= n
+       self._scan = 0
+       self.consumed += n
+       self.allocated += n
+       return data
+
+   def _startswith(self, prefix):
+       ring = self._ring
+       size = len(ring)
+       if self._len < len(prefix):
+           return False
+       for i in range(len(prefix)):
+           if ring[(self._head + i) % size] != prefix[i]:
+               return False
+       return True
+
+   def _line_end(self):
+       """Return the length of the first complete line in the ring or 0."""
+       ring = self._ring
+       size = len(ring)
+       head = self._head
+       term = 10
+       for prefix, end in FRAMED_LINES:
+           if self._startswith(prefix):
+               term = end
+       i = self._scan
+       while i < self._len:
+           c = ring[(head + i) % size]
+           if c == 10 or c == term:
+               return i + 1
+           i += 1
+       self._scan = i
+       return 0
+
+   def any(self):
+       self._fill()
+       if self._len < len(self._ring):
+           return self._len
+       return self._len + self.transport.any()
+
+   def wait(self, timeout):
+       """Wait up to timeout ms (forever if None) for data to arrive,
+       return True if there is any."""
+       return self._len > 0 or self.transport.wait(timeout)
+
+   def peek(self):
+       """Return the next byte without removing it, None if nothing was
+       received."""
+       self._fill()
+       return self._ring[self._head] if self._len else None
+
+   def read(self, nbytes=None):
+       self._fill()
+       if nbytes is None or nbytes > self._len:
+           nbytes = self._len
+       if nbytes == 0:
+           return None
+       return self._take(nbytes)
+
+   def readinto(self, buf, nbytes=None):
+       self._fill()
+       if nbytes is None:
+           nbytes = len(buf)
+       n = min(nbytes, self._len)
+       if n == 0:
+           return None
+       size = len(self._ring)
+       head = self._head
+       first = min(n, size - head)
+       buf[:first] = self._mv[head:head + first]
+       if first < n:
+           buf[first:n] = self._mv[:n - first]
+       self._head = (head + n) % size
+       self._len -= n
+       self._scan = 0
+       self.consumed += n
+       return n
+
+   def readline(self, timeOut=100):
+       """Return the next line including its '\\n'. If no complete line
+       arrives within timeOut ms, whatever was received is returned (b''
+       if nothing). A timeOut of None waits for the line end forever."""
+       now = utime.ticks_ms()
+       while True:
+           self._fill()
+           n = self._line_end()
+           if n == 0 and self._len == len(self._ring):
+               # line does not fit into the ring, hand out what we have
+               n = self._len
+           if n:
+               return self._take(n)
+           if timeOut is None:
+               self.transport.wait(None)
+               continue
+           left = timeOut - utime.ticks_diff(utime.ticks_ms(), now)
+           if left < 0:
+               return self._take(self._len)
+           self.transport.wait(left)
+
+
+class uartTimeOut(streamTimeOut):
+
+   def __init__(self, id, baudrate=115200, ringSize=RX_RING_SIZE, rxbuf=UART_RX_BUF, flow=0, **kwargs):
+       uart = UART(id, baudrate, rxbuf=rxbuf, flow=flow, **kwargs)
+       super().__init__(UARTTransport(uart, rxbuf, flow), ringSize)